@@ -0,0 +1,89 @@
+"""
+Сравнивает скорость отдачи потокового ответа с буферизацией фрагментов и без неё.
+Фрагменты повторяют то, что отдаёт do_stream для категории с товарами.
+
+    python -m benchmarks.payload --units 100000
+"""
+import asyncio
+from argparse import ArgumentParser
+from datetime import datetime
+
+from aiohttp import ClientSession
+from aiohttp.web import Application, AppRunner, Response, TCPSite
+
+from benchmarks.utils import measure
+from megamarket.api.payloads import AsyncStreamJsonPayload, dumps
+
+parser = ArgumentParser()
+parser.add_argument('--units', type=int, default=100_000)
+
+
+class UnbufferedAsyncStreamJsonPayload(AsyncStreamJsonPayload):
+    """
+    Прежний способ записи: каждый фрагмент сразу уходит в сокет.
+    """
+    async def write(self, writer):
+        async for row in self._value:
+            await writer.write(row.encode(self.encoding))
+
+
+async def generate_fragments(units: int):
+    yield '{"children": ['
+
+    for i in range(units):
+        if i:
+            yield ', '
+
+        yield dumps({
+            'id': f'o-{i}',
+            'name': f'Offer {i}',
+            'date': datetime(2022, 1, 1),
+            'type': 'OFFER',
+            'price': i,
+            'parentId': 'c-1',
+            'children': None,
+        })
+        yield ''
+
+    yield '], '
+    yield dumps({'id': 'c-1', 'name': 'c-1', 'type': 'CATEGORY', 'parentId': None,
+                 'price': 0, 'date': datetime(2022, 1, 1)})[1:]
+
+
+async def run(units: int, payload_class: type[AsyncStreamJsonPayload]) -> int:
+    async def handler(_):
+        return Response(body=payload_class(generate_fragments(units)))
+
+    app = Application()
+    app.router.add_get('/', handler)
+
+    runner = AppRunner(app)
+    await runner.setup()
+    site = TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    try:
+        size = 0
+        async with ClientSession() as session:
+            async with session.get(f'http://127.0.0.1:{port}/') as response:
+                async for data in response.content.iter_any():
+                    size += len(data)
+
+        return size
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    args = parser.parse_args()
+
+    for payload_class in (UnbufferedAsyncStreamJsonPayload, AsyncStreamJsonPayload):
+        with measure(payload_class.__name__):
+            size = asyncio.run(run(args.units, payload_class))
+
+        print(f'{payload_class.__name__}: {size} bytes')
+
+
+if __name__ == '__main__':
+    main()
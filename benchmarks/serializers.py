@@ -0,0 +1,67 @@
+"""
+Сравнивает сериализаторы на тех элементах, из которых собираются ответы:
+товар и категория в /nodes, категория без детей в /node/{id}/statistic и товар в /sales.
+Замеряется время получения готовых байтов, то есть вместе с кодированием.
+
+    python -m benchmarks.serializers --number 100000
+"""
+import timeit
+from argparse import ArgumentParser
+from datetime import datetime
+
+from megamarket.api import payloads
+from megamarket.api.handlers.sales import GetSalesQuery
+from megamarket.db.schema import ShopUnitType
+from megamarket.utils.streamers import ShopUnitSubtreeStreamer, SubtreeNode
+
+parser = ArgumentParser()
+parser.add_argument('--number', type=int, default=100_000)
+
+OFFER = {
+    'shop_unit_id': '863e1a7a-1304-42ae-943b-179184c077e3',
+    'name': 'jPhone 13',
+    'price': 79999,
+    'type': ShopUnitType.OFFER,
+    'date': datetime(2022, 2, 3, 12),
+    'parent_id': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
+}
+
+CATEGORY = {
+    'shop_unit_id': 'd515e43f-f3f6-4471-bb77-6b455017a2d2',
+    'name': 'Смартфоны',
+    'price': None,
+    'type': ShopUnitType.CATEGORY,
+    'date': datetime(2022, 2, 2, 12),
+    'parent_id': '069cb8d7-bbdd-47d3-ad8f-82ef4c269df1',
+}
+
+
+def get_cases():
+    nodes = ShopUnitSubtreeStreamer(None, None, stream_children=True)
+    statistic = ShopUnitSubtreeStreamer(None, None, stream_children=False)
+
+    node = SubtreeNode(CATEGORY)
+    node.add(159998, 2, datetime(2022, 2, 3, 12))
+
+    return {
+        'nodes-offer': lambda: nodes.dump_offer(OFFER),
+        'nodes-category': lambda: b''.join(nodes.finalize([SubtreeNode(CATEGORY), node])),
+        'statistic-category': lambda: statistic.dump_category(node),
+        'sales-offer': lambda: GetSalesQuery.dump_unit(OFFER),
+    }
+
+
+def main():
+    args = parser.parse_args()
+    cases = get_cases()
+
+    for name in payloads.SERIALIZERS:
+        payloads.use_serializer(name)
+
+        for case, dump in cases.items():
+            elapsed = timeit.timeit(dump, number=args.number)
+            print(f'{name:>8} {case:>20}: {elapsed / args.number * 1e6:.2f} us')
+
+
+if __name__ == '__main__':
+    main()
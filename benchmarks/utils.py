@@ -0,0 +1,55 @@
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+
+from alembic.command import upgrade
+from sqlalchemy import create_engine
+from sqlalchemy_utils import create_database, drop_database
+from yarl import URL
+
+from megamarket.utils import testing
+from megamarket.utils.pg import make_alembic_config
+
+
+@contextmanager
+def temporary_database(pg_url: URL):
+    """
+    Создаёт пустую базу с применёнными миграциями и удаляет её по завершении.
+    """
+    tmp_url = str(pg_url.with_path('.'.join([uuid.uuid4().hex, 'benchmark'])))
+    create_database(tmp_url)
+
+    try:
+        options = SimpleNamespace(config='alembic.ini', name='alembic',
+                                  pg_url=tmp_url, raiseerr=False, x=None)
+        upgrade(make_alembic_config(options), 'head')
+
+        yield URL(tmp_url)
+    finally:
+        drop_database(tmp_url)
+
+
+@contextmanager
+def measure(title: str):
+    started_at = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        print(f'{title}: {time.perf_counter() - started_at:.3f} s')
+
+
+def seed_catalog(pg_url: URL, categories: int, offers: int, revisions: int,
+                 base_date: datetime):
+    """
+    Наполняет базу каталогом, все ревизии товара укладываются в один день от base_date.
+    """
+    engine = create_engine(str(pg_url))
+
+    try:
+        with engine.begin() as conn:
+            testing.seed_catalog(conn, categories, offers, revisions, base_date)
+    finally:
+        engine.dispose()
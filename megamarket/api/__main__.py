@@ -1,7 +1,9 @@
 import logging
 import os
 import pwd
+import signal
 import sys
+from functools import partial
 
 from aiohttp import web
 from aiomisc.utils import bind_socket
@@ -10,8 +12,18 @@ from setproctitle import setproctitle
 from yarl import URL
 
 from megamarket.api.app import create_app
-from megamarket.utils.argparse import positive_int
-from megamarket.utils.pg import DEFAULT_PG_URL
+from megamarket.api.middleware import StatsAccessLogger
+from megamarket.api.payloads import DEFAULT_FLUSH_SIZE, DEFAULT_FLUSH_INTERVAL, \
+    DEFAULT_SERIALIZER, SERIALIZERS
+from megamarket.utils.argparse import positive_int, positive_float, non_negative_int
+from megamarket.utils.cache import DEFAULT_NODES_CACHE_SIZE
+from megamarket.utils.deadline import DEFAULT_NODES_TIMEOUT, DEFAULT_NODE_STATISTIC_TIMEOUT, \
+    DEFAULT_SALES_TIMEOUT
+from megamarket.utils.replicas import DEFAULT_PG_REPLICA_CHECK_INTERVAL
+from megamarket.utils.workers import WorkerPool, DEFAULT_SHUTDOWN_TIMEOUT
+from megamarket.utils.pg import DEFAULT_PG_URL, DEFAULT_PG_PREFETCH, DEFAULT_PG_POOL_MIN, \
+    DEFAULT_PG_POOL_MAX, DEFAULT_PG_POOL_OVERFLOW, DEFAULT_PG_POOL_TIMEOUT, \
+    DEFAULT_PG_STATEMENT_CACHE_SIZE, DEFAULT_PG_RAW_POOL_MAX
 
 ENV_VAR_PREFIX = 'MEGAMARKET_'
 
@@ -31,19 +43,88 @@ group.add_argument('--api-address', default='0.0.0.0',
                    help='IPv4/IPv6 address API server should listen on')
 group.add_argument('--api-port', type=positive_int, default=8081,
                    help='TCP port API server should listen on')
+group.add_argument('--workers', type=positive_int, default=1,
+                   help='Number of worker processes sharing the API socket')
+group.add_argument('--metrics-port', type=positive_int, default=None,
+                   help='TCP port serving /metrics instead of the API port. '
+                        'With several workers, worker N listens on this port + N')
+group.add_argument('--shutdown-timeout', type=positive_float, default=DEFAULT_SHUTDOWN_TIMEOUT,
+                   help='Seconds workers are given to finish requests on shutdown')
+group.add_argument('--stream-flush-size', type=positive_int, default=DEFAULT_FLUSH_SIZE,
+                   help='Bytes of a streamed response buffered before writing to the socket')
+group.add_argument('--stream-flush-interval', type=positive_float,
+                   default=DEFAULT_FLUSH_INTERVAL,
+                   help='Seconds a buffered part of a streamed response may wait for more data')
+group.add_argument('--json-serializer', choices=list(SERIALIZERS), default=DEFAULT_SERIALIZER,
+                   help='JSON serializer used to render responses')
+group.add_argument('--nodes-cache-size', type=non_negative_int,
+                   default=DEFAULT_NODES_CACHE_SIZE,
+                   help='Bytes of rendered /nodes responses cached in memory, 0 disables cache')
+group.add_argument('--nodes-timeout', type=positive_float, default=DEFAULT_NODES_TIMEOUT,
+                   help='Seconds a /nodes request may read from the database')
+group.add_argument('--node-statistic-timeout', type=positive_float,
+                   default=DEFAULT_NODE_STATISTIC_TIMEOUT,
+                   help='Seconds a /node/{id}/statistic request may read from the database')
+group.add_argument('--sales-timeout', type=positive_float, default=DEFAULT_SALES_TIMEOUT,
+                   help='Seconds a /sales request may read from the database')
 
 group = parser.add_argument_group('PostgreSQL Options')
 group.add_argument('--pg-url', type=URL, default=URL(DEFAULT_PG_URL),
                    help='URL to use to connect to the database')
+group.add_argument('--pg-prefetch', type=positive_int, default=DEFAULT_PG_PREFETCH,
+                   help='Number of rows fetched from a server-side cursor at once')
+group.add_argument('--pg-pool-min', type=positive_int, default=DEFAULT_PG_POOL_MIN,
+                   help='Connections opened on startup and kept in the pool')
+group.add_argument('--pg-pool-max', type=positive_int, default=DEFAULT_PG_POOL_MAX,
+                   help='Connections kept in the pool')
+group.add_argument('--pg-pool-overflow', type=non_negative_int,
+                   default=DEFAULT_PG_POOL_OVERFLOW,
+                   help='Extra connections opened when the pool is exhausted')
+group.add_argument('--pg-pool-timeout', type=positive_float, default=DEFAULT_PG_POOL_TIMEOUT,
+                   help='Seconds to wait for a free connection')
+group.add_argument('--pg-pool-pre-ping', action='store_true',
+                   help='Check connections before taking them from the pool')
+group.add_argument('--pg-statement-cache-size', type=non_negative_int,
+                   default=DEFAULT_PG_STATEMENT_CACHE_SIZE,
+                   help='Prepared statements cached per connection, 0 disables cache')
+group.add_argument('--pg-command-timeout', type=positive_float, default=None,
+                   help='Seconds a single query may run on the client side')
+group.add_argument('--pg-raw-pool', action='store_true',
+                   help='Serve read-only streaming handlers from a separate asyncpg pool')
+group.add_argument('--pg-raw-pool-max', type=positive_int, default=DEFAULT_PG_RAW_POOL_MAX,
+                   help='Connections kept in the asyncpg pool, in addition to the '
+                        '--pg-pool-max and --pg-pool-overflow connections of the main pool')
+group.add_argument('--pg-replica-url', type=URL, action='append', default=[],
+                   help='URL of a read replica serving GET handlers, can be repeated')
+group.add_argument('--pg-replica-check-interval', type=positive_float,
+                   default=DEFAULT_PG_REPLICA_CHECK_INTERVAL,
+                   help='Seconds between replica health checks')
+group.add_argument('--pg-read-your-writes', action='store_true',
+                   help='Read from a replica only after it has replayed the last import '
+                        'or delete made by this process')
 
 group = parser.add_argument_group('Logging Options')
 group.add_argument('--log-level', default='INFO',
                    choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
 
 
+def serve(args, sock, metrics_socks: list, index: int | None = None):
+    if index is not None:
+        setproctitle(f'{os.path.basename(sys.argv[0])} worker {index}')
+
+    # Приложение и пул соединений создаются уже в процессе воркера
+    metrics_sock = metrics_socks[index or 0] if metrics_socks else None
+    app = create_app(args, worker=index, metrics_sock=metrics_sock)
+    web.run_app(app, sock=sock, shutdown_timeout=args.shutdown_timeout,
+                access_log_class=StatsAccessLogger)
+
+
 def main():
     args = parser.parse_args()
 
+    if args.pg_pool_min > args.pg_pool_max:
+        parser.error('--pg-pool-min must not exceed --pg-pool-max')
+
     # clear_environ(lambda k: k.startswith(ENV_VAR_PREFIX))
 
     logging.basicConfig(level=args.log_level, format='color')
@@ -51,6 +132,15 @@ def main():
     sock = bind_socket(address=args.api_address, port=args.api_port,
                        proto_name='http')
 
+    # Сокеты метрик, как и сокет API, открываются до смены пользователя и fork
+    metrics_socks = []
+    if args.metrics_port is not None:
+        metrics_socks = [
+            bind_socket(address=args.api_address, port=args.metrics_port + index,
+                        proto_name='http')
+            for index in range(args.workers)
+        ]
+
     if args.user is not None:
         logging.info('Changing user to %r', args.user.pw_name)
         os.setgid(args.user.pw_gid)
@@ -58,8 +148,17 @@ def main():
 
     setproctitle(os.path.basename(sys.argv[0]))
 
-    app = create_app(args)
-    web.run_app(app, sock=sock)
+    if args.workers == 1:
+        serve(args, sock, metrics_socks)
+        return
+
+    pool = WorkerPool(partial(serve, args, sock, metrics_socks), args.workers,
+                      shutdown_timeout=args.shutdown_timeout)
+
+    signal.signal(signal.SIGTERM, pool.stop)
+    signal.signal(signal.SIGINT, pool.stop)
+
+    pool.run()
 
 
 if __name__ == '__main__':
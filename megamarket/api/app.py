@@ -1,4 +1,5 @@
 import logging
+import socket
 from collections.abc import AsyncIterable
 from functools import partial
 from typing import Mapping
@@ -6,14 +7,17 @@ from types import MappingProxyType, AsyncGeneratorType
 
 from configargparse import Namespace
 from aiohttp import PAYLOAD_REGISTRY
-from aiohttp.web import Application
+from aiohttp.web import Application, AppRunner, SockSite
 from aiohttp_apispec import validation_middleware, setup_aiohttp_apispec
 from aiohttp_swagger import setup_swagger
 
+from megamarket.utils.cache import SubtreeCache
 from megamarket.utils.pg import setup_pg
-from megamarket.api.handlers import HANDLERS
-from megamarket.api.middleware import error_middleware, handle_validation_error
-from megamarket.api.payloads import JsonPayload, AsyncStreamJsonPayload
+from megamarket.api.handlers import HANDLERS, MetricsView
+from megamarket.api.metrics import ApiMetrics
+from megamarket.api.middleware import error_middleware, handle_validation_error, \
+    instrumentation_middleware
+from megamarket.api.payloads import JsonPayload, AsyncStreamJsonPayload, use_serializer
 
 MEGABYTE = 1024 ** 1024
 MAX_REQUEST_SIZE = 5 * MEGABYTE
@@ -28,15 +32,56 @@ async def swagger(app):
     )
 
 
-def create_app(args: Namespace) -> Application:
+async def serve_metrics(app: Application, sock: socket.socket):
+    """
+    Отдаёт /metrics воркера на его собственном сокете. Через общий сокет API запрос
+    попал бы к случайному воркеру, и счётчики скакали бы между процессами.
+    """
+    metrics_app = Application()
+    metrics_app['metrics'] = app['metrics']
+    metrics_app.router.add_route('*', MetricsView.URL_PATH, MetricsView)
+
+    runner = AppRunner(metrics_app, access_log=None)
+    await runner.setup()
+    await SockSite(runner, sock).start()
+
+    try:
+        yield
+    finally:
+        await runner.cleanup()
+
+
+def create_app(args: Namespace, worker: int | None = None,
+               metrics_sock: socket.socket | None = None) -> Application:
+    """
+    :param worker: Номер воркера, если API запущено в нескольких процессах
+    :param metrics_sock: Отдельный сокет для /metrics
+    """
     app = Application(
         client_max_size=MAX_REQUEST_SIZE,
-        middlewares=[error_middleware, validation_middleware]
+        middlewares=[instrumentation_middleware, error_middleware, validation_middleware]
     )
 
     app.cleanup_ctx.append(partial(setup_pg, args=args))
+    app['pg_prefetch'] = args.pg_prefetch
+    app['nodes_cache'] = SubtreeCache(args.nodes_cache_size)
+    app['metrics'] = ApiMetrics(app, worker)
+    app['timeouts'] = {
+        'nodes': args.nodes_timeout,
+        'node_statistic': args.node_statistic_timeout,
+        'sales': args.sales_timeout,
+    }
+
+    handlers = HANDLERS
+    if metrics_sock is not None:
+        app.cleanup_ctx.append(partial(serve_metrics, sock=metrics_sock))
+        handlers = tuple(handler for handler in HANDLERS if handler is not MetricsView)
+    elif args.workers > 1:
+        log.warning('Metrics are not served: set --metrics-port to serve them with '
+                    'several workers')
+        handlers = tuple(handler for handler in HANDLERS if handler is not MetricsView)
 
-    for handler in HANDLERS:
+    for handler in handlers:
         log.debug('Registering handler: %r as %r', handler, handler.URL_PATH)
         app.router.add_route('*', handler.URL_PATH, handler)
 
@@ -45,7 +90,13 @@ def create_app(args: Namespace) -> Application:
 
     app.on_startup.append(swagger)
 
+    use_serializer(args.json_serializer)
     PAYLOAD_REGISTRY.register(JsonPayload, (Mapping, MappingProxyType))
-    PAYLOAD_REGISTRY.register(AsyncStreamJsonPayload, (AsyncGeneratorType, AsyncIterable))
+    PAYLOAD_REGISTRY.register(
+        partial(AsyncStreamJsonPayload,
+                flush_size=args.stream_flush_size,
+                flush_interval=args.stream_flush_interval),
+        (AsyncGeneratorType, AsyncIterable)
+    )
 
     return app
@@ -1,7 +1,9 @@
 from .imports import ImportsView
 from .delete import DeleteView
-from .nodes import NodesView
+from .nodes import NodesView, NodesBatchView
 from .sales import SalesView
 from .node import NodeView
+from .metrics import MetricsView
 
-HANDLERS = (ImportsView, DeleteView, NodesView, SalesView, NodeView)
+HANDLERS = (ImportsView, DeleteView, NodesView, NodesBatchView, SalesView, NodeView,
+            MetricsView)
@@ -1,5 +1,80 @@
+from collections.abc import AsyncIterable, AsyncIterator
+
+from aiohttp.helpers import ETag, ETAG_ANY
+from aiohttp.web_exceptions import HTTPNotModified, HTTPNotFound
+from aiohttp.web_response import Response
 from aiohttp.web_urldispatcher import View
+from asyncpg import Record
+from sqlalchemy.engine import Row
 from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.sql import Executable
+
+from megamarket.api.metrics import ApiMetrics
+from megamarket.utils.cache import SubtreeCache
+from megamarket.utils.deadline import Deadline, NO_DEADLINE
+from megamarket.utils.pg import PgReader, read_transaction, fetch
+from megamarket.utils.replicas import ReplicaSet
+
+
+class SnapshotQuery(AsyncIterable):
+    """
+    Тело ответа, которое целиком читается из одного снимка базы.
+
+    open() берёт соединение, начинает транзакцию и читает заголовочную запись:
+    по ней обработчик отвечает 404 или считает ETag ещё до отправки заголовков.
+    Тело дочитывается в той же транзакции, поэтому не может разойтись с ними.
+    Если тело не понадобилось, транзакцию закрывает close(). Ответ, который так и
+    не начали отправлять, закроет сборщик асинхронных генераторов цикла событий.
+    """
+    def __init__(self, pg: PgReader, deadline: Deadline = NO_DEADLINE):
+        self._pg = pg
+        self._deadline = deadline
+        self._chunks: AsyncIterator | None = None
+
+    def get_head_query(self) -> Executable:
+        raise NotImplementedError()
+
+    def stream(self, conn, head: Row | Record) -> AsyncIterable[bytes]:
+        raise NotImplementedError()
+
+    async def read(self):
+        async with read_transaction(self._pg, self._deadline) as conn:
+            rows = await fetch(conn, self.get_head_query(), self._deadline)
+            head = rows[0] if rows else None
+
+            yield head
+            if head is None:
+                return
+
+            async for chunk in self.stream(conn, head):
+                yield chunk
+
+    async def open(self) -> Row | Record | None:
+        """
+        Возвращает заголовочную запись или None, если её нет. Без записи
+        транзакция сразу закрывается.
+        """
+        self._chunks = self.read()
+        head = await self._chunks.__anext__()
+
+        if head is None:
+            await self.close()
+
+        return head
+
+    async def close(self):
+        if self._chunks is not None:
+            await self._chunks.aclose()
+
+    async def __aiter__(self):
+        try:
+            if self._chunks is None and await self.open() is None:
+                raise HTTPNotFound()
+
+            async for chunk in self._chunks:
+                yield chunk
+        finally:
+            await self.close()
 
 
 class BaseView(View):
@@ -7,7 +82,58 @@ class BaseView(View):
     Базовый обработчик, предоставляет удобный доступ к Engine'у
     """
     URL_PATH: str
+    # Ключ срока обработки в app['timeouts'], если обработчик читает с ограничением по времени
+    TIMEOUT: str | None = None
 
     @property
     def pg(self) -> AsyncEngine:
         return self.request.app['pg']
+
+    @property
+    def pg_reader(self) -> PgReader:
+        """
+        Откуда читают потоковые обработчики: реплика или основная база,
+        через пул asyncpg, если он включён, иначе через движок.
+        Выбирается один раз на запрос, чтобы все его запросы читали одну базу.
+        """
+        if 'pg_reader' not in self.request:
+            self.request['pg_reader'] = self.pg_replicas.choose()
+
+        return self.request['pg_reader']
+
+    @property
+    def pg_replicas(self) -> ReplicaSet:
+        return self.request.app['pg_replicas']
+
+    @property
+    def pg_prefetch(self) -> int:
+        return self.request.app['pg_prefetch']
+
+    @property
+    def nodes_cache(self) -> SubtreeCache:
+        return self.request.app['nodes_cache']
+
+    @property
+    def metrics(self) -> ApiMetrics:
+        return self.request.app['metrics']
+
+    def make_deadline(self) -> Deadline:
+        """
+        Срок обработки запроса, отсчитанный от текущего момента.
+        """
+        timeout = self.request.app['timeouts'][self.TIMEOUT] if self.TIMEOUT else None
+        return Deadline(timeout)
+
+    def not_modified(self, etag: ETag) -> Response | None:
+        """
+        Возвращает ответ 304, если у клиента уже есть версия etag, иначе None.
+        Теги сравниваются без учёта слабости, как того требует If-None-Match.
+        """
+        if_none_match = self.request.if_none_match or ()
+
+        if any(tag.value in (etag.value, ETAG_ANY) for tag in if_none_match):
+            response = Response(status=HTTPNotModified.status_code)
+            response.etag = etag
+            return response
+
+        return None
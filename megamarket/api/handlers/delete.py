@@ -1,9 +1,12 @@
 from aiohttp.web_exceptions import HTTPNotFound, HTTPOk
 from aiohttp.web_response import Response
 from aiohttp_apispec import match_info_schema
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import array
 
 from .base import BaseView
-from megamarket.db.schema import shop_unit_ids_table
+from megamarket.db.schema import shop_unit_ids_table, shop_units_current_table, ShopUnitType
+from megamarket.utils.aggregates import update_category_aggregates, update_versions
 from ..schema import IdMatchInfoRequestSchema
 
 
@@ -13,20 +16,61 @@ class DeleteView(BaseView):
     """
     URL_PATH = r'/delete/{id:[\da-zA-Z\-]+}'
 
+    @classmethod
+    def get_descendant_ids_query(cls, unit_id):
+        # Путь защищает от зацикливания, если цикл по родителям всё же попал в базу
+        descendants = (
+            select([
+                shop_units_current_table.c.id,
+                array([shop_units_current_table.c.id]).label('path'),
+            ])
+            .where(shop_units_current_table.c.id == unit_id)
+            .cte('descendants', recursive=True)
+        )
+
+        descendants = descendants.union_all(
+            select([
+                shop_units_current_table.c.id,
+                func.array_append(descendants.c.path, shop_units_current_table.c.id),
+            ])
+            .where(shop_units_current_table.c.parent_id == descendants.c.id)
+            .where(shop_units_current_table.c.id != func.all(descendants.c.path))
+        )
+
+        return select([descendants.c.id])
+
     @match_info_schema(IdMatchInfoRequestSchema)
     async def delete(self):
         unit_id = self.request['match_info']['id']
 
         async with self.pg.execution_options(isolation_level='SERIALIZABLE').begin() as conn:
-            query = shop_unit_ids_table.select().where(shop_unit_ids_table.c.id == unit_id)
+            query = (
+                select([shop_units_current_table.c.parent_id, shop_units_current_table.c.type])
+                .where(shop_units_current_table.c.id == unit_id)
+            )
 
-            result = await conn.execute(query)
-            if not result.first():
+            unit = (await conn.execute(query)).first()
+            if not unit:
                 raise HTTPNotFound()
 
+            # Вместе с категорией удаляются все её потомки, их ответы тоже устаревают
+            changed_ids = [unit_id]
+            if unit['type'] == ShopUnitType.CATEGORY:
+                result = await conn.execute(self.get_descendant_ids_query(unit_id))
+                changed_ids = [row['id'] for row in result]
+
             query = shop_unit_ids_table.delete().where(shop_unit_ids_table.c.id == unit_id)
             await conn.execute(query)
 
+            if unit['parent_id'] is not None:
+                category_ids = await update_category_aggregates(conn, [unit['parent_id']])
+                await update_versions(conn, category_ids)
+
+                changed_ids += category_ids
+
             await conn.commit()
 
+        self.nodes_cache.invalidate(changed_ids)
+        await self.pg_replicas.note_write()
+
         return Response(status=HTTPOk.status_code)
@@ -1,3 +1,4 @@
+import time
 from typing import Generator
 
 import asyncpg
@@ -6,13 +7,17 @@ from aiohttp.web import Response
 from aiohttp.web_exceptions import HTTPBadRequest, HTTPOk
 from aiohttp_apispec.decorators import request_schema
 from aiomisc import chunk_list
-from sqlalchemy import select
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import select, cast, column, case, literal, text, String
+from sqlalchemy.dialects.postgresql import insert, ARRAY
 from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.sql import func
 
 from megamarket.api.schema import ShopUnitImportRequestSchema
-from megamarket.db.schema import relations_table, shop_unit_revisions_table, shop_unit_ids_table
+from megamarket.db.schema import relations_table, shop_unit_revisions_table, shop_unit_ids_table, \
+    shop_units_current_table, imported_units_table, ShopUnitType
+from megamarket.utils.aggregates import get_parent_ids, update_category_aggregates, \
+    update_versions, ParentCycleError
 from megamarket.utils.pg import max_query_len_with
 from .base import BaseView
 
@@ -23,7 +28,9 @@ class ImportsView(BaseView):
     MAX_UNIT_IDS_PER_INSERT = max_query_len_with(len(shop_unit_ids_table.columns))
     MAX_UNIT_REVISIONS_PER_INSERT = max_query_len_with(len(shop_unit_revisions_table.columns))
     MAX_RELATIONS_PER_INSERT = max_query_len_with(len(relations_table.columns))
-    MAX_SINGLE_ROW_WHERE = max_query_len_with(1)
+
+    # Начиная с такого размера выгрузки элементы загружаются через COPY во временную таблицу
+    MIN_UNITS_TO_COPY = 1000
 
     @classmethod
     def make_shop_units_ids_rows(cls, units):
@@ -44,56 +51,73 @@ class ImportsView(BaseView):
             }
 
     @classmethod
-    def get_revision_ids_query(cls, unit_ids):
-        actual_revision_dates = (
-            select([
-                shop_unit_revisions_table.c.shop_unit_id,
-                func.max(shop_unit_revisions_table.c.date).label('max_date')
-            ])
-            .group_by(shop_unit_revisions_table.c.shop_unit_id)
-            .cte('actual_revision_dates')
+    def get_imported_units(cls, units):
+        unit_ids = [unit['id'] for unit in units]
+        parent_ids = [unit.get('parentId') for unit in units]
+
+        return (
+            func.unnest(cast(unit_ids, ARRAY(String)), cast(parent_ids, ARRAY(String)))
+            .table_valued(column('id', String), column('parent_id', String))
+            .render_derived(name='imported_units')
         )
 
-        actual_revision_ids = (
+    @classmethod
+    def get_update_current_units_query(cls, imported_units, update_date):
+        """
+        :param imported_units: Выборка с колонками id и parent_id загруженных элементов
+        :param update_date: Дата выгрузки, с которой были вставлены ревизии
+        """
+        revisions = (
             select([
-                actual_revision_dates.c.shop_unit_id,
+                shop_unit_revisions_table.c.shop_unit_id,
                 shop_unit_revisions_table.c.id,
+                shop_unit_revisions_table.c.name,
+                shop_unit_revisions_table.c.price,
+                shop_unit_revisions_table.c.type,
+                imported_units.c.parent_id,
+                shop_unit_revisions_table.c.date,
+                func.coalesce(shop_unit_revisions_table.c.price, 0),
+                case((shop_unit_revisions_table.c.type == ShopUnitType.OFFER, 1), else_=0),
+                shop_unit_revisions_table.c.date,
             ])
-            .where(
-                (actual_revision_dates.c.shop_unit_id == shop_unit_revisions_table.c.shop_unit_id) &
-                (actual_revision_dates.c.max_date == shop_unit_revisions_table.c.date),
+            .select_from(
+                shop_unit_revisions_table
+                .join(imported_units,
+                      imported_units.c.id == shop_unit_revisions_table.c.shop_unit_id)
             )
+            .where(shop_unit_revisions_table.c.date == update_date)
         )
 
-        query = (
-            actual_revision_ids
-            .where(shop_unit_revisions_table.c.shop_unit_id.in_(unit_ids))
+        insert_statement = insert(shop_units_current_table).from_select(
+            ['id', 'revision_id', 'name', 'price', 'type', 'parent_id', 'date',
+             'offer_price_sum', 'offer_count', 'last_update'],
+            revisions
         )
 
-        return query
+        return insert_statement.on_conflict_do_update(
+            index_elements=[shop_units_current_table.c.id],
+            set_={
+                'revision_id': insert_statement.excluded.revision_id,
+                'name': insert_statement.excluded.name,
+                'price': insert_statement.excluded.price,
+                'type': insert_statement.excluded.type,
+                'parent_id': insert_statement.excluded.parent_id,
+                'date': insert_statement.excluded.date,
+                'offer_price_sum': insert_statement.excluded.offer_price_sum,
+                'offer_count': insert_statement.excluded.offer_count,
+                'last_update': insert_statement.excluded.last_update,
+            },
+            where=shop_units_current_table.c.date < insert_statement.excluded.date,
+        )
 
     @classmethod
-    async def make_relations_table_rows(cls, units, pg: AsyncConnection):
-        relations = [(unit['id'], unit['parentId'])
-                     for unit in units if 'parentId' in unit and unit['parentId'] is not None]
-        chunked_children_ids = chunk_list(relations, cls.MAX_SINGLE_ROW_WHERE)
-
-        relation_rows = []
-
-        for chunk in chunked_children_ids:
-            relations_dict = {c[0]: c[1] for c in chunk}
-
-            query = cls.get_revision_ids_query(relations_dict.keys())
-            result = await pg.execute(query)
-            revision_ids = result.fetchall()
-
-            for child_id, child_revision_id in revision_ids:
-                relation_rows.append({
-                    'parent_id': relations_dict[child_id],
-                    'child_revision_id': child_revision_id,
-                })
-
-        return relation_rows
+    def make_relations_table_rows(cls, units, revision_ids: dict[str, int]) -> Generator:
+        for unit in units:
+            if unit.get('parentId') is not None:
+                yield {
+                    'parent_id': unit['parentId'],
+                    'child_revision_id': revision_ids[unit['id']],
+                }
 
     @classmethod
     async def insert_unit_ids(cls, conn, units):
@@ -107,16 +131,25 @@ class ImportsView(BaseView):
             await conn.execute(insert_statement.values(list(chunk)))
 
     @classmethod
-    async def insert_revisions(cls, conn, units, update_date):
+    async def insert_revisions(cls, conn, units, update_date) -> dict[str, int]:
+        """
+        :return: Идентификаторы вставленных ревизий по идентификаторам элементов
+        """
         shop_unit_revisions_rows = cls.make_units_table_rows(units, update_date)
 
         chunked_unit_revisions_rows = chunk_list(shop_unit_revisions_rows,
                                                  cls.MAX_UNIT_REVISIONS_PER_INSERT)
 
+        revision_ids = {}
+
         try:
-            insert_statement = shop_unit_revisions_table.insert()
+            insert_statement = shop_unit_revisions_table.insert().returning(
+                shop_unit_revisions_table.c.shop_unit_id,
+                shop_unit_revisions_table.c.id,
+            )
             for chunk in chunked_unit_revisions_rows:
-                await conn.execute(insert_statement.values(list(chunk)))
+                result = await conn.execute(insert_statement.values(list(chunk)))
+                revision_ids.update(result.fetchall())
         except sqlalchemy.exc.IntegrityError:
             raise HTTPBadRequest()
         except sqlalchemy.exc.DBAPIError as e:
@@ -125,10 +158,18 @@ class ImportsView(BaseView):
 
             raise
 
+        return revision_ids
+
+    @classmethod
+    async def update_current_units(cls, conn, units, update_date):
+        await conn.execute(
+            cls.get_update_current_units_query(cls.get_imported_units(units), update_date)
+        )
+
     @classmethod
-    async def insert_relations(cls, conn, units):
+    async def insert_relations(cls, conn, units, revision_ids: dict[str, int]):
         try:
-            relation_rows = await cls.make_relations_table_rows(units, conn)
+            relation_rows = cls.make_relations_table_rows(units, revision_ids)
             chunked_relation_rows = chunk_list(relation_rows, cls.MAX_RELATIONS_PER_INSERT)
 
             insert_statement = relations_table.insert()
@@ -144,6 +185,131 @@ class ImportsView(BaseView):
 
             raise
 
+    @classmethod
+    def make_imported_units_records(cls, units) -> Generator:
+        for unit in units:
+            yield (
+                unit['id'],
+                unit['name'],
+                unit.get('price'),
+                unit['type'],
+                unit.get('parentId'),
+            )
+
+    @classmethod
+    def get_copy_unit_ids_query(cls):
+        return (
+            insert(shop_unit_ids_table)
+            .from_select(['id'], select([imported_units_table.c.id]))
+            .on_conflict_do_nothing()
+        )
+
+    @classmethod
+    def get_copy_revisions_query(cls, update_date):
+        return shop_unit_revisions_table.insert().from_select(
+            ['date', 'shop_unit_id', 'name', 'price', 'type'],
+            select([
+                literal(update_date, shop_unit_revisions_table.c.date.type),
+                imported_units_table.c.id,
+                imported_units_table.c.name,
+                imported_units_table.c.price,
+                imported_units_table.c.type,
+            ])
+        )
+
+    @classmethod
+    def get_copy_relations_query(cls, update_date):
+        # Ревизии берутся по дате выгрузки, а не из shop_units_current: при загрузке задним
+        # числом там остаётся более новая ревизия
+        return relations_table.insert().from_select(
+            ['child_revision_id', 'parent_id'],
+            select([
+                shop_unit_revisions_table.c.id,
+                imported_units_table.c.parent_id,
+            ])
+            .select_from(
+                imported_units_table
+                .join(shop_unit_revisions_table,
+                      shop_unit_revisions_table.c.shop_unit_id == imported_units_table.c.id)
+            )
+            .where(shop_unit_revisions_table.c.date == update_date)
+            .where(imported_units_table.c.parent_id.isnot(None))
+        )
+
+    @classmethod
+    async def copy_units(cls, conn: AsyncConnection, units):
+        """
+        Загружает элементы во временную таблицу imported_units через COPY,
+        минуя сборку и компиляцию многострочных INSERT.
+        """
+        # Транзакция SQLAlchemy начинается с первого запроса, поэтому таблица создаётся до COPY:
+        # иначе COPY выполнится вне транзакции
+        await conn.execute(CreateTable(imported_units_table))
+
+        raw_connection = await conn.get_raw_connection()
+        await raw_connection.connection.driver_connection.copy_records_to_table(
+            imported_units_table.name,
+            records=cls.make_imported_units_records(units),
+            columns=[c.name for c in imported_units_table.columns],
+        )
+
+        await conn.execute(text(f'ANALYZE {imported_units_table.name}'))
+
+    @classmethod
+    async def insert_copied_units(cls, conn, update_date):
+        """
+        Переносит элементы из imported_units в основные таблицы.
+        Проверки триггеров и ограничений те же, что и при вставке через VALUES.
+        """
+        try:
+            await conn.execute(cls.get_copy_unit_ids_query())
+            await conn.execute(cls.get_copy_revisions_query(update_date))
+            await conn.execute(
+                cls.get_update_current_units_query(imported_units_table, update_date)
+            )
+            await conn.execute(cls.get_copy_relations_query(update_date))
+        except sqlalchemy.exc.IntegrityError:
+            raise HTTPBadRequest()
+        except sqlalchemy.exc.DBAPIError as e:
+            if e.orig.sqlstate in (
+                asyncpg.exceptions.RaiseError.sqlstate,
+                asyncpg.exceptions.ObjectNotInPrerequisiteStateError.sqlstate,
+            ):
+                raise HTTPBadRequest()
+
+            raise
+
+    @classmethod
+    async def import_units(cls, conn: AsyncConnection, units, update_date) -> list[str]:
+        """
+        Загружает элементы и пересчитывает агрегаты затронутых категорий.
+
+        :return: Изменённые элементы и все их прежние и новые предки
+        """
+        unit_ids = [unit['id'] for unit in units]
+
+        previous_parent_ids = await get_parent_ids(conn, unit_ids)
+
+        if len(units) >= cls.MIN_UNITS_TO_COPY:
+            await cls.copy_units(conn, units)
+            await cls.insert_copied_units(conn, update_date)
+        else:
+            await cls.insert_unit_ids(conn, units)
+            revision_ids = await cls.insert_revisions(conn, units, update_date)
+            await cls.update_current_units(conn, units, update_date)
+            await cls.insert_relations(conn, units, revision_ids)
+
+        try:
+            category_ids = await update_category_aggregates(conn,
+                                                            unit_ids + previous_parent_ids)
+        except ParentCycleError:
+            raise HTTPBadRequest()
+
+        changed_ids = unit_ids + category_ids
+        await update_versions(conn, changed_ids)
+
+        return changed_ids
+
     @request_schema(schema=ShopUnitImportRequestSchema)
     async def post(self):
         params = self.request['data']
@@ -155,12 +321,14 @@ class ImportsView(BaseView):
 
         update_date = params['updateDate']
 
+        started_at = time.perf_counter()
         async with self.pg.execution_options(isolation_level='SERIALIZABLE').begin() as conn:
+            changed_ids = await self.import_units(conn, units, update_date)
+            await conn.commit()
 
-            await self.insert_unit_ids(conn, units)
-            await self.insert_revisions(conn, units, update_date)
-            await self.insert_relations(conn, units)
+        self.metrics.observe_import(len(units), time.perf_counter() - started_at)
 
-            await conn.commit()
+        self.nodes_cache.invalidate(changed_ids)
+        await self.pg_replicas.note_write()
 
         return Response(status=HTTPOk.status_code)
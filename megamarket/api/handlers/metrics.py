@@ -0,0 +1,15 @@
+from aiohttp.web_response import Response
+
+from .base import BaseView
+from megamarket.utils.metrics import CONTENT_TYPE
+
+
+class MetricsView(BaseView):
+    """
+    Метрики процесса в текстовом формате Prometheus.
+    """
+    URL_PATH = r'/metrics'
+
+    async def get(self):
+        return Response(body=self.metrics.render().encode(),
+                        headers={'Content-Type': CONTENT_TYPE})
@@ -1,110 +1,103 @@
-import asyncio
-import time
-from collections.abc import AsyncIterable
 from datetime import datetime
 
+from aiohttp.helpers import ETag
 from aiohttp.web import Response
 from aiohttp.web_exceptions import HTTPNotFound
 from aiohttp_apispec import match_info_schema, querystring_schema
 from aiohttp_apispec.decorators import response_schema
-from aiomisc import chunk_list
-from sqlalchemy.ext.asyncio import AsyncEngine, AsyncConnection
+from sqlalchemy import select, func, true
 
 from megamarket.api.schema import ShopUnitSchema, ShopUnitStatisticsRequestParamsSchema, \
     IdMatchInfoRequestSchema
-from .base import BaseView
-from ...db.schema import ShopUnitType, shop_unit_revisions_table
-from ...utils.pg import max_query_len_with
-from ...utils.streamers import ShopUnitStreamer, ShopCategoryStreamer, \
-    shop_unit_streamer_from_record, do_stream
-
-
-class GetNodeStatistic(AsyncIterable):
+from .base import BaseView, SnapshotQuery
+from ...db.schema import shop_unit_ids_table, shop_unit_revisions_table
+from ...utils.deadline import Deadline, NO_DEADLINE
+from ...utils.pg import DEFAULT_PG_PREFETCH, PgReader, stream_partitions, fetch
+from ...utils.statistic import get_subtree_history_query, get_update_dates_query, \
+    get_ever_children_cte, render_statistic
+
+
+class GetNodeStatistic(SnapshotQuery):
+    """
+    История поддерева элемента. Заголовочная запись — версия элемента и последняя
+    ревизия каталога, из них складывается тег ответа.
+    """
     def __init__(self, unit_id: str,
-                 pg: AsyncEngine,
-                 timeout: int = None,
+                 pg: PgReader,
+                 deadline: Deadline = NO_DEADLINE,
                  from_date: datetime | None = None,
-                 to_date: datetime | None = datetime.now()):
+                 to_date: datetime | None = datetime.now(),
+                 prefetch: int = DEFAULT_PG_PREFETCH):
+        super().__init__(pg, deadline)
         self._unit_id = unit_id
-        self._pg = pg
-        self._timeout = timeout
         self._from_date = from_date
         self._to_date = to_date
+        self._prefetch = prefetch
 
     @classmethod
-    def get_revisions_query(cls, unit_ids, from_date: datetime | None, to_date: datetime | None):
-        query = shop_unit_revisions_table.select().where(
-            shop_unit_revisions_table.c.shop_unit_id.in_(unit_ids)
-        )
-        if from_date:
-            query = query.where(shop_unit_revisions_table.c.date >= from_date)
-        if to_date:
-            query = query.where(shop_unit_revisions_table.c.date <= to_date)
-
-        return query
-
-    @classmethod
-    async def get_update_dates(cls, unit_id, from_date, to_date, conn: AsyncConnection):
-        stack = [unit_id]
-        relevant_ids = {unit_id}
-        update_dates = set()
-
-        while stack:
-            unit_id = stack.pop()
-            children = await ShopCategoryStreamer.get_children_ids(
-                unit_id, conn, from_date, to_date
+    def get_version_query(cls, unit_id):
+        """
+        Возвращает версию элемента, последнюю ревизию и число ревизий в его истории.
+        Версия покрывает текущее поддерево, а ревизии — элементы, которые лежали в нём
+        раньше: их обновление добавляет ревизию, а удаление уменьшает число ревизий.
+        """
+        ever_children = get_ever_children_cte(unit_id)
+
+        revisions = (
+            select([
+                func.max(shop_unit_revisions_table.c.id).label('last_revision_id'),
+                func.count(shop_unit_revisions_table.c.id).label('revisions_count'),
+            ])
+            .select_from(
+                ever_children
+                .join(shop_unit_revisions_table,
+                      shop_unit_revisions_table.c.shop_unit_id == ever_children.c.id)
             )
+            .subquery('revisions')
+        )
 
-            for child in children:
-                if child['type'] == ShopUnitType.CATEGORY:
-                    stack.append(child['child_id'])
-
-                relevant_ids.add(child['child_id'])
-
-        maximum_ids_per_query = max_query_len_with(1) - 2
-
-        chunked_ids = chunk_list(relevant_ids, maximum_ids_per_query)
-
-        for chunk in chunked_ids:
-            query = cls.get_revisions_query(list(chunk), from_date, to_date)
-            for row in await conn.execute(query):
-                update_dates.add(row['date'])
-
-        return sorted(list(update_dates))
-
-    async def __aiter__(self):
-        yield '{"items": ['
-        async with self._pg.begin() as conn:
-            update_dates = await self.get_update_dates(
-                self._unit_id, self._from_date, self._to_date, conn)
+        return (
+            select([
+                shop_unit_ids_table.c.version,
+                revisions.c.last_revision_id,
+                revisions.c.revisions_count,
+            ])
+            .select_from(shop_unit_ids_table.join(revisions, true()))
+            .where(shop_unit_ids_table.c.id == unit_id)
+        )
 
-            first = True
-            for date in update_dates:
-                if not first:
-                    yield ', '
-                else:
-                    first = False
+    def get_head_query(self):
+        return self.get_version_query(self._unit_id)
 
-                unit = await ShopUnitStreamer.get_unit_record_by_id(self._unit_id, conn, None, date)
+    async def stream(self, conn, head):
+        yield b'{"items": ['
 
-                if not unit:
-                    continue
+        rows = await fetch(
+            conn, get_update_dates_query(self._unit_id, self._from_date, self._to_date),
+            self._deadline
+        )
+        update_dates = {row['date'] for row in rows}
 
-                unit_streamer = shop_unit_streamer_from_record(unit, conn, None, date,
-                                                               stream_children=False)
+        partitions = stream_partitions(
+            conn, get_subtree_history_query(self._unit_id, self._to_date), self._prefetch,
+            self._deadline
+        )
 
-                exec_time = time.time()
-                async for chunk in do_stream(unit_streamer):
-                    if self._timeout and time.time() - exec_time > self._timeout:
-                        raise asyncio.TimeoutError
+        first = True
+        async for chunk in render_statistic(self._unit_id, update_dates, partitions):
+            if not first:
+                yield b', '
+            else:
+                first = False
 
-                    yield chunk
+            yield chunk
 
-        yield ']}'
+        yield b']}'
 
 
 class NodeView(BaseView):
     URL_PATH = r'/node/{id:[\da-zA-Z\-]+}/statistic'
+    TIMEOUT = 'node_statistic'
 
     @match_info_schema(IdMatchInfoRequestSchema)
     @querystring_schema(ShopUnitStatisticsRequestParamsSchema)
@@ -115,10 +108,24 @@ class NodeView(BaseView):
         date_start = querystring['dateStart'] if 'dateStart' in querystring else None
         date_end = querystring['dateEnd'] if 'dateEnd' in querystring else None
 
-        async with self.pg.begin() as conn:
-            if not await ShopUnitStreamer.get_unit_record_by_id(unit_id, conn, None, None):
-                raise HTTPNotFound()
+        query = GetNodeStatistic(unit_id, self.pg_reader, self.make_deadline(),
+                                 date_start, date_end, prefetch=self.pg_prefetch)
+
+        # Версия читается в транзакции, из которой потом отдаётся история
+        head = await query.open()
+        if head is None:
+            raise HTTPNotFound()
 
-        return Response(
-            body=GetNodeStatistic(unit_id, self.pg, 10, date_start, date_end)
+        etag = ETag(
+            value=f"{head['version']}-{head['last_revision_id']}-{head['revisions_count']}",
+            is_weak=True
         )
+
+        not_modified = self.not_modified(etag)
+        if not_modified is not None:
+            await query.close()
+            return not_modified
+
+        response = Response(body=query)
+        response.etag = etag
+        return response
@@ -1,61 +1,162 @@
-import asyncio
-import time
 from collections.abc import AsyncIterable
 from datetime import datetime
 
+from aiohttp.helpers import ETag
 from aiohttp.web import Response
 from aiohttp.web_exceptions import HTTPNotFound
-from aiohttp_apispec import match_info_schema
-from aiohttp_apispec.decorators import response_schema
-from sqlalchemy.ext.asyncio import AsyncEngine
+from aiohttp_apispec import match_info_schema, querystring_schema
+from aiohttp_apispec.decorators import request_schema, response_schema
+from sqlalchemy import select
 
-from .base import BaseView
-from megamarket.api.schema import ShopUnitSchema, IdMatchInfoRequestSchema
-from ...utils.streamers import ShopUnitStreamer, shop_unit_streamer_from_record, do_stream
+from .base import BaseView, SnapshotQuery
+from megamarket.api.schema import ShopUnitSchema, IdMatchInfoRequestSchema, \
+    NodesBatchRequestSchema, NodesRequestParamsSchema
+from megamarket.db.schema import shop_unit_ids_table
+from ...utils.deadline import Deadline, NO_DEADLINE
+from ...utils.pg import DEFAULT_PG_PREFETCH, PgReader, read_transaction
+from ...utils.streamers import ShopUnitStreamer, ShopUnitSubtreeStreamer, \
+    ShopUnitBatchStreamer, ShopUnitPageStreamer
 
 
-class GetShopUnitQuery(AsyncIterable):
+class GetShopUnitQuery(SnapshotQuery):
+    """
+    Поддерево элемента. Заголовочная запись — версия элемента: она есть, только пока
+    элемент существует, и меняется при любом изменении его поддерева.
+    """
     def __init__(self, parent_unit_id: str,
-                 pg: AsyncEngine,
-                 timeout: int = None,
+                 pg: PgReader,
+                 deadline: Deadline = NO_DEADLINE,
                  from_date: datetime | None = None,
-                 to_date: datetime | None = datetime.now()):
+                 to_date: datetime | None = None,
+                 prefetch: int = DEFAULT_PG_PREFETCH,
+                 depth: int | None = None,
+                 children_limit: int | None = None,
+                 cursor: str | None = None):
+        super().__init__(pg, deadline)
         self._parent_unit_id = parent_unit_id
-        self._pg = pg
-        self._timeout = timeout
         self._from_date = from_date
         self._to_date = to_date
+        self._prefetch = prefetch
+        self._depth = depth
+        self._children_limit = children_limit
+        self._cursor = cursor
 
-    async def __aiter__(self):
-        async with self._pg.begin() as conn:
-            unit = await ShopUnitStreamer.get_unit_record_by_id(self._parent_unit_id, conn,
-                                                                self._from_date, self._to_date)
+    @property
+    def paged(self) -> bool:
+        return any(param is not None
+                   for param in (self._depth, self._children_limit, self._cursor))
 
-            if not unit:
-                raise HTTPNotFound()
+    @classmethod
+    def get_version_query(cls, unit_id):
+        return (
+            select([shop_unit_ids_table.c.version])
+            .where(shop_unit_ids_table.c.id == unit_id)
+        )
 
-            unit = shop_unit_streamer_from_record(unit, conn,
-                                                  self._from_date, self._to_date,
-                                                  stream_children=True)
+    def get_head_query(self):
+        # Версия описывает только текущее состояние, на другой момент
+        # существование проверяется по ревизиям
+        if self._from_date is None and self._to_date is None:
+            return self.get_version_query(self._parent_unit_id)
 
-            exec_time = time.time()
-            async for chunk in do_stream(unit):
-                if self._timeout and time.time() - exec_time > self._timeout:
-                    raise asyncio.TimeoutError()
+        return ShopUnitStreamer.get_unit_record_by_id_query(
+            self._parent_unit_id, self._from_date, self._to_date
+        )
 
-                yield chunk
+    def stream(self, conn, head):
+        if self.paged:
+            return ShopUnitPageStreamer(self._parent_unit_id, conn,
+                                        self._depth, self._children_limit, self._cursor,
+                                        prefetch=self._prefetch,
+                                        deadline=self._deadline)
+
+        return ShopUnitSubtreeStreamer(self._parent_unit_id, conn,
+                                       self._from_date, self._to_date,
+                                       stream_children=True,
+                                       prefetch=self._prefetch,
+                                       deadline=self._deadline)
 
 
 class NodesView(BaseView):
     URL_PATH = r'/nodes/{id:[\da-zA-Z\-]+}'
+    TIMEOUT = 'nodes'
 
     @match_info_schema(IdMatchInfoRequestSchema)
+    @querystring_schema(NodesRequestParamsSchema)
     @response_schema(schema=ShopUnitSchema)
     async def get(self):
         unit_id = self.request['match_info']['id']
+        querystring = self.request['querystring']
+
+        query = GetShopUnitQuery(unit_id, self.pg_reader, self.make_deadline(),
+                                 prefetch=self.pg_prefetch,
+                                 depth=querystring.get('depth'),
+                                 children_limit=querystring.get('childrenLimit'),
+                                 cursor=querystring.get('cursor'))
+
+        # Версия читается в транзакции, из которой потом отдаётся тело,
+        # поэтому 404 и тег решаются до заголовков и совпадают с отданным поддеревом
+        head = await query.open()
+        if head is None:
+            raise HTTPNotFound()
+
+        version = head['version']
+
+        # Версия меняется при любом изменении поддерева, её достаточно для тега
+        etag = ETag(value=str(version), is_weak=True)
+
+        not_modified = self.not_modified(etag)
+        if not_modified is not None:
+            await query.close()
+            return not_modified
+
+        if query.paged:
+            # В кэше лежат только полные поддеревья
+            response = Response(body=query)
+        else:
+            body = self.nodes_cache.get(unit_id, version)
+            if body is not None:
+                await query.close()
+                response = Response(body=body, content_type='application/json')
+            else:
+                response = Response(body=self.nodes_cache.collect(unit_id, version, query))
+
+        response.etag = etag
+        return response
+
+
+class GetShopUnitsBatchQuery(AsyncIterable):
+    def __init__(self, unit_ids: list[str],
+                 pg: PgReader,
+                 deadline: Deadline = NO_DEADLINE,
+                 prefetch: int = DEFAULT_PG_PREFETCH):
+        self._unit_ids = unit_ids
+        self._pg = pg
+        self._deadline = deadline
+        self._prefetch = prefetch
+
+    async def __aiter__(self):
+        async with read_transaction(self._pg, self._deadline) as conn:
+            streamer = ShopUnitBatchStreamer(self._unit_ids, conn,
+                                             prefetch=self._prefetch,
+                                             deadline=self._deadline)
+
+            async for chunk in streamer:
+                yield chunk
+
+
+class NodesBatchView(BaseView):
+    """
+    Несколько поддеревьев за один запрос: объект, где по каждому id лежит то же,
+    что отдаёт /nodes/{id}, или null, если элемента нет.
+    """
+    URL_PATH = r'/nodes:batch'
+    TIMEOUT = 'nodes'
 
-        async with self.pg.begin() as conn:
-            if not await ShopUnitStreamer.get_unit_record_by_id(unit_id, conn, None, None):
-                raise HTTPNotFound()
+    @request_schema(schema=NodesBatchRequestSchema)
+    async def post(self):
+        unit_ids = self.request['data']['ids']
 
-        return Response(body=GetShopUnitQuery(unit_id, self.pg))
+        return Response(body=GetShopUnitsBatchQuery(unit_ids, self.pg_reader,
+                                                    self.make_deadline(),
+                                                    prefetch=self.pg_prefetch))
@@ -1,82 +1,127 @@
-import asyncio
-import time
 from collections.abc import AsyncIterable
 from datetime import datetime, timedelta
 
 from aiohttp.web import Response
 from aiohttp_apispec import querystring_schema
 from aiohttp_apispec.decorators import response_schema
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import AsyncEngine
-from sqlalchemy.sql import func
+from asyncpg import Record
+from sqlalchemy import select, union_all
 
+from megamarket.api.payloads import dumpb
 from megamarket.api.schema import ShopUnitStatisticResponseSchema, SalesRequestParamsSchema
 from .base import BaseView
-from ...db.schema import shop_unit_revisions_table, ShopUnitType
-from ...utils.streamers import shop_unit_streamer_from_record, do_stream
+from ...db.schema import shop_unit_revisions_table, shop_units_current_table, relations_table, \
+    ShopUnitType
+from ...utils.deadline import Deadline, NO_DEADLINE
+from ...utils.pg import DEFAULT_PG_PREFETCH, PgReader, stream_partitions, read_transaction
 
 
 class GetSalesQuery(AsyncIterable):
     @classmethod
     def get_revisions(cls, date_from: datetime | None, date_to: datetime | None):
-        query = (
+        """
+        Возвращает последние в заданном промежутке ревизии товаров вместе с родителем.
+        Для большинства товаров последняя ревизия и есть текущее состояние, так что
+        полный проход по истории нужен только товарам, обновлённым уже после date_to.
+        """
+        current_units = (
+            select([
+                shop_units_current_table.c.id.label('shop_unit_id'),
+                shop_units_current_table.c.name,
+                shop_units_current_table.c.price,
+                shop_units_current_table.c.type,
+                shop_units_current_table.c.date,
+                shop_units_current_table.c.parent_id,
+            ])
+            .where(shop_units_current_table.c.type == ShopUnitType.OFFER)
+        )
+
+        if date_from is not None:
+            current_units = current_units.where(shop_units_current_table.c.date >= date_from)
+        if date_to is None:
+            return current_units
+
+        current_units = current_units.where(shop_units_current_table.c.date <= date_to)
+
+        updated_later_units = (
             select([
                 shop_unit_revisions_table.c.shop_unit_id,
-                func.max_(shop_unit_revisions_table.c.date).label('max_date'),
-                shop_unit_revisions_table.c.type
+                shop_unit_revisions_table.c.name,
+                shop_unit_revisions_table.c.price,
+                shop_unit_revisions_table.c.type,
+                shop_unit_revisions_table.c.date,
+                relations_table.c.parent_id,
             ])
-            .group_by(shop_unit_revisions_table.c.shop_unit_id,
-                      shop_unit_revisions_table.c.type)
+            .distinct(shop_unit_revisions_table.c.shop_unit_id)
+            .select_from(
+                shop_units_current_table
+                .join(shop_unit_revisions_table,
+                      shop_unit_revisions_table.c.shop_unit_id == shop_units_current_table.c.id)
+                .join(relations_table,
+                      relations_table.c.child_revision_id == shop_unit_revisions_table.c.id,
+                      isouter=True)
+            )
+            .where(shop_units_current_table.c.date > date_to)
+            .where(shop_unit_revisions_table.c.type == ShopUnitType.OFFER)
+            .where(shop_unit_revisions_table.c.date <= date_to)
+            .order_by(shop_unit_revisions_table.c.shop_unit_id,
+                      shop_unit_revisions_table.c.date.desc())
         )
 
         if date_from is not None:
-            query = query.where(shop_unit_revisions_table.c.date >= date_from)
-        if date_to is not None:
-            query = query.where(shop_unit_revisions_table.c.date <= date_to)
+            updated_later_units = updated_later_units.where(
+                shop_unit_revisions_table.c.date >= date_from)
 
-        return query
+        updated_later_units = updated_later_units.subquery('updated_later_units')
+
+        return union_all(current_units, select([updated_later_units]))
+
+    @classmethod
+    def dump_unit(cls, record: Record) -> bytes:
+        return dumpb({
+            'id': record['shop_unit_id'],
+            'name': record['name'],
+            'date': record['date'],
+            'type': record['type'],
+            'price': record['price'],
+            'parentId': record['parent_id'],
+        })
 
     def __init__(self,
-                 pg: AsyncEngine,
-                 timeout: int = None,
+                 pg: PgReader,
+                 deadline: Deadline = NO_DEADLINE,
                  from_date: datetime | None = None,
-                 to_date: datetime | None = datetime.now()):
+                 to_date: datetime | None = datetime.now(),
+                 prefetch: int = DEFAULT_PG_PREFETCH):
         self.pg = pg
-        self.timeout = timeout
+        self.deadline = deadline
         self._from_date = from_date
         self._to_date = to_date
+        self._prefetch = prefetch
 
     async def __aiter__(self):
-        yield '{"items": ['
+        yield b'{"items": ['
 
-        async with self.pg.begin() as conn:
-            get_revisions_query = self.get_revisions(self._from_date, self._to_date)\
-                .where(shop_unit_revisions_table.c.type == ShopUnitType.OFFER)
-            result = await conn.execute(get_revisions_query)
+        async with read_transaction(self.pg, self.deadline) as conn:
+            get_revisions_query = self.get_revisions(self._from_date, self._to_date)
 
-            exec_time = time.time()
             first = True
-            for revision in result.fetchall():
+            async for records in stream_partitions(conn, get_revisions_query, self._prefetch,
+                                                   self.deadline):
+                chunk = b', '.join(self.dump_unit(record) for record in records)
+
                 if not first:
-                    yield ', '
+                    yield b', ' + chunk
                 else:
                     first = False
-
-                unit = shop_unit_streamer_from_record(revision, conn,
-                                                      self._from_date, self._to_date,
-                                                      stream_children=False)
-
-                async for chunk in do_stream(unit):
-                    if self.timeout and time.time() - exec_time > self.timeout:
-                        raise asyncio.TimeoutError()
-
                     yield chunk
 
-        yield ']}'
+        yield b']}'
 
 
 class SalesView(BaseView):
     URL_PATH = r'/sales'
+    TIMEOUT = 'sales'
 
     @querystring_schema(SalesRequestParamsSchema)
     @response_schema(schema=ShopUnitStatisticResponseSchema)
@@ -86,6 +131,7 @@ class SalesView(BaseView):
 
         return Response(
             body=GetSalesQuery(
-                self.pg, timeout=10, from_date=from_date, to_date=to_date
+                self.pg_reader, self.make_deadline(), from_date=from_date, to_date=to_date,
+                prefetch=self.pg_prefetch
             )
         )
@@ -0,0 +1,122 @@
+"""
+Метрики API. Задержки и объём отдачи учитываются по завершении задачи запроса, то есть
+уже после потоковой отдачи тела, а состояние пулов и кэша читается в момент запроса /metrics.
+"""
+
+import time
+
+from aiohttp.web import Application
+
+from megamarket.utils.metrics import Registry, Counter, Gauge, Histogram, DEFAULT_SIZE_BUCKETS
+
+UNMATCHED_ROUTE = 'unmatched'
+
+
+class ApiMetrics:
+    def __init__(self, app: Application, worker: int | None = None):
+        self._app = app
+        # Воркеры отдают метрики по отдельности, метка различает их после сбора
+        self.registry = Registry({'worker': str(worker)} if worker is not None else None)
+
+        self.request_duration = self.registry.register(Histogram(
+            'megamarket_request_duration_seconds',
+            'Time from the start of handling to the end of the response body',
+            labels=('method', 'route', 'status'),
+        ))
+        self.requests_in_flight = self.registry.register(Gauge(
+            'megamarket_requests_in_flight',
+            'Requests being handled or streamed',
+        ))
+        self.stream_bytes = self.registry.register(Histogram(
+            'megamarket_response_stream_bytes',
+            'Bytes of a streamed response body',
+            labels=('route',), buckets=DEFAULT_SIZE_BUCKETS,
+        ))
+
+        self.import_batch_units = self.registry.register(Histogram(
+            'megamarket_import_batch_units',
+            'Units in a single import',
+            buckets=DEFAULT_SIZE_BUCKETS,
+        ))
+        self.import_units = self.registry.register(Counter(
+            'megamarket_import_units_total',
+            'Units written by imports, rate() gives rows inserted per second',
+        ))
+        self.import_duration = self.registry.register(Histogram(
+            'megamarket_import_duration_seconds',
+            'Time spent writing an import to the database',
+        ))
+        self.import_rows_per_second = self.registry.register(Gauge(
+            'megamarket_import_rows_per_second',
+            'Units written per second by the last import',
+        ))
+
+        self.registry.register(Gauge(
+            'megamarket_db_pool_checked_out',
+            'Connections taken from the pool',
+            labels=('database', 'driver'), collect=self._collect_checked_out,
+        ))
+        self.registry.register(Gauge(
+            'megamarket_db_pool_overflow',
+            'Connections opened above the pool size',
+            labels=('database',), collect=self._collect_overflow,
+        ))
+
+        self.registry.register(Counter(
+            'megamarket_nodes_cache_hits_total', 'Responses served from the /nodes cache',
+            collect=lambda: [((), self._app['nodes_cache'].hits)],
+        ))
+        self.registry.register(Counter(
+            'megamarket_nodes_cache_misses_total', 'Lookups missing the /nodes cache',
+            collect=lambda: [((), self._app['nodes_cache'].misses)],
+        ))
+        self.registry.register(Counter(
+            'megamarket_nodes_cache_evictions_total', 'Responses evicted from the /nodes cache',
+            collect=lambda: [((), self._app['nodes_cache'].evictions)],
+        ))
+        self.registry.register(Gauge(
+            'megamarket_nodes_cache_bytes', 'Bytes of responses in the /nodes cache',
+            collect=lambda: [((), self._app['nodes_cache'].size)],
+        ))
+
+    def _databases(self):
+        """
+        Отдаёт (название базы, движок, пул asyncpg или None) для основной базы и реплик.
+        """
+        if 'pg' not in self._app:
+            return
+
+        yield 'primary', self._app['pg'], self._app['pg_pool']
+
+        for replica in self._app['pg_replicas'].replicas:
+            yield str(replica.url), replica.engine, replica.pool
+
+    def _collect_checked_out(self):
+        for database, engine, pool in self._databases():
+            yield (database, 'sqlalchemy'), engine.sync_engine.pool.checkedout()
+
+            if pool is not None:
+                yield (database, 'asyncpg'), pool.get_size() - pool.get_idle_size()
+
+    def _collect_overflow(self):
+        for database, engine, _ in self._databases():
+            # QueuePool считает переполнение от -pool_size, пока пул не заполнен
+            yield (database,), max(engine.sync_engine.pool.overflow(), 0)
+
+    def observe_import(self, units: int, duration: float):
+        self.import_batch_units.observe(units)
+        self.import_units.inc(amount=units)
+        self.import_duration.observe(duration)
+
+        if duration > 0:
+            self.import_rows_per_second.set(units / duration)
+
+    def observe_request(self, method: str, route: str, status: int,
+                        started_at: float, bytes_streamed: int):
+        self.request_duration.observe(time.perf_counter() - started_at, method, route, str(status))
+
+        if bytes_streamed:
+            self.stream_bytes.observe(bytes_streamed, route)
+
+    def render(self) -> str:
+        return self.registry.render()
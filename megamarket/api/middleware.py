@@ -1,16 +1,22 @@
+import asyncio
 import logging
 from typing import Mapping
 from http import HTTPStatus
 
 from aiohttp.web_exceptions import (
     HTTPException, HTTPBadRequest, HTTPInternalServerError, HTTPMethodNotAllowed,
-    HTTPRedirection
+    HTTPRedirection, HTTPGatewayTimeout
 )
+from aiohttp.web_log import AccessLogger
 from aiohttp.web_middlewares import middleware
-from aiohttp.web_request import Request
+from aiohttp.web_request import BaseRequest, Request
+from aiohttp.web_response import StreamResponse
 from aiohttp.payload import JsonPayload
 from marshmallow import ValidationError
 
+from megamarket.api.metrics import ApiMetrics, UNMATCHED_ROUTE
+from megamarket.utils.instrumentation import RequestStats, request_stats
+
 
 log = logging.getLogger(__name__)
 
@@ -29,6 +35,13 @@ def format_http_error(http_error_cls, message: str | None = None,
     return http_error_cls(body=error)
 
 
+def format_server_timing(stats: RequestStats) -> str:
+    return (
+        f'handler;dur={stats.handler_time * 1000:.1f}, '
+        f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"'
+    )
+
+
 def handle_validation_error(error: ValidationError, *_):
     raise format_http_error(HTTPBadRequest, 'Request validation has failed',
                             error.messages)
@@ -53,6 +66,86 @@ async def error_middleware(request: Request, handler):
     except ValidationError as exc:
         raise handle_validation_error(exc)
 
+    except asyncio.TimeoutError:
+        log.warning('Request deadline exceeded: %s %s', request.method, request.path)
+        raise format_http_error(HTTPGatewayTimeout)
+
     except Exception:
         log.exception('Unhandled Exception')
         raise format_http_error(HTTPInternalServerError)
+
+
+@middleware
+async def instrumentation_middleware(request: Request, handler):
+    """
+    Собирает статистику обработки запроса и отдаёт её в заголовке Server-Timing.
+    Заголовок уходит до тела, поэтому в нём только то, что успело произойти до начала
+    отдачи. Полная статистика, вместе с запросами потоковой отдачи, пишется в лог доступа.
+
+    Метрики запроса учитываются, когда завершается его задача: aiohttp дописывает тело
+    в той же задаче уже после выхода из middleware.
+    """
+    stats = RequestStats()
+    request['stats'] = stats
+    request_stats.set(stats)
+
+    metrics: ApiMetrics = request.app['metrics']
+    metrics.requests_in_flight.inc()
+
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else UNMATCHED_ROUTE
+
+    response = None
+
+    def finish(_):
+        metrics.requests_in_flight.dec()
+        metrics.observe_request(request.method, route,
+                                response.status if response is not None else 500,
+                                stats.started_at, stats.bytes_streamed)
+
+    asyncio.current_task().add_done_callback(finish)
+
+    try:
+        response = await handler(request)
+        return response
+
+    except HTTPException as exc:
+        response = exc
+        raise
+
+    finally:
+        stats.finish_handler()
+
+        if response is not None and not response.prepared:
+            response.headers['Server-Timing'] = format_server_timing(stats)
+
+
+class StatsAccessLogger(AccessLogger):
+    """
+    Дописывает к строке лога доступа статистику запроса, а в extra кладёт её целиком,
+    чтобы структурный формат логов получил её отдельными полями.
+    """
+    def log(self, request: BaseRequest, response: StreamResponse, time: float):
+        stats: RequestStats | None = request.get('stats')
+        if stats is None:
+            super().log(request, response, time)
+            return
+
+        try:
+            values = [value for _, value in self._format_line(request, response, time)]
+            self.logger.info(
+                '%s queries=%d db=%.3fs ttfb=%s streamed=%d handler=%.3fs',
+                self._log_format % tuple(values),
+                stats.queries, stats.db_time,
+                f'{stats.ttfb:.3f}s' if stats.ttfb is not None else '-',
+                stats.bytes_streamed, stats.handler_time,
+                extra={
+                    'method': request.method,
+                    'path': request.path,
+                    'status': response.status,
+                    'request_time': time,
+                    **stats.as_dict(),
+                }
+            )
+        except Exception:
+            self.logger.exception('Error in logging')
@@ -1,18 +1,28 @@
+import asyncio
 import datetime
 import json
+import logging
 import typing
 from functools import singledispatch, partial
 
+import orjson
 from aiohttp.payload import JsonPayload as BaseJsonPayload, Payload
 from aiohttp.typedefs import JSONEncoder
 from asyncpg import Record
 
 from megamarket.api.schema import DATETIME_FORMAT, ShopUnitType
+from megamarket.utils.deadline import DeadlineExceeded
+from megamarket.utils.instrumentation import request_stats
 
 __all__ = (
     'JsonPayload'
 )
 
+DEFAULT_FLUSH_SIZE = 64 * 1024
+DEFAULT_FLUSH_INTERVAL = 0.1
+
+log = logging.getLogger(__name__)
+
 
 @singledispatch
 def convert(value):
@@ -39,7 +49,61 @@ def convert_shop_unit_type(value: ShopUnitType):
     return value.value
 
 
-dumps = partial(json.dumps, default=convert, ensure_ascii=False)
+class JsonSerializer:
+    """
+    Сериализатор на стандартном json. Нестандартные типы приводятся через convert.
+    """
+    name = 'json'
+
+    def dumps(self, value) -> str:
+        return json.dumps(value, default=convert, ensure_ascii=False)
+
+    def dumpb(self, value) -> bytes:
+        return self.dumps(value).encode()
+
+
+class OrjsonSerializer:
+    """
+    Сериализатор на orjson: сразу кодирует в UTF-8 и сам обрабатывает перечисления.
+    Даты передаются в convert, чтобы сохранить DATETIME_FORMAT.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        self._dumps = partial(orjson.dumps, default=convert,
+                              # Ключи-числа бывают в ошибках валидации вложенных списков
+                              option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+
+    def dumps(self, value) -> str:
+        return self._dumps(value).decode()
+
+    def dumpb(self, value) -> bytes:
+        return self._dumps(value)
+
+
+SERIALIZERS = {
+    serializer.name: serializer
+    for serializer in (JsonSerializer, OrjsonSerializer)
+}
+DEFAULT_SERIALIZER = OrjsonSerializer.name
+
+serializer = SERIALIZERS[DEFAULT_SERIALIZER]()
+
+
+def use_serializer(name: str):
+    """
+    Выбирает сериализатор, которым пользуются dumps и dumpb.
+    """
+    global serializer
+    serializer = SERIALIZERS[name]()
+
+
+def dumps(value) -> str:
+    return serializer.dumps(value)
+
+
+def dumpb(value) -> bytes:
+    return serializer.dumpb(value)
 
 
 class JsonPayload(BaseJsonPayload):
@@ -56,20 +120,135 @@ class JsonPayload(BaseJsonPayload):
         )
 
 
+class BufferedWriter:
+    """
+    Копит фрагменты в буфере и отдаёт их писателю, когда буфер дорастает до flush_size
+    или когда с момента появления в нём первого фрагмента проходит flush_interval секунд.
+
+    Запись по таймеру идёт в отдельной задаче. Её ошибка, например от отключившегося
+    клиента, поднимается из следующего write или из close.
+    """
+    def __init__(self, writer, flush_size: int, flush_interval: float):
+        self._writer = writer
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+
+        self._lock = asyncio.Lock()
+        self._buffer = bytearray()
+        self._timer: asyncio.TimerHandle | None = None
+        self._timed_flushes: set[asyncio.Task] = set()
+        self._error: BaseException | None = None
+
+    async def write(self, data: bytes | memoryview):
+        self._raise_error()
+
+        if not data:
+            return
+
+        if not self._buffer and self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self._flush_interval, self._flush_by_timer)
+
+        self._buffer.extend(data)
+
+        if len(self._buffer) >= self._flush_size:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            self._cancel_timer()
+
+            if self._buffer:
+                # Писатель может держать ссылку на переданный объект, поэтому буфер копируется
+                data = bytes(self._buffer)
+                self._buffer.clear()
+
+                stats = request_stats.get()
+                if stats is not None:
+                    stats.add_chunk(len(data))
+
+                await self._writer.write(data)
+
+    async def close(self):
+        """
+        Останавливает таймер и дожидается начатых по нему записей.
+        Недописанный буфер не отправляется, для этого нужен flush.
+        """
+        self._cancel_timer()
+
+        if self._timed_flushes:
+            await asyncio.gather(*self._timed_flushes, return_exceptions=True)
+
+        self._raise_error()
+
+    def _flush_by_timer(self):
+        self._timer = None
+
+        task = asyncio.ensure_future(self.flush())
+        task.add_done_callback(self._on_timed_flush_done)
+        self._timed_flushes.add(task)
+
+    def _on_timed_flush_done(self, task: asyncio.Task):
+        self._timed_flushes.discard(task)
+
+        if not task.cancelled() and task.exception() is not None and self._error is None:
+            self._error = task.exception()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+class StreamAborted(ConnectionAbortedError):
+    """
+    Отдача прервана, когда заголовки уже ушли клиенту.
+    aiohttp считает это обрывом соединения: закрывает его, не завершая тело,
+    так что клиент получает заведомо неполный ответ, а не обрезанный JSON со статусом 200.
+    """
+
+
 class AsyncStreamJsonPayload(Payload):
+    """
+    Отдаёт JSON, который собирается из фрагментов асинхронного итератора.
+    Фрагменты пишутся через BufferedWriter, который объединяет их в крупные куски.
+    Фрагменты могут быть строками или уже закодированными байтами, например из dumpb.
+    """
     def __init__(self, value, encoding='utf-8',
                  content_type='application/json',
                  root_object: str = None,
+                 flush_size: int = DEFAULT_FLUSH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL,
                  *args, **kwargs):
         super().__init__(value, content_type=content_type, encoding=encoding, *args, **kwargs)
         self.root_object = root_object
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
 
     async def write(self, writer):
-        if self.root_object is not None:
-            await writer.write(('{%s: ' % self.root_object).encode(self.encoding))
+        buffered = BufferedWriter(writer, self.flush_size, self.flush_interval)
+
+        try:
+            if self.root_object is not None:
+                await buffered.write(('{%s: ' % self.root_object).encode(self.encoding))
+
+            async for row in self._value:
+                if isinstance(row, str):
+                    row = row.encode(self.encoding)
+
+                await buffered.write(row)
 
-        async for row in self._value:
-            await writer.write(row.encode(self.encoding))
+            if self.root_object is not None:
+                await buffered.write(b'}')
 
-        if self.root_object is not None:
-            await writer.write(b'}')
+            await buffered.flush()
+        except DeadlineExceeded as e:
+            log.warning('Streamed response aborted: deadline exceeded')
+            raise StreamAborted() from e
+        finally:
+            await buffered.close()
@@ -1,13 +1,15 @@
 from datetime import datetime
 
 from marshmallow import validates_schema, ValidationError
-from marshmallow.fields import String, Integer, DateTime, Nested, List, Dict
+from marshmallow.fields import String, Integer, DateTime, Nested, List, Dict, Boolean
 from marshmallow.schema import Schema
 from marshmallow.validate import OneOf, Range, Length
 
 from megamarket.db.schema import ShopUnitType
 
 DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.000Z"
+MAX_NODES_BATCH_SIZE = 1000
+MAX_CHILDREN_LIMIT = 10000
 
 
 class ShopUnitSchema(Schema):
@@ -19,6 +21,9 @@ class ShopUnitSchema(Schema):
     parentId = String(required=False, allow_none=True, validate=Length(min=1))
     price = Integer(required=False, allow_none=True, validate=Range(min=0))
     children = List(Nested(lambda: ShopUnitSchema()), required=False, allow_none=True)
+    # Только в ответах с depth, childrenLimit или cursor
+    hasChildren = Boolean(required=False)
+    nextCursor = String(required=False, allow_none=True)
 
     @validates_schema
     def validate_parent_is_not_self(self, data, **_):
@@ -81,6 +86,17 @@ class IdMatchInfoRequestSchema(Schema):
     id = String(required=True, validate=Length(min=1))
 
 
+class NodesRequestParamsSchema(Schema):
+    depth = Integer(required=False, validate=Range(min=0))
+    childrenLimit = Integer(required=False, validate=Range(min=1, max=MAX_CHILDREN_LIMIT))
+    cursor = String(required=False, validate=Length(min=1))
+
+
+class NodesBatchRequestSchema(Schema):
+    ids = List(String(validate=Length(min=1)), required=True,
+               validate=Length(min=1, max=MAX_NODES_BATCH_SIZE))
+
+
 class SalesRequestParamsSchema(Schema):
     date = DateTime(required=True, format=DATETIME_FORMAT)
 
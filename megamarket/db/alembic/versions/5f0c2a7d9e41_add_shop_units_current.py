@@ -0,0 +1,208 @@
+"""Add shop units current state
+
+Revision ID: 5f0c2a7d9e41
+Revises: d04941b49bad
+Create Date: 2026-10-18 08:12:40.512934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '5f0c2a7d9e41'
+down_revision = 'd04941b49bad'
+branch_labels = None
+depends_on = None
+
+FILL_SHOP_UNITS_CURRENT = """
+INSERT INTO shop_units_current (id, revision_id, name, price, type, parent_id, date)
+SELECT DISTINCT ON (sur.shop_unit_id)
+    sur.shop_unit_id, sur.id, sur.name, sur.price, sur.type, relations.parent_id, sur.date
+FROM
+    shop_unit_revisions sur
+    LEFT JOIN relations ON relations.child_revision_id = sur.id
+ORDER BY sur.shop_unit_id, sur.date DESC;
+"""
+
+REPLACE_CHECK_RELATIONSHIP_FUNCTION = """
+CREATE OR REPLACE FUNCTION f_check_relationship()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$func$
+BEGIN
+    IF 'OFFER' = (
+        SELECT type
+        FROM shop_units_current
+        WHERE id = NEW.parent_id
+    ) THEN
+        RAISE EXCEPTION USING HINT = 'Offer cannot be a parent',
+            ERRCODE = 'object_not_in_prerequisite_state';
+    END IF;
+
+    RETURN NEW;
+END
+$func$;
+"""
+
+RESTORE_CHECK_RELATIONSHIP_FUNCTION = """
+CREATE OR REPLACE FUNCTION f_check_relationship()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$func$
+BEGIN
+    IF 'OFFER' IN (
+        SELECT type
+        FROM shop_unit_revisions
+        WHERE shop_unit_id = NEW.parent_id
+        ORDER BY date DESC
+        LIMIT 1
+    ) THEN
+        RAISE EXCEPTION USING HINT = 'Offer cannot be a parent',
+            ERRCODE = 'object_not_in_prerequisite_state';
+    END IF;
+
+    RETURN NEW;
+END
+$func$;
+"""
+
+REPLACE_DELETE_CHILDREN_FUNCTION = """
+CREATE OR REPLACE FUNCTION f_delete_children()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$func$
+BEGIN
+    DELETE FROM shop_unit_ids
+    WHERE id IN (SELECT id FROM shop_units_current WHERE parent_id = OLD.id);
+
+    RETURN OLD;
+END
+$func$;
+"""
+
+RESTORE_DELETE_CHILDREN_FUNCTION = """
+CREATE OR REPLACE FUNCTION f_delete_children()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$func$
+BEGIN
+    WITH tmp AS (
+        WITH actual_parent_ids AS (
+            WITH actual_revision_dates AS (
+                SELECT MAX(date) AS max_date, shop_unit_id AS child_id
+                FROM
+                    relations
+                    INNER JOIN shop_unit_revisions sur ON relations.child_revision_id = sur.id
+                GROUP BY sur.shop_unit_id
+            )
+            SELECT shop_unit_revisions.shop_unit_id AS child_id, parent_id
+            FROM
+                shop_unit_revisions
+                INNER JOIN actual_revision_dates ard
+                    ON shop_unit_revisions.shop_unit_id = ard.child_id
+                        AND shop_unit_revisions.date = ard.max_date
+                INNER JOIN relations ON relations.child_revision_id = shop_unit_revisions.id
+        )
+        SELECT child_id
+        FROM actual_parent_ids
+        WHERE parent_id = OLD.id
+    )
+    DELETE FROM shop_unit_ids WHERE id IN (SELECT child_id FROM tmp);
+
+    RETURN OLD;
+
+END
+$func$;
+"""
+
+REPLACE_CHECK_UNIT_TYPE_CHANGE_FUNCTION = """
+CREATE OR REPLACE FUNCTION f_check_unit_type_change()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$func$
+BEGIN
+    IF NEW.type <> (
+        SELECT type
+        FROM shop_units_current
+        WHERE id = NEW.shop_unit_id
+    ) THEN
+        RAISE EXCEPTION 'Unit type cannot be changed';
+    END IF;
+
+    RETURN NEW;
+END
+$func$;
+"""
+
+RESTORE_CHECK_UNIT_TYPE_CHANGE_FUNCTION = """
+CREATE OR REPLACE FUNCTION f_check_unit_type_change()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$func$
+BEGIN
+    IF EXISTS((
+        SELECT type
+        FROM shop_unit_revisions
+        WHERE shop_unit_id = NEW.shop_unit_id
+        ORDER BY date DESC
+    ))
+    THEN
+        IF NEW.type NOT IN (
+            SELECT type
+            FROM shop_unit_revisions
+            WHERE shop_unit_id = NEW.shop_unit_id
+            ORDER BY date DESC
+            LIMIT 1
+        ) THEN
+            RAISE EXCEPTION 'Unit type cannot be changed';
+        END IF;
+    END IF;
+
+    RETURN NEW;
+END
+$func$;
+"""
+
+
+def upgrade():
+    op.create_table('shop_units_current',
+                    sa.Column('id', sa.String(), nullable=False),
+                    sa.Column('revision_id', sa.Integer(), nullable=False),
+                    sa.Column('name', sa.String(), nullable=False),
+                    sa.Column('price', sa.Integer(), nullable=True),
+                    sa.Column('type', postgresql.ENUM('OFFER', 'CATEGORY', name='shop_unit_type',
+                                                      create_type=False),
+                              nullable=False),
+                    sa.Column('parent_id', sa.String(), nullable=True),
+                    sa.Column('date', sa.DateTime(), nullable=False),
+                    sa.ForeignKeyConstraint(
+                        ['id'], ['shop_unit_ids.id'],
+                        name=op.f('fk__shop_units_current__id__shop_unit_ids'),
+                        onupdate='RESTRICT', ondelete='CASCADE'),
+                    sa.ForeignKeyConstraint(
+                        ['revision_id'], ['shop_unit_revisions.id'],
+                        name=op.f('fk__shop_units_current__revision_id__shop_unit_revisions'),
+                        onupdate='RESTRICT', ondelete='CASCADE'),
+                    sa.PrimaryKeyConstraint('id', name=op.f('pk__shop_units_current'))
+                    )
+    op.create_index(op.f('ix__shop_units_current__parent_id'), 'shop_units_current',
+                    ['parent_id'], unique=False)
+    op.create_index(op.f('ix__shop_units_current__date'), 'shop_units_current',
+                    ['date'], unique=False)
+
+    op.execute(FILL_SHOP_UNITS_CURRENT)
+
+    op.execute(REPLACE_CHECK_RELATIONSHIP_FUNCTION)
+    op.execute(REPLACE_CHECK_UNIT_TYPE_CHANGE_FUNCTION)
+    op.execute(REPLACE_DELETE_CHILDREN_FUNCTION)
+
+
+def downgrade():
+    op.execute(RESTORE_CHECK_RELATIONSHIP_FUNCTION)
+    op.execute(RESTORE_CHECK_UNIT_TYPE_CHANGE_FUNCTION)
+    op.execute(RESTORE_DELETE_CHILDREN_FUNCTION)
+
+    op.drop_index(op.f('ix__shop_units_current__date'), table_name='shop_units_current')
+    op.drop_index(op.f('ix__shop_units_current__parent_id'), table_name='shop_units_current')
+    op.drop_table('shop_units_current')
@@ -0,0 +1,63 @@
+"""Add category aggregates
+
+Revision ID: 9b3d6e2f1c85
+Revises: 5f0c2a7d9e41
+Create Date: 2026-10-18 09:03:17.208611
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '9b3d6e2f1c85'
+down_revision = '5f0c2a7d9e41'
+branch_labels = None
+depends_on = None
+
+FILL_AGGREGATES = """
+WITH RECURSIVE subtree(ancestor_id, id) AS (
+    SELECT id, id
+    FROM shop_units_current
+    UNION ALL
+    SELECT subtree.ancestor_id, suc.id
+    FROM
+        subtree
+        INNER JOIN shop_units_current suc ON suc.parent_id = subtree.id
+), aggregates AS (
+    SELECT
+        subtree.ancestor_id AS id,
+        COALESCE(SUM(suc.price) FILTER (WHERE suc.type = 'OFFER'), 0) AS offer_price_sum,
+        COUNT(*) FILTER (WHERE suc.type = 'OFFER') AS offer_count,
+        MAX(suc.date) AS last_update
+    FROM
+        subtree
+        INNER JOIN shop_units_current suc ON suc.id = subtree.id
+    GROUP BY subtree.ancestor_id
+)
+UPDATE shop_units_current
+SET
+    offer_price_sum = aggregates.offer_price_sum,
+    offer_count = aggregates.offer_count,
+    last_update = aggregates.last_update
+FROM aggregates
+WHERE shop_units_current.id = aggregates.id;
+"""
+
+
+def upgrade():
+    op.add_column('shop_units_current', sa.Column('offer_price_sum', sa.BigInteger(),
+                                                  nullable=True))
+    op.add_column('shop_units_current', sa.Column('offer_count', sa.Integer(), nullable=True))
+    op.add_column('shop_units_current', sa.Column('last_update', sa.DateTime(), nullable=True))
+
+    op.execute(FILL_AGGREGATES)
+
+    op.alter_column('shop_units_current', 'offer_price_sum', nullable=False)
+    op.alter_column('shop_units_current', 'offer_count', nullable=False)
+    op.alter_column('shop_units_current', 'last_update', nullable=False)
+
+
+def downgrade():
+    op.drop_column('shop_units_current', 'last_update')
+    op.drop_column('shop_units_current', 'offer_count')
+    op.drop_column('shop_units_current', 'offer_price_sum')
@@ -0,0 +1,29 @@
+"""Add lookup indexes
+
+Revision ID: c71e4a0b8d23
+Revises: 9b3d6e2f1c85
+Create Date: 2026-10-18 09:41:52.730164
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c71e4a0b8d23'
+down_revision = '9b3d6e2f1c85'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix__shop_unit_revisions__date'), 'shop_unit_revisions', ['date'],
+                    unique=False)
+    op.create_index(op.f('ix__relations__parent_id'), 'relations', ['parent_id'],
+                    unique=False, postgresql_include=['child_revision_id'])
+    op.create_index(op.f('ix__shop_units_current__revision_id'), 'shop_units_current',
+                    ['revision_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix__shop_units_current__revision_id'), table_name='shop_units_current')
+    op.drop_index(op.f('ix__relations__parent_id'), table_name='relations')
+    op.drop_index(op.f('ix__shop_unit_revisions__date'), table_name='shop_unit_revisions')
@@ -0,0 +1,142 @@
+"""Statement level checks
+
+Revision ID: e3a9f1b6d2c4
+Revises: c71e4a0b8d23
+Create Date: 2026-10-18 11:20:06.318452
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e3a9f1b6d2c4'
+down_revision = 'c71e4a0b8d23'
+branch_labels = None
+depends_on = None
+
+# Запросы проверок вынесены отдельно, чтобы тест планов проверял именно их
+OFFER_PARENTS_QUERY = """
+        SELECT 1
+        FROM
+            new_relations
+            INNER JOIN shop_units_current suc ON suc.id = new_relations.parent_id
+        WHERE suc.type = 'OFFER'
+"""
+
+CREATE_CHECK_RELATIONSHIP_TRIGGER = f"""
+DROP TRIGGER t_check_relationship ON relations;
+
+CREATE OR REPLACE FUNCTION f_check_relationship()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$func$
+BEGIN
+    IF EXISTS({OFFER_PARENTS_QUERY}) THEN
+        RAISE EXCEPTION USING HINT = 'Offer cannot be a parent',
+            ERRCODE = 'object_not_in_prerequisite_state';
+    END IF;
+
+    RETURN NULL;
+END
+$func$;
+
+CREATE TRIGGER t_check_relationship
+AFTER INSERT ON relations
+REFERENCING NEW TABLE AS new_relations
+FOR EACH STATEMENT
+EXECUTE PROCEDURE f_check_relationship();
+"""
+
+RESTORE_CHECK_RELATIONSHIP_TRIGGER = """
+DROP TRIGGER t_check_relationship ON relations;
+
+CREATE OR REPLACE FUNCTION f_check_relationship()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$func$
+BEGIN
+    IF 'OFFER' = (
+        SELECT type
+        FROM shop_units_current
+        WHERE id = NEW.parent_id
+    ) THEN
+        RAISE EXCEPTION USING HINT = 'Offer cannot be a parent',
+            ERRCODE = 'object_not_in_prerequisite_state';
+    END IF;
+
+    RETURN NEW;
+END
+$func$;
+
+CREATE TRIGGER t_check_relationship
+BEFORE INSERT ON relations
+FOR EACH ROW
+EXECUTE PROCEDURE f_check_relationship();
+"""
+
+# Ревизии вставляются до обновления shop_units_current, поэтому там всё ещё прежний тип
+TYPE_CHANGES_QUERY = """
+        SELECT 1
+        FROM
+            new_revisions
+            INNER JOIN shop_units_current suc ON suc.id = new_revisions.shop_unit_id
+        WHERE suc.type <> new_revisions.type
+"""
+
+CREATE_CHECK_UNIT_TYPE_CHANGE_TRIGGER = f"""
+DROP TRIGGER t_check_unit_type_change ON shop_unit_revisions;
+
+CREATE OR REPLACE FUNCTION f_check_unit_type_change()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$func$
+BEGIN
+    IF EXISTS({TYPE_CHANGES_QUERY}) THEN
+        RAISE EXCEPTION 'Unit type cannot be changed';
+    END IF;
+
+    RETURN NULL;
+END
+$func$;
+
+CREATE TRIGGER t_check_unit_type_change
+AFTER INSERT ON shop_unit_revisions
+REFERENCING NEW TABLE AS new_revisions
+FOR EACH STATEMENT
+EXECUTE PROCEDURE f_check_unit_type_change();
+"""
+
+RESTORE_CHECK_UNIT_TYPE_CHANGE_TRIGGER = """
+DROP TRIGGER t_check_unit_type_change ON shop_unit_revisions;
+
+CREATE OR REPLACE FUNCTION f_check_unit_type_change()
+    RETURNS TRIGGER
+    LANGUAGE plpgsql AS
+$func$
+BEGIN
+    IF NEW.type <> (
+        SELECT type
+        FROM shop_units_current
+        WHERE id = NEW.shop_unit_id
+    ) THEN
+        RAISE EXCEPTION 'Unit type cannot be changed';
+    END IF;
+
+    RETURN NEW;
+END
+$func$;
+
+CREATE TRIGGER t_check_unit_type_change
+BEFORE INSERT ON shop_unit_revisions
+FOR EACH ROW
+EXECUTE PROCEDURE f_check_unit_type_change();
+"""
+
+
+def upgrade():
+    op.execute(CREATE_CHECK_RELATIONSHIP_TRIGGER)
+    op.execute(CREATE_CHECK_UNIT_TYPE_CHANGE_TRIGGER)
+
+
+def downgrade():
+    op.execute(RESTORE_CHECK_UNIT_TYPE_CHANGE_TRIGGER)
+    op.execute(RESTORE_CHECK_RELATIONSHIP_TRIGGER)
@@ -0,0 +1,25 @@
+"""Add unit version
+
+Revision ID: f4b2c8d1a7e5
+Revises: e3a9f1b6d2c4
+Create Date: 2026-10-18 13:12:40.518270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f4b2c8d1a7e5'
+down_revision = 'e3a9f1b6d2c4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('shop_unit_ids',
+                  sa.Column('version', sa.BigInteger(), nullable=False,
+                            server_default=sa.text('txid_current()')))
+
+
+def downgrade():
+    op.drop_column('shop_unit_ids', 'version')
@@ -1,9 +1,11 @@
 from enum import Enum, unique
 
 from sqlalchemy import (
-    Column, Table, MetaData, Integer, String, ForeignKey, Enum as PgEnum, DateTime,
+    Column, Table, MetaData, Integer, BigInteger, String, ForeignKey, Enum as PgEnum, DateTime,
     PrimaryKeyConstraint,
-    UniqueConstraint
+    UniqueConstraint,
+    Index,
+    text
 )
 
 convention = {
@@ -29,12 +31,14 @@ class ShopUnitType(Enum):
 shop_unit_ids_table = Table(
     'shop_unit_ids', metadata,
     Column('id', String, primary_key=True),
+    # Идентификатор транзакции, последней изменившей элемент или его поддерево
+    Column('version', BigInteger, nullable=False, server_default=text('txid_current()')),
 )
 
 shop_unit_revisions_table = Table(
     'shop_unit_revisions', metadata,
     Column('id', Integer, primary_key=True, autoincrement=True),
-    Column('date', DateTime, nullable=False),
+    Column('date', DateTime, nullable=False, index=True),
     Column('shop_unit_id', String,
            ForeignKey('shop_unit_ids.id', ondelete='CASCADE', onupdate='RESTRICT'), nullable=False),
     Column('name', String, nullable=False),
@@ -52,4 +56,39 @@ relations_table = Table(
            ForeignKey('shop_unit_ids.id', ondelete='RESTRICT', onupdate='CASCADE'), nullable=False),
     UniqueConstraint('child_revision_id', 'parent_id'),
     PrimaryKeyConstraint('child_revision_id', name='pk__relations'),
+    Index('ix__relations__parent_id', 'parent_id', postgresql_include=['child_revision_id']),
+)
+
+shop_units_current_table = Table(
+    'shop_units_current', metadata,
+    Column('id', String,
+           ForeignKey('shop_unit_ids.id', ondelete='CASCADE', onupdate='RESTRICT'),
+           primary_key=True),
+    Column('revision_id', Integer,
+           ForeignKey('shop_unit_revisions.id', ondelete='CASCADE', onupdate='RESTRICT'),
+           nullable=False, index=True),
+    Column('name', String, nullable=False),
+    Column('price', Integer, nullable=True),
+    Column('type', PgEnum(ShopUnitType, name='shop_unit_type'), nullable=False),
+    Column('parent_id', String, nullable=True, index=True),
+    Column('date', DateTime, nullable=False, index=True),
+    Column('offer_price_sum', BigInteger, nullable=False),
+    Column('offer_count', Integer, nullable=False),
+    Column('last_update', DateTime, nullable=False),
+)
+
+# Временные таблицы для массовой загрузки через COPY. Живут до конца транзакции,
+# поэтому вынесены в отдельные метаданные и в миграции не попадают.
+staging_metadata = MetaData(naming_convention=convention)
+
+imported_units_table = Table(
+    'imported_units', staging_metadata,
+    Column('id', String, nullable=False),
+    Column('name', String, nullable=False),
+    Column('price', Integer, nullable=True),
+    Column('type', PgEnum(ShopUnitType, name='shop_unit_type', create_type=False),
+           nullable=False),
+    Column('parent_id', String, nullable=True),
+    prefixes=['TEMPORARY'],
+    postgresql_on_commit='DROP',
 )
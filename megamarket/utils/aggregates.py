@@ -0,0 +1,172 @@
+"""
+Агрегаты категорий хранятся в shop_units_current: сумма цен товаров поддерева, их количество
+и дата последнего обновления. Для товара это его собственная цена, единица и дата.
+Благодаря этому агрегат категории считается по её прямым детям, а не по всему поддереву,
+и при изменениях достаточно пересчитать только категории на пути к корню.
+
+Тот же набор элементов получает новую версию в shop_unit_ids, поэтому версия элемента
+меняется при любом изменении его поддерева и годится для проверки кэшей.
+"""
+
+from itertools import groupby
+from typing import Iterable
+
+from sqlalchemy import select, func, cast, column, literal, false, String
+from sqlalchemy.dialects.postgresql import ARRAY, array
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from megamarket.db.schema import shop_units_current_table, shop_unit_ids_table, ShopUnitType
+
+
+class ParentCycleError(Exception):
+    """
+    Импорт сделал категорию предком самой себя.
+    """
+    def __init__(self, unit_ids: list[str]):
+        super().__init__(f'Parent cycle through {", ".join(unit_ids)}')
+        self.unit_ids = unit_ids
+
+
+def get_parent_ids_query(unit_ids: Iterable[str]):
+    return (
+        select([shop_units_current_table.c.parent_id])
+        .distinct()
+        .where(shop_units_current_table.c.id == func.any(cast(list(unit_ids), ARRAY(String))))
+        .where(shop_units_current_table.c.parent_id.isnot(None))
+    )
+
+
+def get_dirty_categories_query(unit_ids: Iterable[str]):
+    """
+    Возвращает категории среди unit_ids и всех их предков вместе с наибольшим расстоянием
+    до одного из unit_ids. Если одна категория лежит внутри другой, расстояние до неё
+    строго меньше, так что пересчёт в порядке возрастания расстояния идёт снизу вверх.
+
+    Проверка триггеров не видит циклов по родителям, поэтому обход запоминает пройденный путь
+    и останавливается на повторе, а такие элементы помечаются в колонке cycle.
+    """
+    ancestors = (
+        select([
+            shop_units_current_table.c.id,
+            shop_units_current_table.c.parent_id,
+            shop_units_current_table.c.type,
+            literal(0).label('distance'),
+            array([shop_units_current_table.c.id]).label('path'),
+            false().label('cycle'),
+        ])
+        .where(shop_units_current_table.c.id == func.any(cast(list(unit_ids), ARRAY(String))))
+        .cte('ancestors', recursive=True)
+    )
+
+    ancestors = ancestors.union_all(
+        select([
+            shop_units_current_table.c.id,
+            shop_units_current_table.c.parent_id,
+            shop_units_current_table.c.type,
+            ancestors.c.distance + 1,
+            func.array_append(ancestors.c.path, shop_units_current_table.c.id),
+            shop_units_current_table.c.id == func.any(ancestors.c.path),
+        ])
+        .select_from(
+            ancestors
+            .join(shop_units_current_table,
+                  shop_units_current_table.c.id == ancestors.c.parent_id)
+        )
+        .where(~ancestors.c.cycle)
+    )
+
+    return (
+        select([
+            ancestors.c.id,
+            func.max(ancestors.c.distance).label('distance'),
+            func.bool_or(ancestors.c.cycle).label('cycle'),
+        ])
+        .where(ancestors.c.type == ShopUnitType.CATEGORY)
+        .group_by(ancestors.c.id)
+        .order_by(func.max(ancestors.c.distance))
+    )
+
+
+def get_update_aggregates_query(category_ids: Iterable[str]):
+    children = shop_units_current_table.alias('children')
+
+    categories = (
+        func.unnest(cast(list(category_ids), ARRAY(String)))
+        .table_valued(column('id', String))
+        .render_derived(name='categories')
+    )
+
+    aggregates = (
+        select([
+            categories.c.id,
+            func.coalesce(func.sum(children.c.offer_price_sum), 0).label('offer_price_sum'),
+            func.coalesce(func.sum(children.c.offer_count), 0).label('offer_count'),
+            func.max(children.c.last_update).label('last_update'),
+        ])
+        .select_from(
+            categories
+            .join(children, children.c.parent_id == categories.c.id, isouter=True)
+        )
+        .group_by(categories.c.id)
+        .subquery('aggregates')
+    )
+
+    return (
+        shop_units_current_table
+        .update()
+        .where(shop_units_current_table.c.id == aggregates.c.id)
+        .values(
+            offer_price_sum=aggregates.c.offer_price_sum,
+            offer_count=aggregates.c.offer_count,
+            last_update=func.greatest(shop_units_current_table.c.date, aggregates.c.last_update),
+        )
+    )
+
+
+def get_update_versions_query(unit_ids: Iterable[str]):
+    return (
+        shop_unit_ids_table
+        .update()
+        .where(shop_unit_ids_table.c.id == func.any(cast(list(unit_ids), ARRAY(String))))
+        .values(version=func.txid_current())
+    )
+
+
+async def get_parent_ids(conn: AsyncConnection, unit_ids: Iterable[str]) -> list[str]:
+    result = await conn.execute(get_parent_ids_query(unit_ids))
+    return [row['parent_id'] for row in result]
+
+
+async def update_category_aggregates(conn: AsyncConnection,
+                                     unit_ids: Iterable[str]) -> list[str]:
+    """
+    Пересчитывает агрегаты категорий из unit_ids и всех их предков.
+
+    :param conn: Соединение, в транзакции которого были изменены элементы
+    :param unit_ids: Изменённые элементы и их прежние родители
+    :return: Пересчитанные категории
+    :raises ParentCycleError: Если среди предков есть цикл
+    """
+    rows = (await conn.execute(get_dirty_categories_query(unit_ids))).fetchall()
+
+    cycle_ids = [row['id'] for row in rows if row['cycle']]
+    if cycle_ids:
+        raise ParentCycleError(cycle_ids)
+
+    category_ids = []
+
+    for _, level in groupby(rows, key=lambda row: row['distance']):
+        ids = [row['id'] for row in level]
+        await conn.execute(get_update_aggregates_query(ids))
+        category_ids.extend(ids)
+
+    return category_ids
+
+
+async def update_versions(conn: AsyncConnection, unit_ids: Iterable[str]):
+    """
+    Присваивает элементам версию текущей транзакции.
+
+    :param unit_ids: Изменённые элементы и пересчитанные категории
+    """
+    await conn.execute(get_update_versions_query(unit_ids))
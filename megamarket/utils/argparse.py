@@ -15,6 +15,8 @@ def validate(type: Callable, constrain: Callable):
 
 
 positive_int = validate(int, lambda x: x > 0)
+non_negative_int = validate(int, lambda x: x >= 0)
+positive_float = validate(float, lambda x: x > 0)
 
 
 def clear_environ(rule: Callable):
@@ -0,0 +1,87 @@
+"""
+Кэш готовых ответов /nodes в памяти процесса.
+Данные меняются только при импорте и удалении, поэтому после их фиксации из кэша
+выбрасываются изменённые элементы и все их предки, а остальные ответы остаются верными.
+"""
+
+from collections import OrderedDict
+from typing import AsyncIterable, AsyncIterator, Iterable
+
+DEFAULT_NODES_CACHE_SIZE = 64 * 1024 * 1024
+
+
+class SubtreeCache:
+    """
+    LRU-кэш отрисованных поддеревьев, ограниченный суммарным размером в байтах.
+
+    Ответ хранится вместе с версией элемента, прочитанной до начала отрисовки,
+    и отдаётся только для той же версии. Поэтому ответ, собранный по старому
+    состоянию, после импорта не вернётся, даже если попал в кэш уже после сброса.
+    """
+    def __init__(self, max_size: int = DEFAULT_NODES_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries: OrderedDict[str, tuple[int, bytes]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, unit_id: str, version: int) -> bytes | None:
+        entry = self._entries.get(unit_id)
+
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(unit_id)
+
+        return entry[1]
+
+    def put(self, unit_id: str, version: int, body: bytes):
+        if len(body) > self.max_size:
+            return
+
+        self._discard(unit_id)
+        self._entries[unit_id] = version, body
+        self.size += len(body)
+
+        while self.size > self.max_size:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, unit_ids: Iterable[str]):
+        for unit_id in unit_ids:
+            self._discard(unit_id)
+
+    def _discard(self, unit_id: str):
+        entry = self._entries.pop(unit_id, None)
+
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    async def collect(self, unit_id: str, version: int,
+                      chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+        """
+        Отдаёт фрагменты ответа и, если он дошёл до конца, сохраняет его в кэш.
+        Ответ, не поместившийся в кэш целиком, перестаёт копироваться.
+        """
+        body = bytearray()
+
+        async for chunk in chunks:
+            if body is not None:
+                body.extend(chunk)
+
+                if len(body) > self.max_size:
+                    body = None
+
+            yield chunk
+
+        if body is not None:
+            self.put(unit_id, version, bytes(body))
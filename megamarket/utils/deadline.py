@@ -0,0 +1,75 @@
+"""
+Срок выполнения запроса на чтение.
+Срок отсчитывается от начала обработки и ограничивает каждое обращение к базе: ожидание
+соединения из пула, выполнение запроса и чтение очередной пачки из курсора. Кроме того,
+в транзакции выставляется statement_timeout на оставшееся время, чтобы Postgres сам
+прервал запрос, который клиент уже не дождётся.
+"""
+
+import asyncio
+from typing import Awaitable, TypeVar
+
+import asyncpg
+from sqlalchemy.exc import DBAPIError
+
+T = TypeVar('T')
+
+DEFAULT_NODES_TIMEOUT = 30
+DEFAULT_NODE_STATISTIC_TIMEOUT = 10
+DEFAULT_SALES_TIMEOUT = 10
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    pass
+
+
+class Deadline:
+    def __init__(self, timeout: float | None):
+        self.timeout = timeout
+        self._expires_at = None
+
+        if timeout is not None:
+            self._expires_at = asyncio.get_running_loop().time() + timeout
+
+    def remaining(self) -> float | None:
+        if self._expires_at is None:
+            return None
+
+        return max(self._expires_at - asyncio.get_running_loop().time(), 0)
+
+    def statement_timeout(self) -> int | None:
+        """
+        Оставшееся время в миллисекундах для statement_timeout.
+        Ноль в Postgres отключает ограничение, поэтому меньше одной миллисекунды не бывает.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+
+        return max(int(remaining * 1000), 1)
+
+    async def wait(self, awaitable: Awaitable[T]) -> T:
+        """
+        Дожидается обращения к базе, но не дольше оставшегося времени.
+
+        :raises DeadlineExceeded: Если время вышло здесь или Postgres прервал запрос
+            по statement_timeout
+        """
+        try:
+            if self._expires_at is None:
+                return await awaitable
+
+            return await asyncio.wait_for(awaitable, self.remaining())
+        except asyncio.TimeoutError as e:
+            raise DeadlineExceeded() from e
+        except asyncpg.QueryCanceledError as e:
+            raise DeadlineExceeded() from e
+        except DBAPIError as e:
+            if getattr(e.orig, 'sqlstate', None) == asyncpg.QueryCanceledError.sqlstate:
+                raise DeadlineExceeded() from e
+
+            raise
+
+
+# Срок без ограничения для вызовов вне обработчиков
+NO_DEADLINE = Deadline(None)
@@ -0,0 +1,96 @@
+"""
+Сбор статистики обработки запроса: сколько было запросов к базе, сколько они заняли,
+когда ушёл первый байт ответа и сколько байт отдано.
+
+Статистика текущего запроса лежит в контекстной переменной. SQLAlchemy выполняет запросы
+в гринлетах с тем же контекстом, asyncpg вызывает логгеры запросов через call_soon, который
+тоже копирует контекст, поэтому хуки находят статистику своего запроса без передачи
+её через аргументы. Вне обработки запроса статистика не собирается.
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import asyncpg
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+class RequestStats:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+
+        self.queries = 0
+        self.db_time = 0.0
+        # Секунды от начала обработки до отправки первого фрагмента тела
+        self.ttfb: float | None = None
+        self.bytes_streamed = 0
+        self.handler_time: float | None = None
+
+    def add_query(self, elapsed: float, count: int = 1):
+        self.queries += count
+        self.db_time += elapsed
+
+    def add_chunk(self, size: int):
+        if self.ttfb is None:
+            self.ttfb = time.perf_counter() - self.started_at
+
+        self.bytes_streamed += size
+
+    def finish_handler(self):
+        self.handler_time = time.perf_counter() - self.started_at
+
+    def as_dict(self) -> dict:
+        return {
+            'queries': self.queries,
+            'db_time': self.db_time,
+            'ttfb': self.ttfb,
+            'bytes_streamed': self.bytes_streamed,
+            'handler_time': self.handler_time,
+        }
+
+
+request_stats: ContextVar[RequestStats | None] = ContextVar('request_stats', default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Время начала хранится в контексте выполнения, который живёт один запрос
+    context.megamarket_started_at = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.add_query(time.perf_counter() - context.megamarket_started_at)
+
+
+def instrument_engine(engine: AsyncEngine):
+    event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine.sync_engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def log_raw_query(record):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.add_query(record.elapsed)
+
+
+def instrument_raw_connection(conn: asyncpg.Connection):
+    conn.add_query_logger(log_raw_query)
+
+
+@contextmanager
+def track_db_time(queries: int = 0):
+    """
+    Учитывает обращения к базе, которые не видны хукам: открытие курсора asyncpg
+    и чтение очередной пачки из серверного курсора.
+    """
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        stats = request_stats.get()
+        if stats is not None:
+            stats.add_query(time.perf_counter() - start, queries)
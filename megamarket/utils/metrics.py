@@ -0,0 +1,156 @@
+"""
+Метрики в текстовом формате Prometheus.
+Значения копятся в памяти процесса: наблюдение — это поиск по словарю и пара сложений,
+а текст собирается только при запросе /metrics. Воркеры не складывают метрики между собой:
+каждый отдаёт свои на отдельном порту с меткой worker, а складывает их уже Prometheus.
+"""
+
+from bisect import bisect_left
+from collections.abc import Callable, Iterable
+
+LabelValues = tuple[str, ...]
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DEFAULT_SIZE_BUCKETS = tuple(4 ** power for power in range(3, 13))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    labels = ','.join(
+        f'{name}="{escape_label_value(str(value))}"' for name, value in zip(names, values)
+    )
+    return f'{{{labels}}}' if labels else ''
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if not isinstance(value, int) else str(value)
+
+
+class Metric:
+    TYPE: str
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+
+    def samples(self) -> Iterable[tuple[str, LabelValues, float]]:
+        """
+        Отдаёт тройки (суффикс имени, значения меток, значение).
+        """
+        raise NotImplementedError()
+
+    def render(self, const_labels: dict[str, str] | None = None) -> Iterable[str]:
+        """
+        :param const_labels: Метки, которые добавляются ко всем значениям, например worker
+        """
+        const_labels = const_labels or {}
+
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.TYPE}'
+
+        for suffix, labels, value in self.samples():
+            names = self.label_names
+            if len(labels) > len(names):
+                names = (*names, 'le')
+
+            names = (*const_labels, *names)
+            labels = (*const_labels.values(), *labels)
+
+            yield f'{self.name}{suffix}{format_labels(names, labels)} {format_value(value)}'
+
+
+class Value(Metric):
+    """
+    Метрика из одного значения на набор меток. Значение меняется напрямую или,
+    если передан collect, читается при отдаче метрик: так удобнее отдавать то,
+    что уже считается в другом месте, например размер пула соединений.
+    collect возвращает пары (значения меток, значение).
+    """
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 collect: Callable[[], Iterable[tuple[LabelValues, float]]] | None = None):
+        super().__init__(name, documentation, labels)
+        self._values: dict[LabelValues, float] = {}
+        self._collect = collect
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        values = self._collect() if self._collect is not None else self._values.items()
+
+        for labels, value in values:
+            yield '', labels, value
+
+
+class Counter(Value):
+    TYPE = 'counter'
+
+
+class Gauge(Value):
+    TYPE = 'gauge'
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Для каждого набора меток: число наблюдений по корзинам (без накопления), сумма
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+
+        counts, total = entry
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self):
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                yield '_bucket', (*labels, format_value(bound)), cumulative
+
+            yield '_sum', labels, total[0]
+            yield '_count', labels, cumulative
+
+
+class Registry:
+    def __init__(self, const_labels: dict[str, str] | None = None):
+        self._metrics: dict[str, Metric] = {}
+        self._const_labels = const_labels or {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'Metric {metric.name} is already registered')
+
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render(self._const_labels))
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,118 @@
+"""
+Распределение чтения по репликам.
+Потоковые GET-обработчики читают с реплик по кругу, а импорт и удаление всегда идут
+в основную базу. Реплики периодически проверяются, недоступные пропускаются, а если
+не осталось ни одной, чтение уходит в основную базу.
+
+В режиме read-your-writes после каждой записи запоминается позиция журнала основной базы,
+и реплика выбирается, только если уже проиграла журнал до этой позиции.
+"""
+
+import asyncio
+import logging
+from itertools import count
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from yarl import URL
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PG_REPLICA_CHECK_INTERVAL = 5
+
+# Позиции журнала переводятся в числа, чтобы их можно было сравнивать
+CURRENT_LSN_QUERY = text("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), '0/0')")
+REPLAY_LSN_QUERY = text("SELECT pg_wal_lsn_diff(pg_last_wal_replay_lsn(), '0/0')")
+
+
+class Replica:
+    """
+    Движок реплики и, если включён, её пул asyncpg.
+    """
+    def __init__(self, url: URL, engine: AsyncEngine, pool: asyncpg.Pool | None = None):
+        self.url = url
+        self.engine = engine
+        self.pool = pool
+
+        self.healthy = True
+        # Позиция проигранного журнала на момент последней проверки.
+        # None, если сервер её не сообщает, то есть не является репликой
+        self.replay_lsn: int | None = None
+
+    @property
+    def reader(self):
+        return self.pool if self.pool is not None else self.engine
+
+    async def check(self, timeout: float):
+        try:
+            async with self.engine.connect() as conn:
+                lsn = await asyncio.wait_for(conn.scalar(REPLAY_LSN_QUERY), timeout)
+        except (OSError, asyncio.TimeoutError, SQLAlchemyError) as e:
+            if self.healthy:
+                log.warning('Replica %s is unavailable: %r', self.url, e)
+
+            self.healthy = False
+            return
+
+        if not self.healthy:
+            log.info('Replica %s is available again', self.url)
+
+        self.healthy = True
+        self.replay_lsn = int(lsn) if lsn is not None else None
+
+
+class ReplicaSet:
+    """
+    Выбирает, откуда читать очередному запросу.
+
+    :param primary: Движок основной базы, через него узнаётся позиция журнала после записи
+    :param primary_reader: Откуда читать, если ни одна реплика не подходит
+    :param replicas: Реплики
+    :param read_your_writes: Читать только с реплик, догнавших последнюю запись
+    """
+    def __init__(self, primary: AsyncEngine, primary_reader, replicas: list[Replica],
+                 read_your_writes: bool = False):
+        self.primary = primary
+        self.primary_reader = primary_reader
+        self.replicas = replicas
+        self.read_your_writes = read_your_writes
+
+        self.last_write_lsn: int | None = None
+        self._counter = count()
+
+    def _is_caught_up(self, replica: Replica) -> bool:
+        if not self.read_your_writes or self.last_write_lsn is None:
+            return True
+
+        return replica.replay_lsn is not None and replica.replay_lsn >= self.last_write_lsn
+
+    def choose(self):
+        replicas = [
+            replica for replica in self.replicas
+            if replica.healthy and self._is_caught_up(replica)
+        ]
+
+        if not replicas:
+            return self.primary_reader
+
+        return replicas[next(self._counter) % len(replicas)].reader
+
+    async def note_write(self):
+        """
+        Запоминает позицию журнала основной базы. Вызывается после фиксации записи.
+        """
+        if not self.read_your_writes or not self.replicas:
+            return
+
+        async with self.primary.connect() as conn:
+            self.last_write_lsn = int(await conn.scalar(CURRENT_LSN_QUERY))
+
+    async def check(self, timeout: float = DEFAULT_PG_REPLICA_CHECK_INTERVAL):
+        await asyncio.gather(*(replica.check(timeout) for replica in self.replicas))
+
+    async def run_checks(self, interval: float = DEFAULT_PG_REPLICA_CHECK_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            await self.check(interval)
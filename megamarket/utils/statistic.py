@@ -0,0 +1,264 @@
+"""
+История элемента за один проход.
+Все ревизии элементов, когда-либо лежавших в поддереве, читаются одним запросом
+через серверный курсор и проигрываются в порядке дат. Сумма цен, количество товаров и даты поддерева
+поддерживаются по ходу проигрывания, поэтому состояние на каждую дату обновления
+получается без повторного обхода поддерева.
+"""
+
+from collections import Counter, defaultdict
+from datetime import datetime
+from heapq import heappush, heappop
+from typing import AsyncIterable, AsyncIterator, Iterator
+
+from asyncpg import Record
+from sqlalchemy import select, literal
+
+from megamarket.db.schema import shop_unit_revisions_table, relations_table, ShopUnitType
+from megamarket.utils.streamers import ShopUnitSubtreeStreamer, SubtreeNode
+
+
+def get_ever_children_cte(unit_id):
+    """
+    Элемент и все элементы, которые хоть раз были в его поддереве.
+    """
+    ever_children = (
+        select([literal(unit_id).label('id')])
+        .cte('ever_children', recursive=True)
+    )
+
+    ever_children = ever_children.union(
+        select([shop_unit_revisions_table.c.shop_unit_id])
+        .select_from(
+            ever_children
+            .join(relations_table, relations_table.c.parent_id == ever_children.c.id)
+            .join(shop_unit_revisions_table,
+                  shop_unit_revisions_table.c.id == relations_table.c.child_revision_id)
+        )
+    )
+
+    return ever_children
+
+
+def get_subtree_history_query(unit_id, to_date: datetime | None):
+    """
+    Возвращает ревизии элемента и всех элементов, которые хоть раз были в его поддереве,
+    вместе с родителем, упорядоченные по дате.
+    """
+    ever_children = get_ever_children_cte(unit_id)
+
+    query = (
+        select([
+            shop_unit_revisions_table.c.shop_unit_id,
+            shop_unit_revisions_table.c.name,
+            shop_unit_revisions_table.c.price,
+            shop_unit_revisions_table.c.type,
+            shop_unit_revisions_table.c.date,
+            relations_table.c.parent_id,
+        ])
+        .select_from(
+            ever_children
+            .join(shop_unit_revisions_table,
+                  shop_unit_revisions_table.c.shop_unit_id == ever_children.c.id)
+            .join(relations_table,
+                  relations_table.c.child_revision_id == shop_unit_revisions_table.c.id,
+                  isouter=True)
+        )
+        .order_by(shop_unit_revisions_table.c.date)
+    )
+
+    if to_date is not None:
+        query = query.where(shop_unit_revisions_table.c.date <= to_date)
+
+    return query
+
+
+def get_update_dates_query(unit_id,
+                           from_date: datetime | None,
+                           to_date: datetime | None):
+    """
+    Возвращает даты ревизий из промежутка [from_date, to_date] у элементов, которые лежат
+    в поддереве unit_id по своим последним ревизиям из этого промежутка.
+    """
+    if from_date is None and to_date is None:
+        actual_revisions = ShopUnitSubtreeStreamer.get_current_units()
+    else:
+        actual_revisions = ShopUnitSubtreeStreamer.get_actual_revisions_query(from_date, to_date)\
+            .cte('actual_revisions')
+
+    subtree = (
+        select([literal(unit_id).label('id')])
+        .cte('subtree', recursive=True)
+    )
+
+    subtree = subtree.union(
+        select([actual_revisions.c.shop_unit_id])
+        .where(actual_revisions.c.parent_id == subtree.c.id)
+    )
+
+    query = (
+        select([shop_unit_revisions_table.c.date])
+        .distinct()
+        .select_from(
+            subtree
+            .join(shop_unit_revisions_table,
+                  shop_unit_revisions_table.c.shop_unit_id == subtree.c.id)
+        )
+    )
+
+    if from_date is not None:
+        query = query.where(shop_unit_revisions_table.c.date >= from_date)
+    if to_date is not None:
+        query = query.where(shop_unit_revisions_table.c.date <= to_date)
+
+    return query
+
+
+class DateCounter:
+    """
+    Мультимножество дат, из которого можно удалять, с быстрым получением наибольшей.
+    """
+    def __init__(self):
+        self._counts = Counter()
+        self._heap = []
+
+    def add(self, date: datetime):
+        if not self._counts[date]:
+            # Ключ кучи уменьшается с ростом даты, так что на вершине самая поздняя
+            heappush(self._heap, datetime.max - date)
+
+        self._counts[date] += 1
+
+    def remove(self, date: datetime):
+        self._counts[date] -= 1
+
+    def max(self) -> datetime | None:
+        while self._heap and not self._counts[datetime.max - self._heap[0]]:
+            heappop(self._heap)
+
+        return datetime.max - self._heap[0] if self._heap else None
+
+
+class SubtreeHistory:
+    """
+    Состояние поддерева, которое восстанавливается проигрыванием ревизий.
+    Для каждого элемента хранится его последняя ревизия и дети, а для поддерева —
+    множество входящих в него элементов и их суммарные цена, количество товаров и даты.
+    """
+    def __init__(self, unit_id):
+        self._unit_id = unit_id
+        self._records: dict[str, Record] = {}
+        self._children: defaultdict[str, set[str]] = defaultdict(set)
+        self._members: set[str] = set()
+        self._price_sum = 0
+        self._offers_count = 0
+        self._dates = DateCounter()
+
+    def _is_member(self, unit_id) -> bool:
+        return unit_id == self._unit_id \
+            or self._records[unit_id]['parent_id'] in self._members
+
+    def _descendants(self, unit_id) -> Iterator[str]:
+        stack = [unit_id]
+        while stack:
+            current_id = stack.pop()
+            stack.extend(self._children[current_id])
+
+            yield current_id
+
+    def _add(self, record: Record):
+        if record['type'] == ShopUnitType.OFFER:
+            self._price_sum += record['price']
+            self._offers_count += 1
+
+        self._dates.add(record['date'])
+
+    def _remove(self, record: Record):
+        if record['type'] == ShopUnitType.OFFER:
+            self._price_sum -= record['price']
+            self._offers_count -= 1
+
+        self._dates.remove(record['date'])
+
+    def _attach(self, unit_id):
+        for descendant_id in self._descendants(unit_id):
+            self._members.add(descendant_id)
+            self._add(self._records[descendant_id])
+
+    def _detach(self, unit_id):
+        for descendant_id in self._descendants(unit_id):
+            self._members.discard(descendant_id)
+            self._remove(self._records[descendant_id])
+
+    def apply(self, record: Record):
+        unit_id = record['shop_unit_id']
+        previous = self._records.get(unit_id)
+
+        # Если родитель не поменялся, вместе с элементом в поддерево не входят
+        # и из него не выходят другие элементы
+        if previous is not None and previous['parent_id'] == record['parent_id']:
+            if unit_id in self._members:
+                self._remove(previous)
+                self._add(record)
+
+            self._records[unit_id] = record
+            return
+
+        if previous is not None:
+            if unit_id in self._members:
+                self._detach(unit_id)
+
+            self._children[previous['parent_id']].discard(unit_id)
+
+        self._records[unit_id] = record
+        self._children[record['parent_id']].add(unit_id)
+
+        if self._is_member(unit_id):
+            self._attach(unit_id)
+
+    def dump(self, streamer: ShopUnitSubtreeStreamer) -> bytes | None:
+        """
+        Возвращает элемент в текущем состоянии или None, если его ещё нет.
+        """
+        record = self._records.get(self._unit_id)
+
+        if record is None:
+            return None
+
+        if record['type'] == ShopUnitType.OFFER:
+            return streamer.dump_offer(record)
+
+        node = SubtreeNode(record)
+        node.add(self._price_sum, self._offers_count, self._dates.max())
+
+        return streamer.dump_category(node)
+
+
+async def render_statistic(unit_id, update_dates: set[datetime],
+                           partitions: AsyncIterable[list[Record]]) -> AsyncIterator[bytes]:
+    """
+    Отдаёт состояние элемента на каждую из дат обновления.
+
+    :param update_dates: Строки запроса get_update_dates_query
+    :param partitions: Пачки строк запроса get_subtree_history_query
+    """
+    history = SubtreeHistory(unit_id)
+    streamer = ShopUnitSubtreeStreamer(unit_id, None, stream_children=False)
+
+    previous_date = None
+
+    async for records in partitions:
+        for record in records:
+            # Все ревизии предыдущей даты применены, можно отдавать её состояние
+            if record['date'] != previous_date and previous_date in update_dates:
+                dump = history.dump(streamer)
+                if dump is not None:
+                    yield dump
+
+            history.apply(record)
+            previous_date = record['date']
+
+    if previous_date in update_dates:
+        dump = history.dump(streamer)
+        if dump is not None:
+            yield dump
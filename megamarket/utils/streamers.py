@@ -5,16 +5,21 @@
 то, что требуется для вычислений, например цены.
 """
 
+from collections import deque
 from datetime import datetime
 from enum import Enum
-from typing import AsyncIterable, List
+from typing import AsyncIterable, Iterable, List
 
 from asyncpg import Record
-from sqlalchemy import select, func
+from sqlalchemy import select, func, literal
+from sqlalchemy.dialects.postgresql import array
 from sqlalchemy.ext.asyncio import AsyncConnection
 
-from megamarket.api.payloads import dumps
-from megamarket.db.schema import shop_unit_revisions_table, relations_table, ShopUnitType
+from megamarket.api.payloads import dumps, dumpb
+from megamarket.utils.deadline import Deadline, NO_DEADLINE
+from megamarket.utils.pg import DEFAULT_PG_PREFETCH, stream_partitions, fetch
+from megamarket.db.schema import shop_unit_revisions_table, relations_table, ShopUnitType, \
+    shop_units_current_table
 
 
 class EndOfStream:
@@ -26,9 +31,9 @@ class ShopUnitStreamer(AsyncIterable):
     Базовый класс стримера.
     """
     @classmethod
-    async def get_unit_record_by_id(cls, unit_id, pg: AsyncConnection,
+    def get_unit_record_by_id_query(cls, unit_id,
                                     from_date: datetime | None,
-                                    to_date: datetime | None) -> Record | None:
+                                    to_date: datetime | None):
         query = (
             shop_unit_revisions_table
             .select()
@@ -42,7 +47,13 @@ class ShopUnitStreamer(AsyncIterable):
         if to_date is not None:
             query = query.where(shop_unit_revisions_table.c.date <= to_date)
 
-        result = await pg.execute(query)
+        return query
+
+    @classmethod
+    async def get_unit_record_by_id(cls, unit_id, pg: AsyncConnection,
+                                    from_date: datetime | None,
+                                    to_date: datetime | None) -> Record | None:
+        result = await pg.execute(cls.get_unit_record_by_id_query(unit_id, from_date, to_date))
 
         first = result.first()
         return first
@@ -172,17 +183,29 @@ class ShopCategoryStreamer(ShopUnitStreamer):
     Класс стримера категорий.
     Стример получает дочерние категории, отдаёт их итератору и ждёт, пока они закончат стриминг.
     После этого высчитывает свою цену и дату обновления, отдаёт информацию о себе.
+
+    Сумма цен, число товаров и дата копятся по мере того, как дети заканчивают стриминг,
+    а сами дети создаются только перед отдачей и сразу после неё отпускаются. Дети читаются
+    страницами по CHILDREN_PAGE_SIZE, поэтому в памяти держится цепочка открытых категорий
+    и по странице детей на каждую, а не всё поддерево.
     """
     type = ShopUnitType.CATEGORY
+    CHILDREN_PAGE_SIZE = 1000
 
     @property
     def children_count(self) -> int:
-        return sum(child.children_count for child in self._children)
+        return self._offers_count
 
     @classmethod
     def get_children_ids_query(cls, unit_id,
                                from_date: datetime | None,
-                               to_date: datetime | None):
+                               to_date: datetime | None,
+                               after: str | None = None,
+                               limit: int | None = None):
+        """
+        Возвращает детей элемента по порядку id: всех или страницу из limit детей,
+        идущих после after.
+        """
         actual_revision_dates = (
             select([
                 func.max(shop_unit_revisions_table.c.date).label('max_date'),
@@ -231,16 +254,24 @@ class ShopCategoryStreamer(ShopUnitStreamer):
                 actual_parent_ids.c.type,
             ])
             .where(actual_parent_ids.c.parent_id == unit_id)
+            .order_by(actual_parent_ids.c.child_id)
+            .limit(limit)
         )
 
+        if after is not None:
+            children_ids = children_ids.where(actual_parent_ids.c.child_id > after)
+
         return children_ids
 
     @classmethod
     async def get_children_ids(cls, unit_id, pg: AsyncConnection,
                                from_date: datetime | None,
-                               to_date: datetime | None) -> List[Record]:
+                               to_date: datetime | None,
+                               after: str | None = None,
+                               limit: int | None = None) -> List[Record]:
 
-        result = await pg.execute(cls.get_children_ids_query(unit_id, from_date, to_date))
+        result = await pg.execute(cls.get_children_ids_query(unit_id, from_date, to_date,
+                                                             after, limit))
         return result.fetchall()
 
     def __init__(self, unit_id, pg: AsyncConnection,
@@ -251,12 +282,35 @@ class ShopCategoryStreamer(ShopUnitStreamer):
         super(ShopCategoryStreamer, self).__init__(unit_id, pg, from_date, to_date, stream_children,
                                                    stream_self)
         self._state = StreamerState.INITIALIZING
-        self._children = []
-        self._children_done = -1
+        # Прочитанные, но ещё не отданные дети текущей страницы
+        self._children_rows = deque()
+        self._children_exhausted = False
+        self._last_child_id = None
+        self._child: ShopUnitStreamer | None = None
         self._price = None
+        self._offers_count = 0
         self._first = True
         self._stream_children = stream_children
 
+    async def has_next_child(self) -> bool:
+        """
+        Проверяет, остались ли неотданные дети, и читает следующую страницу,
+        если текущая закончилась.
+        """
+        if not self._children_rows and not self._children_exhausted:
+            rows = await self.get_children_ids(self._unit_id, self._pg,
+                                               self._from_date, self._to_date,
+                                               after=self._last_child_id,
+                                               limit=self.CHILDREN_PAGE_SIZE)
+
+            self._children_rows.extend(rows)
+            self._children_exhausted = len(rows) < self.CHILDREN_PAGE_SIZE
+
+            if rows:
+                self._last_child_id = rows[-1]['child_id']
+
+        return bool(self._children_rows)
+
     def __aiter__(self):
         return self
 
@@ -269,18 +323,6 @@ class ShopCategoryStreamer(ShopUnitStreamer):
                 if not self_row:
                     raise KeyError
 
-                for child_id, child_type in await self.get_children_ids(self._unit_id, self._pg,
-                                                                        self._from_date,
-                                                                        self._to_date):
-                    self._children.append(
-                        shop_unit_streamer(
-                            child_type, child_id, self._pg,
-                            self._from_date, self._to_date,
-                            self._stream_children,
-                            stream_self=(
-                                self._stream_children and self._stream_self))
-                    )
-
                 self._state = StreamerState.RUNNING
 
                 if self._stream_self:
@@ -294,27 +336,34 @@ class ShopCategoryStreamer(ShopUnitStreamer):
                     return ''
 
             case StreamerState.RUNNING:
-                self._children_done += 1
-
-                if self._children_done == len(self._children):
+                if not await self.has_next_child():
                     self._state = StreamerState.FINALIZING
                     return ''
                 else:
+                    child_id, child_type = self._children_rows.popleft()
+                    self._child = shop_unit_streamer(
+                        child_type, child_id, self._pg,
+                        self._from_date, self._to_date,
+                        self._stream_children,
+                        stream_self=(
+                            self._stream_children and self._stream_self))
+
                     self._state = StreamerState.WAITING_FOR_CHILD
-                    return self._children[self._children_done]
+                    return self._child
 
             case StreamerState.WAITING_FOR_CHILD:
-                child_price = self._children[self._children_done].price
+                child, self._child = self._child, None
 
-                if self._price is None:
-                    self._price = child_price
-                else:
-                    self._price += child_price
+                # У пустой категории нет ни цены, ни товаров
+                if child.price is not None:
+                    self._price = (self._price or 0) + child.price
+                self._offers_count += child.children_count
+                self._date = max(child.date, self._date or child.date)
 
                 self._state = StreamerState.RUNNING
 
                 if self._stream_children and self._stream_self:
-                    if self._children_done != len(self._children) - 1:
+                    if await self.has_next_child():
                         return ', '
                     else:
                         return ''
@@ -327,15 +376,13 @@ class ShopCategoryStreamer(ShopUnitStreamer):
                 self_row = await self.get_unit_record_by_id(self._unit_id, self._pg,
                                                             self._from_date, self._to_date)
 
-                self._date = max(self_row['date'],
-                                 max((child.date for child in self._children),
-                                     default=self_row['date']))
+                self._date = max(self_row['date'], self._date or self_row['date'])
 
                 if self._stream_self:
-                    if not self._children:
+                    if not self._offers_count:
                         price = None
                     else:
-                        price = self._price // self.children_count
+                        price = self._price // self._offers_count
 
                     if not self_row:
                         raise KeyError
@@ -397,6 +444,634 @@ def shop_unit_streamer_from_record(unit_record, pg: AsyncConnection,
                               stream_self=stream_self)
 
 
+class SubtreeNode:
+    """
+    Открытая категория при обходе поддерева.
+    Хранит только то, что нужно для расчёта её цены и даты обновления.
+    """
+    __slots__ = ('record', 'price_sum', 'offers_count', 'date', 'has_children')
+
+    def __init__(self, record: Record):
+        self.record = record
+        self.price_sum = 0
+        self.offers_count = 0
+        self.date = record['date']
+        self.has_children = False
+
+    @property
+    def price(self) -> int | None:
+        if not self.offers_count:
+            return None
+
+        return self.price_sum // self.offers_count
+
+    def add(self, price_sum: int, offers_count: int, date: datetime):
+        self.price_sum += price_sum
+        self.offers_count += offers_count
+        self.date = max(self.date, date)
+
+
+class AggregatedNode(SubtreeNode):
+    """
+    Открытая категория с агрегатами, уже посчитанными в базе.
+    Цены детей к ней не прибавляются: часть детей может быть не загружена.
+    """
+    __slots__ = ()
+
+    def __init__(self, record: Record):
+        super().__init__(record)
+        SubtreeNode.add(self, record['offer_price_sum'], record['offer_count'],
+                        record['last_update'])
+
+    def add(self, price_sum: int, offers_count: int, date: datetime):
+        pass
+
+
+class ShopUnitSubtreeStreamer(AsyncIterable):
+    """
+    Стример поддерева.
+    В отличие от ShopCategoryStreamer, загружает всё поддерево одним рекурсивным запросом,
+    строки которого приходят в порядке обхода в глубину. В памяти держится только
+    цепочка открытых категорий от корня до текущего элемента.
+    Вывод совпадает с тем, что отдаёт do_stream для ShopCategoryStreamer.
+    """
+    NODE_CLASS = SubtreeNode
+
+    @classmethod
+    def get_current_units(cls):
+        return (
+            select([
+                shop_units_current_table.c.revision_id.label('id'),
+                shop_units_current_table.c.id.label('shop_unit_id'),
+                shop_units_current_table.c.name,
+                shop_units_current_table.c.price,
+                shop_units_current_table.c.type,
+                shop_units_current_table.c.date,
+                shop_units_current_table.c.parent_id,
+            ])
+            .subquery('actual_revisions')
+        )
+
+    @classmethod
+    def get_current_unit_query(cls, unit_id):
+        return (
+            select([
+                shop_units_current_table.c.id.label('shop_unit_id'),
+                shop_units_current_table.c.name,
+                shop_units_current_table.c.price,
+                shop_units_current_table.c.type,
+                shop_units_current_table.c.date,
+                shop_units_current_table.c.parent_id,
+                shop_units_current_table.c.offer_price_sum,
+                shop_units_current_table.c.offer_count,
+                shop_units_current_table.c.last_update,
+            ])
+            .where(shop_units_current_table.c.id == unit_id)
+        )
+
+    @classmethod
+    def get_actual_revisions_query(cls, from_date: datetime | None, to_date: datetime | None):
+        query = (
+            select([
+                shop_unit_revisions_table.c.id,
+                shop_unit_revisions_table.c.shop_unit_id,
+                shop_unit_revisions_table.c.name,
+                shop_unit_revisions_table.c.price,
+                shop_unit_revisions_table.c.type,
+                shop_unit_revisions_table.c.date,
+                relations_table.c.parent_id,
+            ])
+            .select_from(
+                shop_unit_revisions_table
+                .join(relations_table,
+                      relations_table.c.child_revision_id == shop_unit_revisions_table.c.id,
+                      isouter=True)
+            )
+            .distinct(shop_unit_revisions_table.c.shop_unit_id)
+            .order_by(shop_unit_revisions_table.c.shop_unit_id,
+                      shop_unit_revisions_table.c.date.desc())
+        )
+
+        if from_date is not None:
+            query = query.where(shop_unit_revisions_table.c.date >= from_date)
+        if to_date is not None:
+            query = query.where(shop_unit_revisions_table.c.date <= to_date)
+
+        return query
+
+    @classmethod
+    def get_subtree_query(cls, unit_id,
+                          from_date: datetime | None,
+                          to_date: datetime | None):
+        # Текущее состояние хранится в shop_units_current, по нему можно идти индексом.
+        # Состояние на произвольный момент приходится собирать из истории ревизий.
+        if from_date is None and to_date is None:
+            actual_revisions = cls.get_current_units()
+        else:
+            actual_revisions = cls.get_actual_revisions_query(from_date, to_date)\
+                .cte('actual_revisions')
+
+        return cls.build_subtree_query(actual_revisions,
+                                       actual_revisions.c.shop_unit_id == unit_id)
+
+    @classmethod
+    def build_subtree_query(cls, actual_revisions, roots_condition):
+        """
+        Обходит поддеревья элементов, выбранных условием roots_condition.
+        Путь начинается с корня, поэтому строки каждого поддерева идут подряд.
+        """
+        subtree = (
+            select([
+                actual_revisions,
+                literal(0).label('depth'),
+                array([actual_revisions.c.shop_unit_id]).label('path'),
+            ])
+            .where(roots_condition)
+            .cte('subtree', recursive=True)
+        )
+
+        subtree = subtree.union_all(
+            select([
+                actual_revisions,
+                subtree.c.depth + 1,
+                func.array_append(subtree.c.path, actual_revisions.c.shop_unit_id),
+            ])
+            .where(actual_revisions.c.parent_id == subtree.c.shop_unit_id)
+        )
+
+        return select([subtree]).order_by(subtree.c.path)
+
+    def __init__(self, unit_id, pg: AsyncConnection,
+                 from_date: datetime | None = None,
+                 to_date: datetime | None = None,
+                 stream_children: bool = True,
+                 prefetch: int = DEFAULT_PG_PREFETCH,
+                 deadline: Deadline = NO_DEADLINE):
+        self._unit_id = unit_id
+        self._pg = pg
+        self._from_date = from_date
+        self._to_date = to_date
+        self._stream_children = stream_children
+        self._prefetch = prefetch
+        self._deadline = deadline
+
+    def subtree_query(self):
+        return self.get_subtree_query(self._unit_id, self._from_date, self._to_date)
+
+    def dump_offer(self, record: Record) -> bytes:
+        data = {
+            'id': record['shop_unit_id'],
+            'name': record['name'],
+            'date': record['date'],
+            'type': record['type'],
+            'price': record['price'],
+            'parentId': record['parent_id'],
+        }
+
+        if self._stream_children:
+            data['children'] = None
+
+        return dumpb(data)
+
+    def dump_category(self, node: SubtreeNode) -> bytes:
+        return dumpb({
+            'id': node.record['shop_unit_id'],
+            'name': node.record['name'],
+            'type': node.record['type'],
+            'parentId': node.record['parent_id'],
+            'price': node.price,
+            'date': node.date,
+        })
+
+    def finalize(self, stack: List[SubtreeNode]) -> Iterable[bytes | memoryview]:
+        node = stack.pop()
+
+        if stack:
+            stack[-1].add(node.price_sum, node.offers_count, node.date)
+
+        if not self._stream_children:
+            if not stack:
+                yield self.dump_category(node)
+            return
+
+        # Поля категории дописываются к уже открытому объекту с детьми,
+        # memoryview отрезает открывающую скобку без копирования
+        yield b'], '
+        yield memoryview(self.dump_category(node))[1:]
+
+    def render(self, records: Iterable[Record],
+               stack: List[SubtreeNode]) -> Iterable[bytes | memoryview]:
+        """
+        Собирает JSON из строк поддерева, упорядоченных по пути от корня.
+        Строки могут приходить несколькими пачками: состояние обхода хранится в stack,
+        а после последней пачки открытые категории закрывает close.
+
+        :param records: Очередная пачка строк запроса get_subtree_query
+        :param stack: Цепочка открытых категорий от корня
+        """
+        for record in records:
+            while len(stack) > record['depth']:
+                yield from self.finalize(stack)
+
+            if stack and self._stream_children:
+                if stack[-1].has_children:
+                    yield b', '
+                stack[-1].has_children = True
+
+            if record['type'] == ShopUnitType.OFFER:
+                if stack:
+                    stack[-1].add(record['price'], 1, record['date'])
+
+                if self._stream_children or not stack:
+                    yield self.dump_offer(record)
+            else:
+                if self._stream_children:
+                    yield b'{"children": ['
+
+                stack.append(self.NODE_CLASS(record))
+
+    def close(self, stack: List[SubtreeNode]) -> Iterable[bytes | memoryview]:
+        while stack:
+            yield from self.finalize(stack)
+
+    async def stream_aggregated(self):
+        """
+        Отдаёт элемент без детей по сохранённым агрегатам, не обходя поддерево.
+        """
+        records = await fetch(self._pg, self.get_current_unit_query(self._unit_id),
+                              self._deadline)
+
+        if not records:
+            raise KeyError
+
+        record = records[0]
+
+        if record['type'] == ShopUnitType.OFFER:
+            yield self.dump_offer(record)
+        else:
+            node = SubtreeNode(record)
+            node.add(record['offer_price_sum'], record['offer_count'], record['last_update'])
+
+            yield self.dump_category(node)
+
+    async def __aiter__(self):
+        if not self._stream_children and self._from_date is None and self._to_date is None:
+            async for chunk in self.stream_aggregated():
+                yield chunk
+            return
+
+        query = self.subtree_query()
+
+        stack: List[SubtreeNode] = []
+        empty = True
+
+        async for records in stream_partitions(self._pg, query, self._prefetch, self._deadline):
+            empty = False
+
+            # Пачка собирается в одну строку, чтобы не писать в сокет по элементу
+            chunk = b''.join(self.render(records, stack))
+            if chunk:
+                yield chunk
+
+        if empty:
+            raise KeyError
+
+        chunk = b''.join(self.close(stack))
+        if chunk:
+            yield chunk
+
+
+class ShopUnitPageStreamer(ShopUnitSubtreeStreamer):
+    """
+    Стример части поддерева для текущего состояния.
+
+    Категории глубже depth не раскрываются: отдаются без детей, с ценой по сохранённым
+    агрегатам и флагом hasChildren, а их потомки не загружаются вовсе. Дети корня отдаются
+    страницами по children_limit штук в порядке id, следующая страница начинается после
+    cursor, а id для неё приходит в nextCursor корня.
+    Цены всех категорий берутся из агрегатов, поэтому не зависят от того, что попало в ответ.
+    """
+    NODE_CLASS = AggregatedNode
+
+    @classmethod
+    def get_page_query(cls, unit_id, depth: int | None = None,
+                       children_limit: int | None = None, cursor: str | None = None):
+        units = shop_units_current_table
+        columns = [
+            units.c.id.label('shop_unit_id'),
+            units.c.name,
+            units.c.price,
+            units.c.type,
+            units.c.date,
+            units.c.parent_id,
+            units.c.offer_price_sum,
+            units.c.offer_count,
+            units.c.last_update,
+        ]
+
+        page = (
+            select(columns)
+            .where(units.c.parent_id == unit_id)
+            .order_by(units.c.id)
+        )
+        if cursor is not None:
+            page = page.where(units.c.id > cursor)
+        if children_limit is not None:
+            # Лишняя строка показывает, что есть следующая страница
+            page = page.limit(children_limit + 1)
+
+        page = page.cte('page')
+        page_rows = select([page]).order_by(page.c.shop_unit_id)
+        if children_limit is not None:
+            page_rows = page_rows.limit(children_limit)
+
+        has_more = literal(False)
+        if children_limit is not None:
+            has_more = select([func.count()]).select_from(page).scalar_subquery() \
+                > children_limit
+
+        root = (
+            select([
+                *columns,
+                literal(0).label('depth'),
+                array([units.c.id]).label('path'),
+                has_more.label('has_more'),
+            ])
+            .where(units.c.id == unit_id)
+        )
+
+        seed = root
+        if depth is None or depth > 0:
+            page_rows = page_rows.subquery('page_rows')
+            seed = select([
+                root.union_all(
+                    select([
+                        page_rows,
+                        literal(1),
+                        array([literal(unit_id), page_rows.c.shop_unit_id]),
+                        literal(False),
+                    ])
+                ).subquery('seed')
+            ])
+
+        subtree = seed.cte('subtree', recursive=True)
+
+        children = (
+            select([
+                *columns,
+                subtree.c.depth + 1,
+                func.array_append(subtree.c.path, units.c.id),
+                literal(False),
+            ])
+            .where(
+                (units.c.parent_id == subtree.c.shop_unit_id)
+                # Дети корня уже выбраны страницей
+                & (subtree.c.depth > 0)
+            )
+        )
+        if depth is not None:
+            children = children.where(subtree.c.depth < depth)
+
+        subtree = subtree.union_all(children)
+
+        # EXISTS в списке полей планировщик превращает в хэш по всей таблице,
+        # подзапрос с LIMIT проверяется по индексу для каждой строки
+        child = shop_units_current_table.alias('child')
+        has_children = (
+            select([literal(True)])
+            .where(child.c.parent_id == subtree.c.shop_unit_id)
+            .limit(1)
+            .scalar_subquery()
+            .isnot(None)
+        )
+
+        return (
+            select([subtree, has_children.label('has_children')])
+            .order_by(subtree.c.path)
+        )
+
+    def __init__(self, unit_id, pg: AsyncConnection,
+                 depth: int | None = None,
+                 children_limit: int | None = None,
+                 cursor: str | None = None,
+                 prefetch: int = DEFAULT_PG_PREFETCH,
+                 deadline: Deadline = NO_DEADLINE):
+        super().__init__(unit_id, pg, stream_children=True, prefetch=prefetch, deadline=deadline)
+        self._depth = depth
+        self._children_limit = children_limit
+        self._cursor = cursor
+
+        self._has_more = False
+        self._last_child_id = cursor
+
+    def subtree_query(self):
+        return self.get_page_query(self._unit_id, self._depth, self._children_limit,
+                                   self._cursor)
+
+    def dump_category(self, node: SubtreeNode) -> bytes:
+        record = node.record
+        data = {
+            'id': record['shop_unit_id'],
+            'name': record['name'],
+            'type': record['type'],
+            'parentId': record['parent_id'],
+            'price': node.price,
+            'date': node.date,
+            'hasChildren': record['has_children'],
+        }
+
+        if record['depth'] == 0 and self._children_limit is not None \
+                and record['depth'] != self._depth:
+            data['nextCursor'] = self._last_child_id if self._has_more else None
+
+        return dumpb(data)
+
+    def render(self, records: Iterable[Record],
+               stack: List[SubtreeNode]) -> Iterable[bytes | memoryview]:
+        for record in records:
+            if record['depth'] == 0:
+                self._has_more = record['has_more']
+            elif record['depth'] == 1:
+                self._last_child_id = record['shop_unit_id']
+
+            if record['type'] == ShopUnitType.OFFER or record['depth'] != self._depth:
+                yield from super().render((record,), stack)
+                continue
+
+            # Категория на последнем уровне отдаётся целиком, без списка детей
+            while len(stack) > record['depth']:
+                yield from self.finalize(stack)
+
+            if stack:
+                if stack[-1].has_children:
+                    yield b', '
+                stack[-1].has_children = True
+
+            yield self.dump_category(AggregatedNode(record))
+
+
+class ShopUnitBatchStreamer(ShopUnitSubtreeStreamer):
+    """
+    Стример нескольких поддеревьев в одном объекте JSON с ключами по id.
+
+    Поддеревья загружаются в одной транзакции, по рекурсивному запросу на каждый корень:
+    с одним корнем обход идёт по индексу parent_id, а общий запрос для нескольких корней
+    планировщик может выполнить полным чтением таблицы. Если запрошенный элемент лежит
+    в поддереве другого запрошенного, отдельно он не обходится: его фрагмент копируется
+    при отрисовке предка и дописывается в ответ после него. Ненайденным id соответствует null.
+    """
+    @classmethod
+    def get_roots_query(cls, unit_ids: List[str]):
+        """
+        Находит существующие элементы из unit_ids и для каждого отмечает,
+        есть ли среди его предков другой запрошенный элемент.
+        """
+        ancestors = (
+            select([
+                shop_units_current_table.c.id.label('unit_id'),
+                shop_units_current_table.c.parent_id,
+                array([shop_units_current_table.c.id]).label('path'),
+            ])
+            .where(shop_units_current_table.c.id.in_(unit_ids))
+            .cte('ancestors', recursive=True)
+        )
+
+        # Путь защищает от зацикливания, как и при обходе предков для агрегатов
+        ancestors = ancestors.union_all(
+            select([
+                ancestors.c.unit_id,
+                shop_units_current_table.c.parent_id,
+                func.array_append(ancestors.c.path, shop_units_current_table.c.id),
+            ])
+            .where(
+                (shop_units_current_table.c.id == ancestors.c.parent_id)
+                & (shop_units_current_table.c.id != func.all(ancestors.c.path))
+            )
+        )
+
+        return (
+            select([
+                ancestors.c.unit_id.label('id'),
+                func.bool_or(ancestors.c.parent_id.in_(unit_ids)).label('nested'),
+            ])
+            .group_by(ancestors.c.unit_id)
+        )
+
+    def __init__(self, unit_ids: Iterable[str], pg: AsyncConnection,
+                 prefetch: int = DEFAULT_PG_PREFETCH,
+                 deadline: Deadline = NO_DEADLINE):
+        super().__init__(None, pg, stream_children=True, prefetch=prefetch, deadline=deadline)
+
+        # Порядок запрошенных id сохраняется, повторы отбрасываются
+        self._unit_ids = list(dict.fromkeys(unit_ids))
+        self._nested: set[str] = set()
+        self._first_key = True
+
+        # Открытые копии фрагментов вложенных элементов и уже собранные фрагменты
+        self._captures: List[tuple[SubtreeNode, str, bytearray]] = []
+        self._captured: dict[str, bytes] = {}
+
+    def key(self, unit_id: str) -> bytes:
+        prefix = b'' if self._first_key else b', '
+        self._first_key = False
+
+        return prefix + dumpb(unit_id) + b': '
+
+    def flush_captured(self) -> Iterable[bytes]:
+        for unit_id, chunk in self._captured.items():
+            yield self.key(unit_id)
+            yield chunk
+
+        self._captured.clear()
+
+    def finalize(self, stack: List[SubtreeNode]) -> Iterable[bytes | memoryview]:
+        node = stack[-1]
+
+        yield from super().finalize(stack)
+
+        if self._captures and self._captures[-1][0] is node:
+            _, unit_id, buffer = self._captures.pop()
+            self._captured[unit_id] = bytes(buffer)
+
+    def render_record(self, record: Record,
+                      stack: List[SubtreeNode]) -> Iterable[bytes | memoryview]:
+        while len(stack) > record['depth']:
+            yield from self.finalize(stack)
+
+        unit_id = record['shop_unit_id']
+
+        if not stack:
+            yield from self.flush_captured()
+            yield self.key(unit_id)
+        else:
+            if stack[-1].has_children:
+                yield b', '
+            stack[-1].has_children = True
+
+        if record['type'] == ShopUnitType.OFFER:
+            if stack:
+                stack[-1].add(record['price'], 1, record['date'])
+
+            chunk = self.dump_offer(record)
+            if stack and unit_id in self._nested:
+                self._captured[unit_id] = chunk
+
+            yield chunk
+        else:
+            node = SubtreeNode(record)
+            stack.append(node)
+
+            if len(stack) > 1 and unit_id in self._nested:
+                self._captures.append((node, unit_id, bytearray()))
+
+            yield b'{"children": ['
+
+    def capture(self, chunks: Iterable[bytes | memoryview]) -> Iterable[bytes | memoryview]:
+        for chunk in chunks:
+            # Фрагмент попадает во все открытые копии, в том числе в начатую им самим
+            for _, _, buffer in self._captures:
+                buffer.extend(chunk)
+
+            yield chunk
+
+    def render(self, records: Iterable[Record],
+               stack: List[SubtreeNode]) -> Iterable[bytes | memoryview]:
+        for record in records:
+            yield from self.capture(self.render_record(record, stack))
+
+    def close(self, stack: List[SubtreeNode]) -> Iterable[bytes | memoryview]:
+        yield from self.capture(super().close(stack))
+        yield from self.flush_captured()
+
+    async def __aiter__(self):
+        yield b'{'
+
+        rows = await fetch(self._pg, self.get_roots_query(self._unit_ids), self._deadline)
+        found = {row['id'] for row in rows}
+        self._nested = {row['id'] for row in rows if row['nested']}
+        roots = sorted(unit_id for unit_id in found if unit_id not in self._nested)
+
+        stack: List[SubtreeNode] = []
+
+        for unit_id in roots:
+            query = self.get_subtree_query(unit_id, None, None)
+            async for records in stream_partitions(self._pg, query, self._prefetch,
+                                                   self._deadline):
+                chunk = b''.join(self.render(records, stack))
+                if chunk:
+                    yield chunk
+
+        chunk = b''.join(self.close(stack))
+        if chunk:
+            yield chunk
+
+        missing = b''.join(
+            self.key(unit_id) + b'null' for unit_id in self._unit_ids if unit_id not in found
+        )
+
+        yield missing + b'}'
+
+
 async def do_stream(streamer: ShopUnitStreamer) -> AsyncIterable[str]:
     """
     Осуществляет стриминг.
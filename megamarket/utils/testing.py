@@ -8,8 +8,11 @@ from http import HTTPStatus
 
 from aiohttp.test_utils import TestClient
 from aiohttp.web_urldispatcher import DynamicResource
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
 
-from megamarket.api.handlers import ImportsView, NodeView, NodesView, DeleteView, SalesView
+from megamarket.api.handlers import ImportsView, NodeView, NodesView, DeleteView, SalesView, \
+    NodesBatchView
 from megamarket.api.schema import DATETIME_FORMAT, ShopUnitSchema, ShopUnitStatisticResponseSchema
 
 COMPANIES = [
@@ -310,6 +313,30 @@ async def get_unit(
         return data
 
 
+async def get_units_batch(
+        client: TestClient,
+        unit_ids: list[str],
+        expected_status: int | EnumMeta = HTTPStatus.OK,
+        **request_kwargs
+):
+    response = await client.post(
+        NodesBatchView.URL_PATH,
+        json={'ids': unit_ids},
+        **request_kwargs
+    )
+
+    assert response.status == expected_status
+
+    if expected_status == HTTPStatus.OK:
+        data = await response.json()
+
+        for unit in data.values():
+            if unit is not None:
+                assert not ShopUnitSchema().validate(unit)
+
+        return data
+
+
 async def get_sales(
         client: TestClient,
         date: datetime.datetime | None = None,
@@ -605,3 +632,60 @@ def normalize_response_units(units: list[dict | ResponseUnit]) -> list:
 
 def compare_unit_lists(left: list, right: list):
     return normalize_response_units(left) == normalize_response_units(right)
+
+
+# Категория c-i вложена в c-(i / 10), товар o-i лежит в c-(i % categories + 1).
+# Ревизии товара o-i идут с разницей в час начиная с base_date + (i % days) дней
+SEED_CATALOG = """
+INSERT INTO shop_unit_ids (id)
+SELECT 'c-' || i FROM generate_series(1, :categories) i
+UNION ALL
+SELECT 'o-' || i FROM generate_series(1, :offers) i;
+
+INSERT INTO shop_unit_revisions (date, shop_unit_id, name, price, type)
+SELECT :base_date, 'c-' || i, 'c-' || i, NULL, 'CATEGORY'
+FROM generate_series(1, :categories) i;
+
+INSERT INTO shop_unit_revisions (date, shop_unit_id, name, price, type)
+SELECT
+    :base_date + (i % :days) * INTERVAL '1 day' + r * INTERVAL '1 hour',
+    'o-' || i, 'o-' || i, i * 10 + r, 'OFFER'
+FROM generate_series(1, :offers) i, generate_series(1, :revisions) r;
+
+INSERT INTO relations (child_revision_id, parent_id)
+SELECT id, 'c-' || (substr(shop_unit_id, 3)::int / 10)
+FROM shop_unit_revisions
+WHERE type = 'CATEGORY' AND substr(shop_unit_id, 3)::int >= 10;
+
+INSERT INTO relations (child_revision_id, parent_id)
+SELECT id, 'c-' || (substr(shop_unit_id, 3)::int % :categories + 1)
+FROM shop_unit_revisions
+WHERE type = 'OFFER';
+
+INSERT INTO shop_units_current (id, revision_id, name, price, type, parent_id, date,
+                                offer_price_sum, offer_count, last_update)
+SELECT DISTINCT ON (sur.shop_unit_id)
+    sur.shop_unit_id, sur.id, sur.name, sur.price, sur.type, relations.parent_id, sur.date,
+    COALESCE(sur.price, 0), CASE WHEN sur.type = 'OFFER' THEN 1 ELSE 0 END, sur.date
+FROM
+    shop_unit_revisions sur
+    LEFT JOIN relations ON relations.child_revision_id = sur.id
+ORDER BY sur.shop_unit_id, sur.date DESC;
+
+ANALYZE;
+"""
+
+
+def seed_catalog(conn: Connection, categories: int, offers: int, revisions: int,
+                 base_date: datetime.datetime, days: int = 1):
+    """
+    Быстро наполняет базу каталогом с историей, минуя обработчики API.
+    Агрегаты категорий при этом не пересчитываются.
+    """
+    conn.execute(text(SEED_CATALOG), {
+        'categories': categories,
+        'offers': offers,
+        'revisions': revisions,
+        'base_date': base_date,
+        'days': days,
+    })
@@ -0,0 +1,116 @@
+"""
+Запуск API в нескольких процессах.
+Сокет открывается один раз в главном процессе и наследуется воркерами при fork,
+так что соединения между ними распределяет ядро. Каждый воркер создаёт своё
+приложение и свой пул соединений с базой, главный процесс только следит за ними.
+"""
+
+import logging
+import os
+import signal
+import time
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+from typing import Callable
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RESTART_DELAY = 1
+DEFAULT_SHUTDOWN_TIMEOUT = 30
+
+
+def run_worker(target: Callable[[int], None], index: int):
+    # Обработчики главного процесса наследуются при fork, воркер ставит свои
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+    target(index)
+
+
+class WorkerPool:
+    """
+    Запускает workers процессов с target(index) и перезапускает упавшие.
+    После stop воркеры получают SIGTERM, на который aiohttp штатно завершает
+    обработку запросов. Не успевшие за shutdown_timeout секунд воркеры убиваются.
+    """
+    def __init__(self, target: Callable[[int], None], workers: int,
+                 restart_delay: float = DEFAULT_RESTART_DELAY,
+                 shutdown_timeout: float = DEFAULT_SHUTDOWN_TIMEOUT):
+        self._target = target
+        self._workers = workers
+        self._restart_delay = restart_delay
+        self._shutdown_timeout = shutdown_timeout
+
+        self._context = get_context('fork')
+        self._processes: dict[int, BaseProcess] = {}
+        self._stopping = False
+
+        # stop может прийти из обработчика сигнала или другого потока, пока run ждёт
+        # завершения воркеров. Запись в канал будит wait, иначе он ждал бы выхода воркера
+        self._wakeup_read, self._wakeup_write = os.pipe()
+
+    def _start(self, index: int):
+        process = self._context.Process(target=run_worker, args=(self._target, index),
+                                        name=f'worker-{index}')
+        process.start()
+
+        self._processes[index] = process
+        log.info('Started worker %d with pid %d', index, process.pid)
+
+    def stop(self, *_):
+        self._stopping = True
+
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+
+        os.write(self._wakeup_write, b'\0')
+
+    def run(self):
+        try:
+            self._supervise()
+        finally:
+            self._shutdown()
+
+    def _supervise(self):
+        for index in range(self._workers):
+            if not self._stopping:
+                self._start(index)
+
+        while not self._stopping:
+            sentinels = {process.sentinel: index for index, process in self._processes.items()}
+
+            for sentinel in wait([*sentinels, self._wakeup_read]):
+                if sentinel == self._wakeup_read:
+                    break
+
+                index = sentinels[sentinel]
+                process = self._processes[index]
+                process.join()
+
+                if self._stopping:
+                    continue
+
+                log.warning('Worker %d exited with code %s, restarting',
+                            index, process.exitcode)
+
+                # Задержка не даёт воркеру, падающему при старте, занять весь процессор
+                time.sleep(self._restart_delay)
+                if not self._stopping:
+                    self._start(index)
+
+    def _shutdown(self):
+        # Воркеры, запущенные между stop и выходом из цикла, тоже получают SIGTERM
+        for process in self._processes.values():
+            if process.is_alive():
+                process.terminate()
+
+        deadline = time.monotonic() + self._shutdown_timeout
+        for index, process in self._processes.items():
+            process.join(max(deadline - time.monotonic(), 0))
+
+            if process.is_alive():
+                log.warning('Worker %d did not stop in time, killing', index)
+                process.kill()
+                process.join()
@@ -4,6 +4,7 @@ from sqlalchemy import create_engine
 
 from megamarket.api.__main__ import parser
 from megamarket.api.app import create_app
+from megamarket.api.middleware import StatsAccessLogger
 
 
 @pytest.fixture
@@ -28,7 +29,8 @@ def arguments(aiomisc_unused_port, migrated_postgres):
 @pytest.fixture
 async def api_server(arguments, aiohttp_server):
     app = create_app(arguments)
-    server = await aiohttp_server(app, port=arguments.api_port)
+    server = await aiohttp_server(app, port=arguments.api_port,
+                                  access_log_class=StatsAccessLogger)
 
     try:
         yield server
@@ -0,0 +1,75 @@
+import asyncio
+from datetime import datetime
+from http import HTTPStatus
+
+import pytest
+from asyncpg import QueryCanceledError
+from aiohttp import ClientPayloadError
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from megamarket.api.handlers import SalesView
+from megamarket.api.schema import DATETIME_FORMAT
+from megamarket.utils.deadline import Deadline, DeadlineExceeded
+from megamarket.utils.pg import read_transaction, fetch
+from megamarket.utils.testing import generate_category, import_data, get_unit, \
+    get_node_statistic
+
+SLEEP_QUERY = text('SELECT pg_sleep(5)')
+
+
+@pytest.fixture(params=[False, True], ids=['engine', 'raw-pool'])
+def arguments(arguments, request):
+    arguments.pg_raw_pool = request.param
+    return arguments
+
+
+async def test_deadline_wait():
+    deadline = Deadline(0.05)
+
+    with pytest.raises(DeadlineExceeded):
+        await deadline.wait(asyncio.sleep(5))
+
+    assert deadline.remaining() == 0
+    assert deadline.statement_timeout() == 1
+
+
+async def test_statement_timeout(api_server):
+    pg = api_server.app['pg_pool'] or api_server.app['pg']
+
+    # Сам запрос не ограничен на стороне клиента, его прерывает Postgres
+    with pytest.raises(DeadlineExceeded) as exc_info:
+        async with read_transaction(pg, Deadline(0.2)) as conn:
+            await fetch(conn, SLEEP_QUERY)
+
+    assert isinstance(exc_info.value.__cause__, (DBAPIError, QueryCanceledError))
+
+    # SET LOCAL действует только до конца транзакции
+    async with read_transaction(pg) as conn:
+        await fetch(conn, text('SELECT pg_sleep(0.3)'))
+
+
+async def test_gateway_timeout(api_client, api_server):
+    await import_data(api_client, [generate_category(unit_id='c-1')])
+
+    api_server.app['timeouts'] = dict.fromkeys(api_server.app['timeouts'], 1e-6)
+
+    await get_unit(api_client, 'c-1', expected_status=HTTPStatus.GATEWAY_TIMEOUT)
+    await get_node_statistic(api_client, 'c-1', expected_status=HTTPStatus.GATEWAY_TIMEOUT)
+
+    # Соединения, взятые до истечения срока, вернулись в пул
+    api_server.app['timeouts'] = dict.fromkeys(api_server.app['timeouts'], 10)
+    await get_unit(api_client, 'c-1')
+
+
+async def test_stream_aborted(api_client, api_server):
+    api_server.app['timeouts']['sales'] = 1e-6
+
+    # /sales начинает читать базу уже после отправки заголовков,
+    # поэтому вместо 504 клиент получает оборванный ответ
+    response = await api_client.get(SalesView.URL_PATH,
+                                    params={'date': datetime.now().strftime(DATETIME_FORMAT)})
+    assert response.status == HTTPStatus.OK
+
+    with pytest.raises(ClientPayloadError):
+        await response.read()
@@ -1,6 +1,8 @@
+from datetime import datetime, timedelta
 from http import HTTPStatus
 
-from megamarket.utils.testing import import_data, generate_offer, delete_unit
+from megamarket.utils.testing import import_data, generate_offer, delete_unit, generate_category, \
+    get_unit
 
 
 async def test_delete(api_client):
@@ -9,3 +11,21 @@ async def test_delete(api_client):
     await delete_unit(api_client, '1', HTTPStatus.OK)
 
     await delete_unit(api_client, '1', HTTPStatus.NOT_FOUND)
+
+
+async def test_delete_children(api_client):
+    date = datetime.now()
+
+    await import_data(api_client, [
+        generate_category(unit_id='c-1'),
+        generate_category(unit_id='c-2', parent_id='c-1'),
+        generate_offer(unit_id='o-1', parent_id='c-2'),
+        generate_offer(unit_id='o-2', parent_id='c-1'),
+    ], date - timedelta(hours=1))
+    await import_data(api_client, [generate_offer(unit_id='o-2')], date)
+
+    await delete_unit(api_client, 'c-1', HTTPStatus.OK)
+
+    await get_unit(api_client, 'c-2', HTTPStatus.NOT_FOUND)
+    await get_unit(api_client, 'o-1', HTTPStatus.NOT_FOUND)
+    await get_unit(api_client, 'o-2', HTTPStatus.OK)
@@ -3,9 +3,10 @@ from http import HTTPStatus
 
 import pytest
 
+from megamarket.api.handlers import ImportsView
 from megamarket.utils.pg import MAX_INTEGER
 from megamarket.utils.testing import generate_offer, generate_category, generate_shop_units, \
-    import_data
+    import_data, get_unit, get_node_statistic
 
 LONGEST_STR = 'ё' * 256
 CASES = [
@@ -60,11 +61,30 @@ CASES = [
         ],
         HTTPStatus.BAD_REQUEST
     ),
+
+    (
+        [
+            generate_category(unit_id='category-1', parent_id='category-2'),
+            generate_category(unit_id='category-2', parent_id='category-1'),
+        ],
+        HTTPStatus.BAD_REQUEST
+    ),
+
+    # Ошибка в элементе списка приходит с числовым ключом
+    (
+        [
+            generate_offer(unit_id='offer-1', price=-1),
+        ],
+        HTTPStatus.BAD_REQUEST
+    ),
 ]
 
 
+@pytest.mark.parametrize('min_units_to_copy', [ImportsView.MIN_UNITS_TO_COPY, 1])
 @pytest.mark.parametrize('units,expected_status', CASES)
-async def test_imports(api_client, units, expected_status):
+async def test_imports(api_client, monkeypatch, units, expected_status, min_units_to_copy):
+    monkeypatch.setattr(ImportsView, 'MIN_UNITS_TO_COPY', min_units_to_copy)
+
     await import_data(
         api_client,
         units,
@@ -79,3 +99,67 @@ async def test_future_request(api_client):
         date=datetime.datetime(2030, 1, 1),
         expected_status=HTTPStatus.BAD_REQUEST,
     )
+
+
+@pytest.mark.parametrize('min_units_to_copy', [ImportsView.MIN_UNITS_TO_COPY, 1])
+async def test_type_change(api_client, monkeypatch, min_units_to_copy):
+    monkeypatch.setattr(ImportsView, 'MIN_UNITS_TO_COPY', min_units_to_copy)
+
+    await import_data(api_client, [
+        generate_category(unit_id='category-1'),
+        generate_offer(unit_id='offer-1', parent_id='category-1'),
+    ])
+
+    await import_data(
+        api_client,
+        [generate_offer(unit_id='offer-2'), generate_offer(unit_id='category-1')],
+        expected_status=HTTPStatus.BAD_REQUEST,
+    )
+    await import_data(
+        api_client,
+        [generate_category(unit_id='category-2'),
+         generate_offer(unit_id='offer-3', parent_id='offer-1')],
+        expected_status=HTTPStatus.BAD_REQUEST,
+    )
+
+
+@pytest.mark.parametrize('min_units_to_copy', [ImportsView.MIN_UNITS_TO_COPY, 1])
+async def test_parent_cycle(api_client, monkeypatch, min_units_to_copy):
+    monkeypatch.setattr(ImportsView, 'MIN_UNITS_TO_COPY', min_units_to_copy)
+
+    await import_data(api_client, [
+        generate_category(unit_id='category-1'),
+        generate_category(unit_id='category-2', parent_id='category-1'),
+    ])
+
+    await import_data(
+        api_client,
+        [generate_category(unit_id='category-1', parent_id='category-2')],
+        expected_status=HTTPStatus.BAD_REQUEST,
+    )
+
+
+@pytest.mark.parametrize('min_units_to_copy', [ImportsView.MIN_UNITS_TO_COPY, 1])
+async def test_backdated_import(api_client, monkeypatch, min_units_to_copy):
+    monkeypatch.setattr(ImportsView, 'MIN_UNITS_TO_COPY', min_units_to_copy)
+
+    date = datetime.datetime(2022, 2, 2, 12)
+
+    await import_data(api_client, [
+        generate_category(unit_id='category-1'),
+        generate_category(unit_id='category-2'),
+        generate_offer(unit_id='offer-1', parent_id='category-2'),
+    ], date=date)
+
+    # Ревизия задним числом привязывается к своему родителю, текущее состояние не меняется
+    await import_data(
+        api_client,
+        [generate_offer(unit_id='offer-1', parent_id='category-1')],
+        date=date - datetime.timedelta(days=1),
+    )
+
+    unit = await get_unit(api_client, 'offer-1')
+    assert unit['parentId'] == 'category-2'
+
+    statistic = await get_node_statistic(api_client, 'offer-1')
+    assert sorted(item['parentId'] for item in statistic) == ['category-1', 'category-2']
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import re
+
+import pytest
+
+from megamarket.utils.testing import generate_category, generate_offer, import_data, get_unit, \
+    get_sales
+
+UNITS = [
+    generate_category(unit_id='c-1'),
+    generate_category(unit_id='c-2', parent_id='c-1'),
+    generate_offer(unit_id='o-1', parent_id='c-2', price=100),
+]
+
+
+@pytest.fixture(params=[False, True], ids=['engine', 'raw-pool'])
+def arguments(arguments, request):
+    arguments.pg_raw_pool = request.param
+    return arguments
+
+
+async def wait_access_record(caplog, path: str) -> logging.LogRecord:
+    # Запись появляется после отправки ответа, клиент может прочитать его раньше
+    for _ in range(100):
+        for record in caplog.records:
+            if record.name == 'aiohttp.access' and getattr(record, 'path', None) == path:
+                return record
+
+        await asyncio.sleep(0.01)
+
+    raise AssertionError(f'No access log record for {path}')
+
+
+async def test_server_timing(api_client):
+    await import_data(api_client, UNITS)
+
+    response = await api_client.get('/nodes/c-1')
+    await response.read()
+
+    server_timing = response.headers['Server-Timing']
+    match = re.fullmatch(r'handler;dur=[\d.]+, db;dur=[\d.]+;desc="(\d+) queries"',
+                         server_timing)
+
+    # Версия поддерева читается до отправки заголовков
+    assert match
+    assert int(match.group(1)) > 0
+
+
+async def test_access_log(api_client, caplog, monkeypatch):
+    # Конфигурация логов alembic при миграции отключает уже созданные логгеры
+    monkeypatch.setattr(logging.getLogger('aiohttp.access'), 'disabled', False)
+    caplog.set_level(logging.INFO, logger='aiohttp.access')
+
+    await import_data(api_client, UNITS)
+    await get_unit(api_client, 'c-1')
+    await get_sales(api_client)
+
+    for path in ('/nodes/c-1', '/sales'):
+        record = await wait_access_record(caplog, path)
+
+        # В лог попадают и запросы потоковой отдачи, сделанные после заголовков
+        assert record.status == 200
+        assert record.queries >= 2
+        assert record.db_time > 0
+        assert record.bytes_streamed > 0
+        assert 0 < record.ttfb <= record.request_time
+        assert record.handler_time <= record.request_time
@@ -0,0 +1,96 @@
+import asyncio
+from http import HTTPStatus
+
+from megamarket.api.handlers import MetricsView
+from megamarket.utils.metrics import Registry, Counter, Gauge, Histogram
+from megamarket.utils.testing import generate_category, generate_offer, import_data, get_unit
+
+UNITS = [
+    generate_category(unit_id='c-1'),
+    generate_offer(unit_id='o-1', parent_id='c-1', price=100),
+]
+
+
+def parse(text: str) -> dict[str, float]:
+    return {
+        name: float(value)
+        for name, value in (line.rsplit(' ', 1) for line in text.splitlines())
+        if not name.startswith('#')
+    }
+
+
+def test_registry():
+    registry = Registry()
+    counter = registry.register(Counter('c_total', 'Counter', labels=('a',)))
+    registry.register(Gauge('g', 'Gauge', collect=lambda: [((), 7)]))
+    histogram = registry.register(Histogram('h', 'Histogram', labels=('a',), buckets=(1, 10)))
+
+    counter.inc('x"y')
+    counter.inc('x"y', amount=2)
+    histogram.observe(1, 'x')
+    histogram.observe(5, 'x')
+    histogram.observe(50, 'x')
+
+    assert registry.render().splitlines() == [
+        '# HELP c_total Counter',
+        '# TYPE c_total counter',
+        'c_total{a="x\\"y"} 3',
+        '# HELP g Gauge',
+        '# TYPE g gauge',
+        'g 7',
+        '# HELP h Histogram',
+        '# TYPE h histogram',
+        'h_bucket{a="x",le="1"} 1',
+        'h_bucket{a="x",le="10"} 2',
+        'h_bucket{a="x",le="+Inf"} 3',
+        'h_sum{a="x"} 56.0',
+        'h_count{a="x"} 3',
+    ]
+
+
+def test_registry_const_labels():
+    registry = Registry({'worker': '1'})
+    registry.register(Gauge('g', 'Gauge', collect=lambda: [((), 7)]))
+    histogram = registry.register(Histogram('h', 'Histogram', labels=('a',), buckets=(1,)))
+    histogram.observe(1, 'x')
+
+    assert [line for line in registry.render().splitlines() if not line.startswith('#')] == [
+        'g{worker="1"} 7',
+        'h_bucket{worker="1",a="x",le="1"} 1',
+        'h_bucket{worker="1",a="x",le="+Inf"} 1',
+        'h_sum{worker="1",a="x"} 1.0',
+        'h_count{worker="1",a="x"} 1',
+    ]
+
+
+async def test_metrics(api_client):
+    await import_data(api_client, UNITS)
+    await get_unit(api_client, 'c-1')
+    await get_unit(api_client, 'c-2', expected_status=HTTPStatus.NOT_FOUND)
+
+    # Задача запроса завершается уже после того, как клиент прочитал ответ
+    await asyncio.sleep(0.1)
+
+    response = await api_client.get(MetricsView.URL_PATH)
+    assert response.status == HTTPStatus.OK
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+
+    metrics = parse(await response.text())
+
+    route = '/nodes/{id}'
+    assert metrics[f'megamarket_request_duration_seconds_count'
+                   f'{{method="GET",route="{route}",status="200"}}'] == 1
+    assert metrics[f'megamarket_request_duration_seconds_count'
+                   f'{{method="GET",route="{route}",status="404"}}'] == 1
+    assert metrics[f'megamarket_response_stream_bytes_count{{route="{route}"}}'] == 1
+
+    # Считается и сам запрос /metrics
+    assert metrics['megamarket_requests_in_flight'] == 1
+
+    assert metrics['megamarket_import_batch_units_count'] == 1
+    assert metrics['megamarket_import_units_total'] == len(UNITS)
+    assert metrics['megamarket_import_rows_per_second'] > 0
+
+    assert metrics['megamarket_db_pool_checked_out{database="primary",driver="sqlalchemy"}'] == 0
+    assert metrics['megamarket_db_pool_overflow{database="primary"}'] == 0
+    assert metrics['megamarket_nodes_cache_misses_total'] == 1
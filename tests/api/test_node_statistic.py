@@ -1,11 +1,15 @@
 import datetime
+import json
 from http import HTTPStatus
 
 import pytest
 
+from megamarket.api.handlers.node import GetNodeStatistic, NodeView
 from megamarket.utils.testing import generate_offer, generate_response_offer, import_data, \
     get_node_statistic, \
-    compare_unit_lists, generate_category, generate_response_category
+    compare_unit_lists, generate_category, generate_response_category, url_for
+from megamarket.utils.streamers import ShopUnitStreamer, shop_unit_streamer_from_record, \
+    do_stream
 
 date = datetime.datetime.now()
 
@@ -119,3 +123,91 @@ async def test_node_statistic(api_client, unit_id, unit_groups, expected_units):
 
 async def test_404_error(api_client):
     await get_node_statistic(api_client, '-', None, None, HTTPStatus.NOT_FOUND)
+
+
+MOVES_HISTORY = [
+    (
+        [
+            generate_category(unit_id='c-1', name='c-1'),
+            generate_category(unit_id='c-2', name='c-2', parent_id='c-1'),
+            generate_offer(unit_id='o-1', name='o-1', parent_id='c-2', price=100),
+            generate_offer(unit_id='o-2', name='o-2', price=50),
+        ],
+        date - datetime.timedelta(hours=4)
+    ),
+    (
+        [generate_offer(unit_id='o-2', name='o-2', parent_id='c-1', price=60)],
+        date - datetime.timedelta(hours=3)
+    ),
+    (
+        [generate_category(unit_id='c-2', name='c-2')],
+        date - datetime.timedelta(hours=2)
+    ),
+    (
+        [generate_offer(unit_id='o-1', name='o-1', parent_id='c-2', price=200)],
+        date - datetime.timedelta(hours=1)
+    ),
+]
+
+
+@pytest.mark.parametrize('unit_id,date_end,expected_hours', [
+    ('c-1', None, [4, 3]),
+    ('c-1', date - datetime.timedelta(hours=3), [4, 3]),
+    ('c-2', None, [4, 2, 1]),
+    ('o-2', None, [4, 3]),
+])
+async def test_moves_history(api_client, api_server, unit_id, date_end, expected_hours):
+    for units, group_date in MOVES_HISTORY:
+        await import_data(api_client, units, date=group_date)
+
+    resp = await get_node_statistic(api_client, unit_id, None, date_end)
+
+    expected_units = []
+    async with api_server.app['pg'].begin() as conn:
+        for hours in expected_hours:
+            update_date = date - datetime.timedelta(hours=hours)
+            record = await ShopUnitStreamer.get_unit_record_by_id(unit_id, conn, None, update_date)
+            streamer = shop_unit_streamer_from_record(record, conn, None, update_date,
+                                                      stream_children=False)
+            expected_units.append(json.loads(''.join([
+                chunk async for chunk in do_stream(streamer)
+            ])))
+
+    assert resp == expected_units
+
+    query = GetNodeStatistic(unit_id, api_server.app['pg'], to_date=date_end, prefetch=1)
+    chunks = [chunk async for chunk in query]
+
+    assert json.loads(b''.join(chunks))['items'] == resp
+
+
+async def test_conditional_get(api_client):
+    for units, group_date in MOVES_HISTORY:
+        await import_data(api_client, units, date=group_date)
+
+    url = url_for(NodeView.URL_PATH, id='c-1')
+
+    response = await api_client.get(url)
+    etag = response.headers['ETag']
+    items = (await response.json())['items']
+
+    response = await api_client.get(url, headers={'If-None-Match': etag})
+    assert response.status == HTTPStatus.NOT_MODIFIED
+
+    # Импорт вне поддерева и его истории тег не меняет
+    await import_data(api_client, [
+        generate_offer(unit_id='x-1', name='x-1', price=1),
+    ], date=date)
+
+    response = await api_client.get(url, headers={'If-None-Match': etag})
+    assert response.status == HTTPStatus.NOT_MODIFIED
+
+    # o-1 давно не лежит в c-1, но новая ревизия задним числом меняет его историю
+    await import_data(api_client, [
+        generate_offer(unit_id='o-1', name='o-1', parent_id='c-2', price=300),
+    ], date=date - datetime.timedelta(hours=3, minutes=30))
+
+    response = await api_client.get(url, headers={'If-None-Match': etag})
+    assert response.status == HTTPStatus.OK
+    assert response.headers['ETag'] != etag
+    assert (await response.json())['items'] != items
@@ -1,11 +1,20 @@
+import json
 from datetime import datetime, timedelta
 from http import HTTPStatus
 
 import pytest
 
+from megamarket.api.handlers import ImportsView, NodesView
+from megamarket.api.handlers.nodes import GetShopUnitQuery
+from megamarket.utils.cache import SubtreeCache
+from megamarket.utils.pg import DEFAULT_PG_PREFETCH
 from megamarket.utils.testing import (
     generate_offer, generate_response_offer, get_unit, import_data,
-    generate_category, generate_response_category, compare_units
+    generate_category, generate_response_category, compare_units, delete_unit, url_for
+)
+from megamarket.utils.streamers import (
+    ShopCategoryStreamer, ShopUnitStreamer, ShopUnitSubtreeStreamer,
+    shop_unit_streamer_from_record, do_stream
 )
 
 date = datetime.now()
@@ -101,8 +110,12 @@ CASES = [
 ]
 
 
+@pytest.mark.parametrize('min_units_to_copy', [ImportsView.MIN_UNITS_TO_COPY, 1])
 @pytest.mark.parametrize('offer_id,units,expected_unit', CASES)
-async def test_get_nodes(api_client, offer_id, units, expected_unit):
+async def test_get_nodes(api_client, monkeypatch, offer_id, units, expected_unit,
+                         min_units_to_copy):
+    monkeypatch.setattr(ImportsView, 'MIN_UNITS_TO_COPY', min_units_to_copy)
+
     await import_data(api_client, units, date=date)
 
     resp = await get_unit(api_client, offer_id)
@@ -126,3 +139,225 @@ async def test_node_update(api_client):
     resp = await get_unit(api_client, '1')
 
     assert compare_units(expected_unit, resp)
+
+
+SUBTREE_UNITS = [
+    generate_category(unit_id='c-1', name='c-1'),
+    generate_category(unit_id='c-2', name='c-2', parent_id='c-1'),
+    generate_category(unit_id='c-3', name='c-3', parent_id='c-1'),
+    generate_category(unit_id='c-4', name='c-4', parent_id='c-3'),
+    generate_offer(unit_id='o-1', name='o-1', parent_id='c-1', price=100),
+    generate_offer(unit_id='o-2', name='o-2', parent_id='c-2', price=15),
+    generate_offer(unit_id='o-3', name='o-3', parent_id='c-2', price=40),
+    generate_offer(unit_id='o-4', name='o-4', parent_id='c-3', price=7),
+    generate_offer(unit_id='o-5', name='o-5', parent_id='c-4', price=1999),
+]
+
+
+@pytest.mark.parametrize('unit_id', ['c-1', 'c-3', 'c-4', 'o-5'])
+@pytest.mark.parametrize('stream_children', [True, False])
+@pytest.mark.parametrize('prefetch', [DEFAULT_PG_PREFETCH, 1])
+async def test_subtree_streamer_matches_do_stream(api_client, api_server, unit_id,
+                                                  stream_children, prefetch):
+    await import_data(api_client, SUBTREE_UNITS, date=date - timedelta(hours=1))
+    await import_data(api_client, [
+        generate_offer(unit_id='o-3', name='o-3', parent_id='c-4', price=45),
+    ], date=date)
+
+    async with api_server.app['pg'].begin() as conn:
+        record = await ShopUnitStreamer.get_unit_record_by_id(unit_id, conn, None, None)
+        streamer = shop_unit_streamer_from_record(record, conn, None, None,
+                                                  stream_children=stream_children)
+        expected = ''.join([chunk async for chunk in do_stream(streamer)])
+
+        streamer = ShopUnitSubtreeStreamer(unit_id, conn, None, None,
+                                           stream_children=stream_children,
+                                           prefetch=prefetch)
+        actual = b''.join([chunk async for chunk in streamer]).decode()
+
+    assert actual == expected
+
+
+async def test_do_stream_empty_category(api_client, api_server):
+    # Пустая категория идёт после товара: у неё нет ни цены, ни товаров
+    await import_data(api_client, [
+        generate_category(unit_id='c-1', name='c-1'),
+        generate_offer(unit_id='a-1', name='a-1', parent_id='c-1', price=10),
+        generate_category(unit_id='c-2', name='c-2', parent_id='c-1'),
+        generate_category(unit_id='c-3', name='c-3', parent_id='c-2'),
+    ], date=date)
+
+    async with api_server.app['pg'].begin() as conn:
+        record = await ShopUnitStreamer.get_unit_record_by_id('c-1', conn, None, None)
+        streamer = shop_unit_streamer_from_record(record, conn, None, None)
+        actual = ''.join([chunk async for chunk in do_stream(streamer)])
+
+    assert json.loads(actual) == await get_unit(api_client, 'c-1')
+
+
+@pytest.mark.parametrize('page_size', [1, 2])
+async def test_do_stream_pages_children(api_client, api_server, monkeypatch, page_size):
+    # Страница детей и её граница не должны влиять на результат
+    monkeypatch.setattr(ShopCategoryStreamer, 'CHILDREN_PAGE_SIZE', page_size)
+    await import_data(api_client, SUBTREE_UNITS, date=date)
+
+    async with api_server.app['pg'].begin() as conn:
+        record = await ShopUnitStreamer.get_unit_record_by_id('c-1', conn, None, None)
+        streamer = shop_unit_streamer_from_record(record, conn, None, None)
+        actual = ''.join([chunk async for chunk in do_stream(streamer)])
+
+    assert json.loads(actual) == await get_unit(api_client, 'c-1')
+
+
+async def test_category_aggregates(api_client, api_server):
+    await import_data(api_client, SUBTREE_UNITS, date=date - timedelta(hours=2))
+    await import_data(api_client, [
+        generate_category(unit_id='c-4', name='c-4', parent_id='c-2'),
+        generate_offer(unit_id='o-4', name='o-4', parent_id='c-2', price=8),
+    ], date=date - timedelta(hours=1))
+    await delete_unit(api_client, 'o-3')
+    await delete_unit(api_client, 'c-3')
+
+    async with api_server.app['pg'].begin() as conn:
+        for unit_id in ('c-1', 'c-2', 'c-4'):
+            streamer = ShopUnitSubtreeStreamer(unit_id, conn, None, date,
+                                               stream_children=False)
+            expected = b''.join([chunk async for chunk in streamer])
+
+            streamer = ShopUnitSubtreeStreamer(unit_id, conn, None, None,
+                                               stream_children=False)
+            actual = b''.join([chunk async for chunk in streamer])
+
+            assert actual == expected
+
+
+async def get_fresh_unit(api_server, unit_id):
+    async with api_server.app['pg'].begin() as conn:
+        streamer = ShopUnitSubtreeStreamer(unit_id, conn)
+        return json.loads(b''.join([chunk async for chunk in streamer]))
+
+
+async def test_nodes_cache(api_client, api_server):
+    cache = api_server.app['nodes_cache']
+    unit_ids = ['c-1', 'c-2', 'c-3', 'c-4', 'o-2', 'o-5']
+
+    await import_data(api_client, SUBTREE_UNITS, date=date - timedelta(hours=1))
+
+    for unit_id in unit_ids:
+        await get_unit(api_client, unit_id)
+    assert len(cache) == len(unit_ids)
+
+    assert await get_unit(api_client, 'c-1') == await get_fresh_unit(api_server, 'c-1')
+    assert cache.hits == 1
+
+    # Глубоко вложенный товар меняет цену, ещё один переезжает в другую ветку
+    await import_data(api_client, [
+        generate_offer(unit_id='o-5', name='o-5', parent_id='c-4', price=5),
+        generate_offer(unit_id='o-2', name='o-2', parent_id='c-4', price=15),
+    ], date=date)
+
+    for unit_id in unit_ids:
+        assert await get_unit(api_client, unit_id) == await get_fresh_unit(api_server, unit_id)
+
+    await delete_unit(api_client, 'c-3')
+
+    for unit_id in ('c-3', 'c-4', 'o-2', 'o-5'):
+        await get_unit(api_client, unit_id, expected_status=HTTPStatus.NOT_FOUND)
+    assert await get_unit(api_client, 'c-1') == await get_fresh_unit(api_server, 'c-1')
+
+    # Ответ из кэша не держит соединение, открытое для чтения версии
+    assert api_server.app['pg'].sync_engine.pool.checkedout() == 0
+
+
+async def test_single_snapshot(api_client, api_server):
+    await import_data(api_client, SUBTREE_UNITS, date=date - timedelta(hours=1))
+    expected = await get_unit(api_client, 'c-1')
+
+    query = GetShopUnitQuery('c-1', api_server.app['pg'])
+    assert await query.open() is not None
+
+    # Поддерево удаляется после чтения версии, но тело читается из того же снимка
+    await delete_unit(api_client, 'c-1')
+
+    assert json.loads(b''.join([chunk async for chunk in query])) == expected
+    assert api_server.app['pg'].sync_engine.pool.checkedout() == 0
+
+    assert await GetShopUnitQuery('c-1', api_server.app['pg']).open() is None
+
+
+async def get_etag(api_client, unit_id, etag=None, expected_status=HTTPStatus.OK):
+    headers = {'If-None-Match': etag} if etag else {}
+    response = await api_client.get(url_for(NodesView.URL_PATH, id=unit_id), headers=headers)
+
+    assert response.status == expected_status
+    return response.headers['ETag']
+
+
+async def test_conditional_get(api_client):
+    await import_data(api_client, SUBTREE_UNITS, date=date - timedelta(hours=2))
+
+    etags = {unit_id: await get_etag(api_client, unit_id) for unit_id in ('c-1', 'c-2', 'c-4')}
+
+    for unit_id, etag in etags.items():
+        assert await get_etag(api_client, unit_id, etag, HTTPStatus.NOT_MODIFIED) == etag
+    assert await get_etag(api_client, 'c-1', '"other", ' + etags['c-1'],
+                          HTTPStatus.NOT_MODIFIED) == etags['c-1']
+
+    # Цена меняется глубоко в c-3, поддерево c-2 не затронуто
+    await import_data(api_client, [
+        generate_offer(unit_id='o-5', name='o-5', parent_id='c-4', price=5),
+    ], date=date - timedelta(hours=1))
+
+    assert await get_etag(api_client, 'c-1', etags['c-1']) != etags['c-1']
+    assert await get_etag(api_client, 'c-4', etags['c-4']) != etags['c-4']
+    await get_etag(api_client, 'c-2', etags['c-2'], HTTPStatus.NOT_MODIFIED)
+
+    # Удаление товара меняет тег предков, даже если дата обновления не меняется
+    etag = await get_etag(api_client, 'c-2')
+    await delete_unit(api_client, 'o-3')
+    assert await get_etag(api_client, 'c-2', etag) != etag
+
+
+async def chunks(*values):
+    for value in values:
+        yield value
+
+
+async def test_subtree_cache_eviction():
+    cache = SubtreeCache(max_size=10)
+
+    for unit_id in ('a', 'b', 'c'):
+        assert [chunk async for chunk in cache.collect(unit_id, 1, chunks(b'12', b'34'))]
+    assert cache.get('a', 1) is None
+    assert cache.get('b', 1) == b'1234'
+
+    # Последним использовался b, поэтому вытесняется c
+    [_ async for _ in cache.collect('d', 1, chunks(b'1234'))]
+    assert cache.get('c', 1) is None
+    assert cache.get('d', 1) == b'1234'
+
+    # Ответ больше всего кэша не сохраняется и ничего не вытесняет
+    [_ async for _ in cache.collect('e', 1, chunks(b'12345', b'678901'))]
+    assert cache.get('e', 1) is None
+    assert cache.get('b', 1) == b'1234'
+
+    assert (cache.hits, cache.misses, cache.evictions, cache.size) == (3, 3, 2, 8)
+
+
+async def test_subtree_cache_skips_stale_response():
+    cache = SubtreeCache()
+
+    collect = cache.collect('a', 1, chunks(b'old'))
+    assert await collect.__anext__() == b'old'
+
+    # Импорт зафиксировался, пока ответ ещё отдавался: ответ попадает в кэш уже после сброса,
+    # но остаётся привязан к версии 1 и для новой версии не отдаётся
+    cache.invalidate(['a'])
+    [_ async for _ in collect]
+
+    assert cache.get('a', 1) == b'old'
+    assert cache.get('a', 2) is None
+
+    [_ async for _ in cache.collect('a', 2, chunks(b'new'))]
+    assert cache.get('a', 2) == b'new'
+    assert cache.get('a', 1) is None
@@ -0,0 +1,56 @@
+from http import HTTPStatus
+
+import pytest
+
+from megamarket.utils.testing import generate_category, generate_offer, import_data, get_unit, \
+    get_units_batch
+
+UNITS = [
+    generate_category(unit_id='c-1'),
+    generate_category(unit_id='c-2', parent_id='c-1'),
+    generate_category(unit_id='c-3', parent_id='c-2'),
+    generate_offer(unit_id='o-1', parent_id='c-2', price=100),
+    generate_offer(unit_id='o-2', parent_id='c-3', price=50),
+    generate_offer(unit_id='o-3', parent_id='c-1', price=10),
+    generate_category(unit_id='d-1'),
+    generate_offer(unit_id='o-4', parent_id='d-1', price=1),
+    generate_category(unit_id='e-1'),
+]
+
+
+@pytest.fixture(params=[False, True], ids=['engine', 'raw-pool'])
+def arguments(arguments, request):
+    arguments.pg_raw_pool = request.param
+    return arguments
+
+
+@pytest.mark.parametrize('unit_ids', [
+    ['c-1'],
+    ['c-1', 'd-1', 'e-1'],
+    # Вложенные поддеревья, в том числе вложенные друг в друга и офферы
+    ['c-1', 'c-2', 'c-3', 'o-1', 'o-2'],
+    ['o-2', 'c-3', 'c-1', 'd-1', 'o-4'],
+    ['c-2', 'o-3'],
+    ['x', 'c-3', 'x'],
+])
+async def test_nodes_batch(api_client, unit_ids):
+    await import_data(api_client, UNITS)
+
+    data = await get_units_batch(api_client, unit_ids)
+
+    assert set(data) == set(unit_ids)
+
+    for unit_id in unit_ids:
+        if unit_id == 'x':
+            assert data[unit_id] is None
+        else:
+            assert data[unit_id] == await get_unit(api_client, unit_id)
+
+
+@pytest.mark.parametrize('unit_ids', [[], [''], [1]])
+async def test_nodes_batch_validation(api_client, unit_ids):
+    await get_units_batch(api_client, unit_ids, expected_status=HTTPStatus.BAD_REQUEST)
+
+
+async def test_nodes_batch_empty_database(api_client):
+    assert await get_units_batch(api_client, ['c-1']) == {'c-1': None}
@@ -0,0 +1,78 @@
+import pytest
+
+from megamarket.utils.testing import generate_category, generate_offer, import_data, get_unit
+
+UNITS = [
+    generate_category(unit_id='c-1'),
+    generate_category(unit_id='c-2', parent_id='c-1'),
+    generate_category(unit_id='c-3', parent_id='c-2'),
+    generate_category(unit_id='c-4', parent_id='c-1'),
+    generate_offer(unit_id='o-1', parent_id='c-3', price=100),
+    generate_offer(unit_id='o-2', parent_id='c-2', price=50),
+    generate_offer(unit_id='o-3', parent_id='c-1', price=10),
+]
+
+
+@pytest.fixture(params=[False, True], ids=['engine', 'raw-pool'])
+def arguments(arguments, request):
+    arguments.pg_raw_pool = request.param
+    return arguments
+
+
+def cut(unit: dict, depth: int) -> dict:
+    """
+    Полный ответ /nodes, обрезанный так, как его должен отдать запрос с depth.
+    """
+    if unit['type'] == 'OFFER':
+        return unit
+
+    unit = {**unit, 'hasChildren': bool(unit['children'])}
+
+    if depth == 0:
+        del unit['children']
+    else:
+        unit['children'] = [cut(child, depth - 1) for child in unit['children']]
+
+    return unit
+
+
+def children_ids(unit: dict) -> list[str]:
+    return [child['id'] for child in unit['children']]
+
+
+@pytest.mark.parametrize('depth', [0, 1, 2, 3])
+async def test_depth(api_client, depth):
+    await import_data(api_client, UNITS)
+    full = await get_unit(api_client, 'c-1')
+
+    unit = await get_unit(api_client, 'c-1', params={'depth': depth})
+
+    # Цены совпадают с полным ответом, хотя глубже depth ничего не загружалось
+    assert unit == cut(full, depth)
+
+
+async def test_children_pages(api_client):
+    await import_data(api_client, UNITS)
+    full = await get_unit(api_client, 'c-1')
+
+    first = await get_unit(api_client, 'c-1', params={'childrenLimit': 2})
+    assert children_ids(first) == ['c-2', 'c-4']
+    assert first['nextCursor'] == 'c-4'
+    assert first['price'] == full['price']
+    assert first['children'][0] == cut(full['children'][0], 100)
+
+    params = {'childrenLimit': 2, 'cursor': first['nextCursor']}
+    second = await get_unit(api_client, 'c-1', params=params)
+    assert children_ids(second) == ['o-3']
+    assert second['nextCursor'] is None
+
+    params = {'depth': 1, 'childrenLimit': 1, 'cursor': 'c-2'}
+    third = await get_unit(api_client, 'c-1', params=params)
+    assert third['children'] == [cut(full['children'][1], 0)]
+    assert third['nextCursor'] == 'c-4'
+
+
+@pytest.mark.parametrize('params', [{'depth': -1}, {'childrenLimit': 0}, {'cursor': ''}])
+async def test_invalid_params(api_client, params):
+    await import_data(api_client, UNITS)
+    await get_unit(api_client, 'c-1', params=params, expected_status=400)
@@ -0,0 +1,131 @@
+import asyncio
+import json
+from datetime import datetime
+
+import pytest
+
+from megamarket.api.payloads import AsyncStreamJsonPayload, SERIALIZERS, StreamAborted
+from megamarket.db.schema import ShopUnitType
+from megamarket.utils.deadline import DeadlineExceeded
+
+
+class Writer:
+    def __init__(self):
+        self.chunks = []
+
+    async def write(self, chunk: bytes):
+        self.chunks.append(chunk)
+
+
+class DisconnectedWriter(Writer):
+    async def write(self, chunk: bytes):
+        await super().write(chunk)
+        raise ConnectionResetError()
+
+
+async def generate(*rows, delay: float = 0):
+    for row in rows:
+        if delay:
+            await asyncio.sleep(delay)
+
+        yield row
+
+
+async def test_write_coalescing():
+    writer = Writer()
+    payload = AsyncStreamJsonPayload(generate('{', '', '"a": ', '"ё"', '', '}'),
+                                     flush_size=1024, flush_interval=60)
+
+    await payload.write(writer)
+
+    assert writer.chunks == ['{"a": "ё"}'.encode()]
+
+
+async def test_bytes_rows():
+    writer = Writer()
+    payload = AsyncStreamJsonPayload(generate(b'{"a": ', memoryview(b'{"b": 1}')[1:]),
+                                     flush_size=1024, flush_interval=60)
+
+    await payload.write(writer)
+
+    assert writer.chunks == [b'{"a": "b": 1}']
+
+
+async def test_flush_size():
+    writer = Writer()
+    payload = AsyncStreamJsonPayload(generate(*['12345'] * 5), flush_size=10, flush_interval=60)
+
+    await payload.write(writer)
+
+    assert writer.chunks == [b'1234512345', b'1234512345', b'12345']
+
+
+async def test_flush_interval():
+    writer = Writer()
+    payload = AsyncStreamJsonPayload(generate('[1', ', 2', ']', delay=0.1),
+                                     flush_size=1024, flush_interval=0.05)
+
+    await payload.write(writer)
+
+    assert writer.chunks == [b'[1', b', 2', b']']
+
+
+async def test_flush_interval_error():
+    writer = DisconnectedWriter()
+    payload = AsyncStreamJsonPayload(generate('[1', ', 2', ', 3', ']', delay=0.1),
+                                     flush_size=1024, flush_interval=0.05)
+
+    # Ошибка записи по таймеру останавливает отдачу, а не теряется в фоновой задаче
+    with pytest.raises(ConnectionResetError):
+        await payload.write(writer)
+
+    assert writer.chunks == [b'[1']
+
+
+async def test_deadline_exceeded():
+    async def rows():
+        yield '[1'
+        raise DeadlineExceeded()
+
+    writer = Writer()
+    payload = AsyncStreamJsonPayload(rows(), flush_size=1024, flush_interval=60)
+
+    # Заголовки уже отправлены, поэтому соединение обрывается, а накопленное в буфере
+    # не отправляется
+    with pytest.raises(StreamAborted):
+        await payload.write(writer)
+
+    assert writer.chunks == []
+
+
+@pytest.mark.parametrize('name', SERIALIZERS)
+def test_serializer(name):
+    serializer = SERIALIZERS[name]()
+    value = {
+        'id': 'о-1',
+        'date': datetime(2022, 2, 1, 12),
+        'type': ShopUnitType.OFFER,
+        'price': 10,
+        'children': None,
+    }
+
+    data = serializer.dumpb(value)
+
+    assert data.decode() == serializer.dumps(value)
+    assert json.loads(data) == {
+        'id': 'о-1',
+        'date': '2022-02-01T12:00:00.000Z',
+        'type': 'OFFER',
+        'price': 10,
+        'children': None,
+    }
+
+
+@pytest.mark.parametrize('name', SERIALIZERS)
+def test_serializer_int_keys(name):
+    serializer = SERIALIZERS[name]()
+
+    # Так marshmallow описывает ошибку в элементе списка
+    data = serializer.dumpb({'items': {0: ['Invalid']}})
+
+    assert json.loads(data) == {'items': {'0': ['Invalid']}}
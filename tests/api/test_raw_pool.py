@@ -0,0 +1,72 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from megamarket.api.handlers.node import GetNodeStatistic
+from megamarket.api.handlers.nodes import GetShopUnitQuery
+from megamarket.api.handlers.sales import GetSalesQuery
+from megamarket.utils.pg import setup_pg
+from megamarket.utils.testing import generate_category, generate_offer, import_data, get_unit, \
+    get_sales, get_node_statistic
+
+date = datetime.now()
+
+UNITS = [
+    generate_category(unit_id='c-1', name='c-1'),
+    generate_category(unit_id='c-2', name='c-2', parent_id='c-1'),
+    generate_offer(unit_id='o-1', name='o-1', parent_id='c-1', price=100),
+    generate_offer(unit_id='o-2', name='o-2', parent_id='c-2', price=15),
+]
+
+
+@pytest.fixture
+def arguments(arguments):
+    arguments.pg_raw_pool = True
+    return arguments
+
+
+async def read(query) -> dict:
+    return json.loads(b''.join([chunk async for chunk in query]))
+
+
+async def test_raw_pool(api_client, api_server):
+    pg = api_server.app['pg']
+    assert api_server.app['pg_pool'] is not None
+
+    await import_data(api_client, UNITS, date=date - timedelta(hours=1))
+    await import_data(api_client, [
+        generate_offer(unit_id='o-2', name='o-2', parent_id='c-1', price=20),
+    ], date=date)
+
+    assert await get_unit(api_client, 'c-1') == await read(GetShopUnitQuery('c-1', pg))
+
+    assert await get_sales(api_client, date) == (await read(GetSalesQuery(
+        pg, from_date=date - timedelta(days=1), to_date=date
+    )))['items']
+
+    assert await get_node_statistic(api_client, 'c-1') == (await read(
+        GetNodeStatistic('c-1', pg, to_date=None)
+    ))['items']
+
+
+async def test_pool_options(arguments):
+    arguments.pg_statement_cache_size = 0
+    arguments.pg_raw_pool_max = 2
+
+    app = {}
+    setup = setup_pg(app, arguments)
+    await setup.__anext__()
+
+    try:
+        # Подготовленные запросы не кэшируются ни движком, ни пулом asyncpg
+        async with app['pg'].connect() as conn:
+            raw_connection = await conn.get_raw_connection()
+            assert raw_connection.connection._prepared_statement_cache is None
+
+        async with app['pg_pool'].acquire() as conn:
+            assert conn._stmt_cache.get_max_size() == 0
+
+        assert app['pg_pool'].get_max_size() == 2
+    finally:
+        await setup.aclose()
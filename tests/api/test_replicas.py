@@ -0,0 +1,104 @@
+import uuid
+from http import HTTPStatus
+from types import SimpleNamespace
+
+import pytest
+from alembic.command import upgrade
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy_utils import create_database, drop_database
+from yarl import URL
+
+from megamarket.utils.pg import make_alembic_config
+from megamarket.utils.replicas import Replica, ReplicaSet
+from megamarket.utils.testing import generate_category, generate_offer, import_data, get_unit, \
+    get_sales
+from tests.conftest import PG_URL
+
+UNITS = [
+    generate_category(unit_id='c-1'),
+    generate_offer(unit_id='o-1', parent_id='c-1', price=100),
+]
+
+
+@pytest.fixture
+def replica_postgres():
+    """
+    Отдельная пустая база вместо реплики: по ответам видно, куда ушло чтение.
+    """
+    tmp_url = str(URL(PG_URL).with_path('.'.join([uuid.uuid4().hex, 'pytest'])))
+    create_database(tmp_url)
+
+    try:
+        options = SimpleNamespace(config='alembic.ini', name='alembic',
+                                  pg_url=tmp_url, raiseerr=False, x=None)
+        upgrade(make_alembic_config(options), 'head')
+
+        yield tmp_url
+    finally:
+        drop_database(tmp_url)
+
+
+@pytest.fixture
+def read_your_writes():
+    return False
+
+
+@pytest.fixture
+def arguments(arguments, replica_postgres, read_your_writes):
+    arguments.pg_replica_url = [URL(replica_postgres)]
+    arguments.pg_read_your_writes = read_your_writes
+    return arguments
+
+
+async def test_reads_go_to_replica(api_client, api_server):
+    await import_data(api_client, UNITS)
+
+    await get_unit(api_client, 'c-1', expected_status=HTTPStatus.NOT_FOUND)
+    assert await get_sales(api_client) == []
+
+    # Без доступных реплик чтение уходит в основную базу
+    api_server.app['pg_replicas'].replicas[0].healthy = False
+
+    await get_unit(api_client, 'c-1')
+    assert len(await get_sales(api_client)) == 1
+
+
+@pytest.mark.parametrize('read_your_writes', [True])
+async def test_read_your_writes(api_client, api_server):
+    replicas = api_server.app['pg_replicas']
+
+    await get_unit(api_client, 'c-1', expected_status=HTTPStatus.NOT_FOUND)
+
+    # Подставная реплика не сообщает позицию журнала, поэтому после записи читается основная
+    await import_data(api_client, UNITS)
+    assert replicas.last_write_lsn is not None
+
+    await get_unit(api_client, 'c-1')
+
+    replicas.replicas[0].replay_lsn = replicas.last_write_lsn
+    await get_unit(api_client, 'c-1', expected_status=HTTPStatus.NOT_FOUND)
+
+
+async def test_unavailable_replica(aiomisc_unused_port):
+    url = URL(PG_URL).with_port(aiomisc_unused_port)
+    engine = create_async_engine(str(url.with_scheme('postgresql+asyncpg')))
+    replicas = ReplicaSet(None, 'primary', [Replica(url, engine)])
+
+    try:
+        assert replicas.choose() is engine
+
+        await replicas.check(timeout=5)
+
+        assert not replicas.replicas[0].healthy
+        assert replicas.choose() == 'primary'
+    finally:
+        await engine.dispose()
+
+
+def test_round_robin():
+    replicas = ReplicaSet(None, 'primary', [Replica(URL(), 'a'), Replica(URL(), 'b')])
+
+    assert [replicas.choose() for _ in range(4)] == ['a', 'b', 'a', 'b']
+
+    replicas.replicas[0].healthy = False
+    assert [replicas.choose() for _ in range(2)] == ['b', 'b']
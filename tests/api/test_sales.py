@@ -1,7 +1,9 @@
 import datetime
+import json
 
-from megamarket.utils.testing import generate_offer, generate_response_offer, get_sales, \
-    import_data, compare_unit_lists
+from megamarket.api.handlers.sales import GetSalesQuery
+from megamarket.utils.testing import generate_offer, generate_category, generate_response_offer, \
+    get_sales, import_data, compare_unit_lists
 
 date = datetime.datetime.now()
 
@@ -76,3 +78,53 @@ async def test_duplicate_update(api_client):
     ]
 
     assert compare_unit_lists(resp, expected_units)
+
+
+async def test_updated_after_period(api_client):
+    unit1 = [generate_offer(unit_id='1', name='1', price=123321)]
+    unit2 = [generate_offer(unit_id='1', name='2', price=321123)]
+
+    await import_data(api_client, unit1, date - datetime.timedelta(hours=2))
+    await import_data(api_client, unit2, date)
+
+    resp = await get_sales(api_client, date - datetime.timedelta(hours=1))
+
+    expected_units = [
+        generate_response_offer(unit_id='1', name='1', price=123321,
+                                date=date - datetime.timedelta(hours=2),
+                                include_children=False),
+    ]
+
+    assert compare_unit_lists(resp, expected_units)
+
+
+async def test_parent_at_period(api_client, api_server):
+    categories = [generate_category(unit_id='c-1'), generate_category(unit_id='c-2')]
+    offers = [
+        generate_offer(unit_id=str(i), name=str(i), price=100 + i, parent_id='c-1')
+        for i in range(5)
+    ]
+
+    await import_data(api_client, categories + offers, date - datetime.timedelta(hours=2))
+    await import_data(
+        api_client,
+        [generate_offer(unit_id='0', name='0', price=100, parent_id='c-2')],
+        date,
+    )
+
+    resp = await get_sales(api_client, date - datetime.timedelta(hours=1))
+
+    expected_units = [
+        generate_response_offer(unit_id=str(i), name=str(i), price=100 + i, parent_id='c-1',
+                                date=date - datetime.timedelta(hours=2),
+                                include_children=False)
+        for i in range(5)
+    ]
+
+    assert compare_unit_lists(resp, expected_units)
+
+    query = GetSalesQuery(api_server.app['pg'], from_date=date - datetime.timedelta(days=1),
+                          to_date=date - datetime.timedelta(hours=1), prefetch=2)
+    chunks = [chunk async for chunk in query]
+
+    assert json.loads(b''.join(chunks))['items'] == resp
@@ -0,0 +1,135 @@
+import os
+import re
+import signal
+import threading
+import time
+from functools import partial
+from multiprocessing import get_context
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+from aiomisc.utils import bind_socket
+
+from megamarket.api.__main__ import serve
+from megamarket.api.handlers import NodesView
+from megamarket.utils.testing import url_for
+from megamarket.utils.workers import WorkerPool
+
+context = get_context('fork')
+
+
+def wait_for(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_worker_pool_restarts_and_stops():
+    starts = context.Array('i', [0, 0])
+
+    def target(index: int):
+        with starts.get_lock():
+            starts[index] += 1
+
+        # Первый запуск воркера 0 падает, остальные работают до SIGTERM
+        if index == 0 and starts[index] == 1:
+            os._exit(1)
+
+        signal.pause()
+
+    pool = WorkerPool(target, 2, restart_delay=0, shutdown_timeout=5)
+    thread = threading.Thread(target=pool.run)
+    thread.start()
+
+    try:
+        wait_for(lambda: list(starts) == [2, 1])
+    finally:
+        pool.stop()
+        thread.join(10)
+
+    assert not thread.is_alive()
+    assert list(starts) == [2, 1]
+
+
+def test_worker_pool_kills_stuck_workers():
+    started = context.Event()
+
+    def target(index: int):
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        started.set()
+        signal.pause()
+
+    pool = WorkerPool(target, 1, shutdown_timeout=0.1)
+    thread = threading.Thread(target=pool.run)
+    thread.start()
+
+    started.wait(10)
+    pool.stop()
+    thread.join(10)
+
+    assert not thread.is_alive()
+
+
+def http_get(port: int, path: str) -> tuple[int, str]:
+    try:
+        with urlopen(f'http://127.0.0.1:{port}{path}', timeout=5) as response:
+            return response.status, response.read().decode()
+    except HTTPError as e:
+        return e.code, e.read().decode()
+
+
+def is_up(port: int) -> bool:
+    try:
+        http_get(port, '/metrics')
+    except (URLError, ConnectionError):
+        return False
+
+    return True
+
+
+def count_requests(metrics: str, worker: int, route: str) -> int:
+    pattern = (rf'megamarket_request_duration_seconds_count{{worker="{worker}",'
+               rf'method="GET",route="{re.escape(route)}",status="404"}} (\d+)')
+    match = re.search(pattern, metrics)
+    return int(match.group(1)) if match else 0
+
+
+def test_metrics_per_worker(arguments):
+    arguments.workers = 2
+    sock = bind_socket(address='127.0.0.1', port=0, proto_name='http')
+    metrics_socks = [bind_socket(address='127.0.0.1', port=0, proto_name='http')
+                     for _ in range(arguments.workers)]
+
+    api_port = sock.getsockname()[1]
+    metrics_ports = [metrics_sock.getsockname()[1] for metrics_sock in metrics_socks]
+
+    pool = WorkerPool(partial(serve, arguments, sock, metrics_socks), arguments.workers,
+                      restart_delay=0, shutdown_timeout=5)
+    thread = threading.Thread(target=pool.run)
+    thread.start()
+
+    try:
+        wait_for(lambda: is_up(api_port) and all(map(is_up, metrics_ports)), timeout=30)
+
+        # Общий сокет API отдаёт запрос случайному воркеру, поэтому метрик на нём нет
+        assert http_get(api_port, '/metrics')[0] == 404
+
+        requests = 20
+        for _ in range(requests):
+            status, _ = http_get(api_port, url_for(NodesView.URL_PATH, id='missing'))
+            assert status == 404
+
+        def handled() -> list[int]:
+            return [
+                count_requests(http_get(port, '/metrics')[1], worker, '/nodes/{id}')
+                for worker, port in enumerate(metrics_ports)
+            ]
+
+        # Каждый воркер отдаёт только свои запросы, вместе они дают все
+        wait_for(lambda: sum(handled()) == requests)
+    finally:
+        pool.stop()
+        thread.join(10)
+
+    assert not thread.is_alive()
@@ -0,0 +1,200 @@
+"""
+Проверяет, что запросы стримеров, импорта и триггеров на большом каталоге идут по индексам.
+Если после изменения схемы или запроса планировщик начнёт читать таблицу целиком, тест упадёт.
+"""
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from alembic.command import upgrade
+from sqlalchemy import create_engine, event, text
+from sqlalchemy_utils import create_database, drop_database
+from yarl import URL
+
+from megamarket.api.handlers.delete import DeleteView
+from megamarket.api.handlers.imports import ImportsView
+from megamarket.api.handlers.sales import GetSalesQuery
+from megamarket.db.alembic.versions import e3a9f1b6d2c4_statement_level_checks as \
+    statement_level_checks
+from megamarket.utils.aggregates import (
+    get_parent_ids_query, get_dirty_categories_query, get_update_aggregates_query,
+    get_update_versions_query
+)
+from megamarket.utils.pg import make_alembic_config
+from megamarket.utils.streamers import ShopUnitStreamer, ShopUnitSubtreeStreamer, \
+    ShopUnitPageStreamer, ShopUnitBatchStreamer
+from megamarket.utils.testing import seed_catalog
+from tests.conftest import PG_URL
+
+CATEGORIES_COUNT = 1000
+OFFERS_COUNT = 20000
+REVISIONS_PER_OFFER = 3
+BASE_DATE = datetime(2022, 1, 1)
+CATALOG_DAYS = 100
+
+LARGE_TABLES = {'shop_unit_ids', 'shop_unit_revisions', 'relations', 'shop_units_current'}
+
+# Проверки триггеров уровня оператора. Переходные таблицы доступны только внутри триггера,
+# поэтому подменяются CTE с тем же именем и строками, похожими на пачку импорта
+STATEMENT_CHECK_QUERIES = [
+    text(
+        'WITH new_relations AS MATERIALIZED ('
+        '    SELECT * FROM relations WHERE child_revision_id <= 100'
+        f') SELECT EXISTS({statement_level_checks.OFFER_PARENTS_QUERY})'
+    ),
+    text(
+        'WITH new_revisions AS MATERIALIZED ('
+        '    SELECT * FROM shop_unit_revisions WHERE id <= 100'
+        f') SELECT EXISTS({statement_level_checks.TYPE_CHANGES_QUERY})'
+    ),
+]
+
+# Запросы, которые выполняют триггер удаления детей и каскадное удаление по внешним ключам
+TRIGGER_QUERIES = [
+    text('SELECT id FROM shop_units_current WHERE parent_id = :unit_id'),
+    text('SELECT 1 FROM relations WHERE parent_id = :unit_id'),
+    text('SELECT 1 FROM shop_unit_revisions WHERE shop_unit_id = :unit_id'),
+    text('SELECT 1 FROM shop_units_current WHERE revision_id = 42'),
+]
+
+
+def explain(conn, cursor, statement, parameters, context, executemany):
+    return 'EXPLAIN (FORMAT JSON) ' + statement, parameters
+
+
+def walk_plan(plan: dict):
+    yield plan
+
+    for child in plan.get('Plans', []):
+        yield from walk_plan(child)
+
+
+def get_seq_scans(connection, query, **params) -> list[str]:
+    plans = []
+
+    # План забирается прямо из курсора: для INSERT и UPDATE без RETURNING
+    # SQLAlchemy закрывает результат, не читая строк
+    def fetch_plan(conn, cursor, statement, parameters, context, executemany):
+        plans.append(cursor.fetchone()[0])
+
+    event.listen(connection, 'before_cursor_execute', explain, retval=True)
+    event.listen(connection, 'after_cursor_execute', fetch_plan)
+
+    try:
+        with connection.begin():
+            connection.execute(query, params)
+    finally:
+        event.remove(connection, 'after_cursor_execute', fetch_plan)
+        event.remove(connection, 'before_cursor_execute', explain)
+
+    return [
+        node['Relation Name']
+        for node in walk_plan(plans[0][0]['Plan'])
+        if node['Node Type'] == 'Seq Scan' and node['Relation Name'] in LARGE_TABLES
+    ]
+
+
+@pytest.fixture(scope='module')
+def catalog_connection():
+    tmp_url = str(URL(PG_URL).with_path('.'.join([uuid.uuid4().hex, 'pytest'])))
+    create_database(tmp_url)
+
+    options = SimpleNamespace(config='alembic.ini', name='alembic',
+                              pg_url=tmp_url, raiseerr=False, x=None)
+    upgrade(make_alembic_config(options), 'head')
+
+    engine = create_engine(tmp_url)
+    connection = engine.connect()
+
+    try:
+        with connection.begin():
+            seed_catalog(connection, CATEGORIES_COUNT, OFFERS_COUNT, REVISIONS_PER_OFFER,
+                         BASE_DATE, days=CATALOG_DAYS)
+
+        yield connection
+    finally:
+        connection.close()
+        engine.dispose()
+        drop_database(tmp_url)
+
+
+def get_import_units():
+    return [
+        {'id': 'o-1', 'name': 'o-1', 'type': 'OFFER', 'price': 1, 'parentId': 'c-50'},
+        {'id': 'c-50', 'name': 'c-50', 'type': 'CATEGORY', 'parentId': 'c-5'},
+    ]
+
+
+QUERIES = [
+    pytest.param(
+        lambda: ShopUnitSubtreeStreamer.get_subtree_query('c-50', None, None),
+        id='subtree'
+    ),
+    pytest.param(
+        lambda: ShopUnitPageStreamer.get_page_query('c-5', depth=2, children_limit=10,
+                                                    cursor='c-50'),
+        id='subtree-page'
+    ),
+    pytest.param(
+        lambda: ShopUnitBatchStreamer.get_roots_query(['c-5', 'c-50', 'o-1', 'x']),
+        id='batch-roots'
+    ),
+    pytest.param(
+        lambda: ShopUnitSubtreeStreamer.get_current_unit_query('c-50'),
+        id='current-unit'
+    ),
+    pytest.param(
+        lambda: ShopUnitStreamer.get_unit_record_by_id_query('o-1', None, None),
+        id='unit-record'
+    ),
+    pytest.param(
+        lambda: ShopUnitStreamer.get_unit_record_by_id_query(
+            'o-1', None, BASE_DATE + timedelta(days=2)),
+        id='unit-record-as-of'
+    ),
+    pytest.param(
+        lambda: GetSalesQuery.get_revisions(BASE_DATE + timedelta(days=49),
+                                            BASE_DATE + timedelta(days=50)),
+        id='sales'
+    ),
+    pytest.param(
+        lambda: ImportsView.get_update_current_units_query(
+            ImportsView.get_imported_units(get_import_units()), BASE_DATE + timedelta(days=200)
+        ),
+        id='import-current-units'
+    ),
+    pytest.param(
+        lambda: DeleteView.get_descendant_ids_query('c-5'),
+        id='delete-descendants'
+    ),
+    pytest.param(
+        lambda: get_parent_ids_query(['o-1', 'c-50']),
+        id='import-parent-ids'
+    ),
+    pytest.param(
+        lambda: get_dirty_categories_query(['o-1', 'c-50']),
+        id='aggregates-dirty-categories'
+    ),
+    pytest.param(
+        lambda: get_update_aggregates_query(['c-50', 'c-5']),
+        id='aggregates-update'
+    ),
+    pytest.param(
+        lambda: get_update_versions_query(['o-1', 'c-50', 'c-5']),
+        id='update-versions'
+    ),
+    *(
+        pytest.param(lambda query=query: query, id=f'statement-check-{i}')
+        for i, query in enumerate(STATEMENT_CHECK_QUERIES)
+    ),
+    *(
+        pytest.param(lambda query=query: query, id=f'trigger-{i}')
+        for i, query in enumerate(TRIGGER_QUERIES)
+    ),
+]
+
+
+@pytest.mark.parametrize('make_query', QUERIES)
+def test_query_uses_indexes(catalog_connection, make_query):
+    assert get_seq_scans(catalog_connection, make_query(), unit_id='c-50') == []